@@ -0,0 +1,422 @@
+"""
+Runs the benchmark for every URL in a file like run.sh does, but
+several URLs at a time.
+
+    python3 crawl.py pages.txt --jobs=4
+
+Every run of index.js writes to a directory of its own. Once it's
+done, its files are moved into the output directory and its rows are
+appended to benchmark.csv, one run at a time, so runs never write to
+the same file. Runs that fail, time out or don't write any rows are
+retried after a growing delay.
+
+Every URL that is done or failed for good is recorded in a ledger
+(crawl_ledger.jsonl in the output directory), so running the same
+command again after an interruption only benchmarks the URLs that are
+left. The output of every run is appended to the log in one piece,
+so the lines of parallel runs don't get mixed up.
+
+Pass --command to run something else than index.js, e.g. a stub for
+testing. {url} and {output} are replaced with the URL and the
+directory to write to.
+"""
+import argparse, asyncio, fcntl, json, os, random, shlex, shutil, signal, sys, time
+
+# Same as in run.sh. index.js is found next to this script, so the
+# crawl can be started from anywhere.
+default_command = "node {} -r 737173 -u {{url}} -o {{output}} --nowarn".format(shlex.quote(os.path.join(os.path.dirname(os.path.abspath(__file__)), "index.js")))
+
+# Files and directories that index.js writes to an output directory.
+benchmark_file = "benchmark.csv"
+data_dirs = [ "screenshots", "metrics", "noscript" ]
+
+def read_urls(path):
+    """
+    Returns the URLs of a file with one URL or hostname per line.
+    Hostnames are tested via HTTPS like run.sh does. Empty lines,
+    lines starting with # and repeated URLs are skipped.
+    """
+    urls = []
+    seen = set()
+
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+
+            if len(line) == 0 or line.startswith("#"):
+                continue
+
+            url = line if "://" in line else "https://" + line
+
+            if url not in seen:
+                seen.add(url)
+                urls.append(url)
+
+    return urls
+
+class CrawlError(Exception):
+    """
+    Raised if the crawl can't go on.
+    """
+    pass
+
+def format_duration(seconds):
+    return "{:.1f} s".format(seconds)
+
+async def kill(process):
+    """
+    Kills a process along with the processes it started, unless it's
+    done already.
+    """
+    if process.returncode is not None:
+        return
+
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+    await process.wait()
+
+class Ledger:
+
+    def __init__(self, path):
+        """
+        Opens the ledger of a crawl, a file with a JSON object per
+        line that holds the outcome of a URL. The file is locked, so
+        two crawls can't write to the same output directory.
+        """
+        self.path = path
+        self.status = {}
+        self.file = open(path, "a")
+
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.file.close()
+            raise CrawlError("{} is used by another crawl".format(path))
+
+        last = None
+        end = 0
+
+        with open(path, "rb") as f:
+            for line in f:
+                # A line that was cut off is the last one.
+                try:
+                    entry = json.loads(line) if line.endswith(b"\n") else None
+                except ValueError:
+                    entry = None
+
+                if entry is None:
+                    break
+
+                last = entry
+                end += len(line)
+                self.status[last["url"]] = last
+
+        # Otherwise new entries would end up on the line that was cut
+        # off and be skipped by the next crawl.
+        if os.path.getsize(path) > end:
+            os.truncate(path, end)
+
+        # Merges are always followed by the entry of their URL, so only
+        # the last one can have been cut off.
+        self.interrupted_merge = last if last is not None and last["status"] == "merging" else None
+
+    def get(self, url):
+        entry = self.status.get(url)
+        return None if entry is None else entry["status"]
+
+    def record(self, url, status, **fields):
+        """
+        Appends an entry and makes sure it's on disk before going on.
+        """
+        entry = dict(url=url, status=status, time=round(time.time(), 3), **fields)
+        self.status[url] = entry
+
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+class Crawler:
+
+    def __init__(self, out_dir_path, command, ledger, log_file, timeout=600, retries=2, backoff=10):
+        """
+        Runs the command for single URLs and merges their output into
+        the output directory. Everything except waiting for the
+        command happens on the event loop, so merges and log writes
+        never overlap.
+        """
+        self.out_dir_path = out_dir_path
+        self.command = command
+        self.ledger = ledger
+        self.log_file = log_file
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        self.tmp_dir_path = os.path.join(out_dir_path, ".crawl")
+        self.bm_file_path = os.path.join(out_dir_path, benchmark_file)
+
+        # Same as DEBUG=no-noscript ./run.sh, but it can be overridden.
+        self.env = dict(os.environ)
+        self.env.setdefault("DEBUG", "no-noscript")
+
+        self.counts = { "done": 0, "failed": 0 }
+
+    def recover(self):
+        """
+        Cleans up after a crawl that was interrupted. Rows of a merge
+        that was cut off are removed, so the URL can be benchmarked
+        again without showing up twice. Files that were already moved
+        are left for clean.py.
+        """
+        entry = self.ledger.interrupted_merge
+
+        if entry is not None:
+            if os.path.exists(self.bm_file_path) and os.path.getsize(self.bm_file_path) > entry["offset"]:
+                os.truncate(self.bm_file_path, entry["offset"])
+
+            self.ledger.record(entry["url"], "interrupted")
+
+        # Output of runs that didn't finish.
+        shutil.rmtree(self.tmp_dir_path, ignore_errors=True)
+        os.makedirs(self.tmp_dir_path)
+
+    def merge(self, url, run_dir_path):
+        """
+        Moves the files of a successful run into the output directory
+        and appends its rows to the main table. Returns the amount of
+        rows, which is 0 if the run gave up on the URL.
+        """
+        run_bm_file_path = os.path.join(run_dir_path, benchmark_file)
+
+        if not os.path.exists(run_bm_file_path):
+            return 0
+
+        with open(run_bm_file_path, "r") as f:
+            header = next(f, None)
+            rows = [ x for x in f if x.endswith("\n") ]
+
+        if len(rows) == 0:
+            return 0
+
+        offset = os.path.getsize(self.bm_file_path) if os.path.exists(self.bm_file_path) else 0
+
+        if offset > 0:
+            with open(self.bm_file_path, "r") as f:
+                if next(f, None) != header:
+                    raise CrawlError("The rows of {} have different columns than {} (was --iterations changed?)".format(url, self.bm_file_path))
+
+        for name in data_dirs:
+            src_dir_path = os.path.join(run_dir_path, name)
+            dst_dir_path = os.path.join(self.out_dir_path, name)
+
+            if not os.path.isdir(src_dir_path):
+                continue
+
+            os.makedirs(dst_dir_path, exist_ok=True)
+
+            for file_name in os.listdir(src_dir_path):
+                os.replace(os.path.join(src_dir_path, file_name), os.path.join(dst_dir_path, file_name))
+
+        # If the crawl stops in between, recover removes the rows again.
+        self.ledger.record(url, "merging", offset=offset)
+
+        with open(self.bm_file_path, "a") as f:
+            if offset == 0:
+                f.write(header)
+
+            f.writelines(rows)
+            f.flush()
+            os.fsync(f.fileno())
+
+        return len(rows)
+
+    def write_log(self, url, attempt, outcome, elapsed, output_path):
+        """
+        Appends the output of a run to the log, headed by a line that
+        says which URL it belongs to.
+        """
+        self.log_file.write("crawl: {} attempt {}/{} {} in {}\n".format(url, attempt, self.retries + 1, outcome, format_duration(elapsed)))
+
+        if os.path.exists(output_path):
+            with open(output_path, "r", errors="replace") as f:
+                shutil.copyfileobj(f, self.log_file)
+
+        self.log_file.flush()
+
+    async def run_command(self, url, run_dir_path, output_path):
+        """
+        Runs the command for a URL and returns its exit code, or None
+        if it timed out. The whole process group is killed on a timeout
+        or an interruption, since browsers start processes of their own.
+        """
+        args = [ x.format(url=url, output=run_dir_path) for x in shlex.split(self.command) ]
+
+        with open(output_path, "wb") as output:
+            # Starting the process can't be interrupted, otherwise it
+            # could be left running.
+            start = asyncio.ensure_future(asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.DEVNULL, stdout=output,
+                stderr=asyncio.subprocess.STDOUT, env=self.env, start_new_session=True))
+
+            try:
+                process = await asyncio.shield(start)
+            except asyncio.CancelledError:
+                await kill(await start)
+                raise
+
+            try:
+                return await asyncio.wait_for(process.wait(), self.timeout)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                await kill(process)
+
+    async def crawl_url(self, url, n):
+        """
+        Benchmarks a single URL, trying again until it works or there
+        are no retries left. Returns the outcome as a string.
+        """
+        run_dir_path = os.path.join(self.tmp_dir_path, str(n))
+        output_path = run_dir_path + ".log"
+        started = time.perf_counter()
+
+        for attempt in range(1, self.retries + 2):
+            shutil.rmtree(run_dir_path, ignore_errors=True)
+            t = time.perf_counter()
+
+            code = await self.run_command(url, run_dir_path, output_path)
+            rows = 0
+
+            if code is None:
+                error = "timed out after {}".format(format_duration(self.timeout))
+            elif code != 0:
+                error = "exited with code {}".format(code)
+            else:
+                rows = self.merge(url, run_dir_path)
+                error = "no rows written" if rows == 0 else None
+
+            self.write_log(url, attempt, "failed ({})".format(error) if error is not None else "done", time.perf_counter() - t, output_path)
+
+            if error is None:
+                self.ledger.record(url, "done", attempts=attempt, rows=rows, seconds=round(time.perf_counter() - started, 3))
+                break
+
+            if attempt <= self.retries:
+                # Exponential backoff with some jitter, so URLs that
+                # failed together aren't retried together.
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(1, 1.5))
+        else:
+            self.ledger.record(url, "failed", attempts=attempt, error=error, seconds=round(time.perf_counter() - started, 3))
+
+        shutil.rmtree(run_dir_path, ignore_errors=True)
+
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+        self.counts["done" if error is None else "failed"] += 1
+
+        return "{} after {} attempt{} in {}".format("done" if error is None else "failed ({})".format(error),
+            attempt, "" if attempt == 1 else "s", format_duration(time.perf_counter() - started))
+
+    async def crawl(self, urls, jobs):
+        """
+        Benchmarks the URLs with up to the given amount of runs at a
+        time.
+        """
+        pending = iter(enumerate(urls))
+        total = len(urls)
+
+        async def worker():
+            for n, url in pending:
+                outcome = await self.crawl_url(url, n)
+                print("[{}/{}] {}: {}".format(self.counts["done"] + self.counts["failed"], total, url, outcome), flush=True)
+
+        workers = [ asyncio.ensure_future(worker()) for _ in range(min(jobs, max(total, 1))) ]
+
+        try:
+            await asyncio.wait(workers, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            # Let every worker kill its process if one of them failed or
+            # the crawl was interrupted.
+            for x in workers:
+                x.cancel()
+
+            await asyncio.wait(workers)
+
+        # Raises the error of a worker that failed.
+        for x in workers:
+            if not x.cancelled():
+                x.result()
+
+async def run(crawler, urls, jobs):
+    # Stop like on Ctrl+C when the crawl is killed, e.g. under nohup.
+    task = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+
+    await crawler.crawl(urls, jobs)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0],
+        epilog="\n\n".join(__doc__.strip().split("\n\n")[1:]), formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("pages", help="file with a URL or hostname per line")
+    parser.add_argument("-o", "--output-dir", default="output", help="output directory (default: output)")
+    parser.add_argument("--jobs", type=int, default=1, help="amount of URLs to benchmark at a time (default: 1)")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds after which a run is killed (default: 600)")
+    parser.add_argument("--retries", type=int, default=2, help="how often to try a URL again (default: 2)")
+    parser.add_argument("--backoff", type=float, default=10, help="seconds to wait before the first retry, doubled for every further one (default: 10)")
+    parser.add_argument("--retry-failed", action="store_true", help="try URLs again that failed in an earlier crawl")
+    parser.add_argument("--log", default="noscript.log", help="file to append the output of every run to (default: noscript.log)")
+    parser.add_argument("--command", default=default_command, help="command to run for every URL, default: node index.js with the arguments of run.sh")
+    args = parser.parse_args()
+
+    if args.jobs < 1 or args.retries < 0 or args.timeout <= 0:
+        parser.error("--jobs and --timeout need to be positive, --retries can't be negative")
+
+    if "{url}" not in args.command or "{output}" not in args.command:
+        parser.error("--command needs to contain {url} and {output}")
+
+    try:
+        urls = read_urls(args.pages)
+    except IOError as e:
+        print("File IO error: {}".format(e))
+        sys.exit(1)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    try:
+        ledger = Ledger(os.path.join(args.output_dir, "crawl_ledger.jsonl"))
+    except CrawlError as e:
+        print(e)
+        sys.exit(1)
+
+    finished = [ "done" ] if args.retry_failed else [ "done", "failed" ]
+    todo = [ x for x in urls if ledger.get(x) not in finished ]
+    skipped = len(urls) - len(todo)
+
+    if skipped > 0:
+        print("Skipping {} URLs that are in the ledger already".format(skipped))
+
+    with open(args.log, "a") as log_file:
+        crawler = Crawler(os.path.abspath(args.output_dir), args.command, ledger, log_file, args.timeout, args.retries, args.backoff)
+        crawler.recover()
+
+        try:
+            asyncio.run(run(crawler, todo, args.jobs))
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            print("Interrupted, run the same command again to continue")
+            sys.exit(130)
+        except CrawlError as e:
+            print(e)
+            sys.exit(1)
+        finally:
+            ledger.close()
+            shutil.rmtree(crawler.tmp_dir_path, ignore_errors=True)
+
+    print("{} done, {} failed, {} skipped".format(crawler.counts["done"], crawler.counts["failed"], skipped))
+
+if __name__ == "__main__":
+    main()
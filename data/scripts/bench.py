@@ -0,0 +1,438 @@
+"""
+Micro benchmarks for the hot paths of the evaluation scripts, and a
+suite that times every stage of the pipeline on a generated dataset
+(see bench_suite).
+"""
+from signatures import SignatureMatcher, img_signatures, cat_track
+from util import read_benchmark, as_bool, get_option, ArtifactStore
+
+from urllib.parse import urlparse
+from multiprocessing import Process, Queue
+import json, os, platform, shutil, subprocess, sys, random, resource, tempfile, time, timeit, tracemalloc
+
+def linear_match(signatures, s):
+    """
+    Reference implementation that checks one signature after
+    another, like the if-chain that the matcher replaced.
+    """
+    for pattern, cat, detail in signatures:
+        if pattern in s:
+            return ( cat, detail )
+
+    return None
+
+def bench_signatures():
+    """
+    Compares the time it takes to match a single image source
+    against a growing number of signatures, with the automaton and
+    with what the matcher picks for that many (see
+    automaton_threshold in signatures.py).
+    """
+    # Mix of sources that hit early, late and not at all.
+    srcs = [
+        "https://b.scorecardresearch.com/p?c1=2&c2=6035250&cv=2.0&cj=1",
+        "https://www.facebook.com/tr?id=1234567890&ev=PageView&noscript=1",
+        "https://mc.yandex.ru/watch/12345678",
+        "https://pixel.spotify.com/v1/pixel?pixel_id=abcdef",
+        "https://www.example.com/wp-content/uploads/2020/07/header-image.jpg",
+        "https://www.example.com/images/2020/07/some-image-name-here.png?w=100&h=200",
+    ]
+
+    print("{:>10} {:>14} {:>16} {:>14}".format("signatures", "linear (us)", "automaton (us)", "matcher (us)"))
+
+    for n in [ 50, 100, 200, 500, 1000, 2000 ]:
+        signatures = list(img_signatures)
+
+        # Pad the list with made up trackers that never match.
+        while len(signatures) < n:
+            i = len(signatures)
+            signatures.append(( "px{}.tracker{}.net/collect".format(i, i), cat_track, "tracker_{}".format(i) ))
+
+        signatures = signatures[:n]
+        automaton = SignatureMatcher(signatures, threshold=0)
+        matcher = SignatureMatcher(signatures)
+
+        # All approaches have to agree before timing them.
+        for s in srcs:
+            assert automaton.match(s) == matcher.match(s) == linear_match(signatures, s)
+
+        number = 2000
+        t_linear = timeit.timeit(lambda: [ linear_match(signatures, s) for s in srcs ], number=number)
+        t_automaton = timeit.timeit(lambda: [ automaton.match(s) for s in srcs ], number=number)
+        t_matcher = timeit.timeit(lambda: [ matcher.match(s) for s in srcs ], number=number)
+
+        # Time per tag in microseconds.
+        per_tag = number * len(srcs) / 1e6
+
+        print("{:>10} {:>14.2f} {:>16.2f} {:>14.2f}".format(n, t_linear / per_tag, t_automaton / per_tag, t_matcher / per_tag))
+
+def parse_csv_line(line):
+    """
+    Reference implementation of the CSV parser that read_benchmark
+    replaced. Splits on every comma and strips quotes.
+    """
+    parsed_line = []
+
+    for x in line.split(","):
+        if x[0] == "\"" and x[-1] == "\"":
+            x = x[1:-1]
+        
+        parsed_line.append(x.strip())
+    
+    return parsed_line
+
+def split_benchmark(f):
+    """
+    Reads the main table with parse_csv_line and converts the
+    values the same way read_benchmark does.
+    """
+    # Skip CSV header.
+    next(f)
+
+    for line in f:
+        row = parse_csv_line(line)
+        yield row[0], int(row[1]), as_bool(row[2]), int(row[3]), as_bool(row[4]), row[5], \
+            [ float(x) for x in row[6:11] ], [ float(x) for x in row[11:16] ], [ float(x) for x in row[16:21] ]
+
+def write_benchmark(path, rows):
+    """
+    Writes a main table with the given amount of made up rows.
+    """
+    with open(path, "w") as f:
+        header = [ "url", "timestamp", "jsEnabled", "scriptCount", "noscript", "dataFileName" ]
+
+        for h in [ "load", "domload", "idle" ]:
+            header.extend([ "{}{}".format(h, i + 1) for i in range(5) ])
+
+        f.write(",".join([ "\"{}\"".format(x) for x in header ]) + "\n")
+
+        for i in range(rows):
+            js = i % 2 == 0
+            row = [ "\"https://www.site{}.com/\"".format(i // 2), str(1593700000000 + i), "true" if js else "false",
+                str(random.randint(0, 50)), "true" if random.random() < 0.6 else "false",
+                "\"www_site{}.com_{}js_{}\"".format(i // 2, "" if js else "no", 1593700000000 + i) ]
+            row.extend([ str(random.uniform(100, 20000)) for _ in range(15) ])
+
+            f.write(",".join(row) + "\n")
+
+def bench_csv():
+    """
+    Compares the time it takes to read the main table with
+    read_benchmark and with the old per-line split. Pass the path
+    to a benchmark.csv to use it instead of a generated one.
+    """
+    path = sys.argv[2] if len(sys.argv) > 2 else None
+    tmp_dir = None
+
+    if path is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(tmp_dir.name, "benchmark.csv")
+        write_benchmark(path, 200000)
+
+    for name, reader in [ ( "split", split_benchmark ), ( "read_benchmark", read_benchmark ) ]:
+        with open(path, "r") as f:
+            t = time.perf_counter()
+            rows = sum(1 for _ in reader(f))
+            t = time.perf_counter() - t
+
+        print("{:>16}: {} rows in {:.3f} s ({:.0f} rows/s)".format(name, rows, t, rows / t))
+
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+
+def make_noscript_file():
+    """
+    Returns the contents of a made up noscript file.
+    """
+    snippets = [
+        "<iframe src=\"https://www.googletagmanager.com/ns.html?id=GTM-{}\" height=\"0\" width=\"0\" style=\"display:none\"></iframe>",
+        "<img height=\"1\" width=\"1\" src=\"https://www.facebook.com/tr?id={}&ev=PageView&noscript=1\">",
+        "<div><img src=\"https://mc.yandex.ru/watch/{}\" style=\"position:absolute; left:-9999px;\" alt=\"\"></div>",
+        "<style>.js-only {{ display: none; }} #id{} {{ color: red; }}</style>",
+        "<p>Please enable JavaScript to view this page ({}).</p>",
+        "<a href=\"/nojs?ref={}\"><img src=\"/static/logo.png\" alt=\"Logo\"></a>",
+    ]
+
+    tags = []
+
+    for _ in range(random.randint(1, 4)):
+        content = "".join([ random.choice(snippets).format(random.randint(0, 10 ** 8)) for _ in range(random.randint(1, 3)) ])
+        tags.append("<noscript>{}</noscript>".format(content))
+
+    return "".join(tags).encode()
+
+def measure_parse(parser, corpus, queue):
+    """
+    Parses and classifies every file in the corpus, one after another
+    like noscr.py does. Reports the time, the peak of the Python heap
+    and the growth of the resident set, which includes the memory that
+    libxml2 uses, along with the results.
+    """
+    # Imported here since noscr needs lxml.html, which bench.py
+    # doesn't need otherwise.
+    from noscr import process_noscript_tags
+
+    url = urlparse("https://www.example.com/")
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    t = time.perf_counter()
+    results = [ process_noscript_tags(parser(data), url) for data in corpus ]
+    t = time.perf_counter() - t
+
+    # Tracing slows down allocations a lot, so it gets its own pass.
+    tracemalloc.start()
+
+    for data in corpus:
+        process_noscript_tags(parser(data), url)
+
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    queue.put(( t, peak, rss, results ))
+
+def bench_parse():
+    """
+    Compares the time and memory it takes to parse and classify
+    noscript files with the full lxml document and with the fast
+    path. Pass the path to an output directory to use its noscript
+    files instead of generated ones.
+    """
+    from noscr import get_noscript_tags
+    from fastparse import parse_noscript_tags
+
+    if len(sys.argv) > 2:
+        store = ArtifactStore(os.path.join(sys.argv[2], "noscript"), ".html")
+        corpus = [ store.read(x) for x in store.names() ]
+    else:
+        corpus = [ make_noscript_file() for _ in range(20000) ]
+
+    print("{} files, {} bytes".format(len(corpus), sum([ len(x) for x in corpus ])))
+    print("{:>10} {:>10} {:>14} {:>14} {:>14}".format("parser", "time (s)", "files/s", "py peak (KB)", "rss (KB)"))
+
+    results = []
+
+    for name, parser in [ ( "lxml", get_noscript_tags ), ( "fast", parse_noscript_tags ) ]:
+        # Every parser gets a fresh process, so memory that the other
+        # one left behind doesn't count.
+        queue = Queue()
+        p = Process(target=measure_parse, args=( parser, corpus, queue ))
+        p.start()
+
+        t, peak, rss, r = queue.get()
+        p.join()
+        results.append(r)
+
+        print("{:>10} {:>10.3f} {:>14.0f} {:>14.0f} {:>14}".format(name, t, len(corpus) / t, peak / 1024, rss))
+
+    # Warnings aren't compared since they are only collected for
+    # reporting.
+    assert results[0] == results[1]
+
+# Stages of the suite in the order they run, by name, with the
+# arguments of the cli.py command that runs them. {dir} stands for
+# the output directory and {blacklist} for the blacklist, empty
+# arguments are left out. Later stages need the files that earlier
+# ones write.
+suite_stages = [
+    ( "generate", [ "generate", "{dir}", "--urls={urls}", "--seed={seed}", "{pack}" ] ),
+    ( "trunc", [ "trunc", "{dir}", "{blacklist}" ] ),
+    ( "clean", [ "clean", "{dir}", "--dry-run" ] ),
+    ( "split", [ "split", "{dir}" ] ),
+    ( "summarize", [ "summarize", "{dir}" ] ),
+    ( "stats", [ "stats", "{dir}" ] ),
+    ( "pipeline", [ "pipeline", "{dir}", "--intermediates" ] ),
+    ( "noscr", [ "noscr", "{dir}", "--structured" ] ),
+    ( "noscr_fast", [ "noscr", "{dir}", "--structured", "--fast" ] ),
+    ( "noscr_dedup", [ "noscr", "{dir}", "--structured", "--dedup" ] ),
+    ( "noscr_fast_dedup", [ "noscr", "{dir}", "--structured", "--fast", "--dedup" ] ),
+    ( "metr", [ "metr", "{dir}" ] ),
+    ( "sketch", [ "sketch", "{dir}" ] ),
+    ( "plot", [ "plot", "{dir}", "all" ] )
+]
+
+def bench_stage():
+    """
+    Runs a cli.py command and writes the peak resident set of this
+    process (or of its worker processes if it's higher) to a file.
+    Only meant to be started by run_stage.
+    """
+    from cli import main
+    from profiling import get_peak_rss
+
+    try:
+        main(sys.argv[3:])
+    finally:
+        with open(sys.argv[2], "w") as f:
+            json.dump({ "peak_rss_kb": max(get_peak_rss(), resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) }, f)
+
+def run_stage(args):
+    """
+    Runs a cli.py command in a new process and returns its exit code,
+    wall time and CPU time in seconds and its peak resident set in KB.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir_path:
+        report_path = os.path.join(tmp_dir_path, "report.json")
+
+        t = time.perf_counter()
+        p = subprocess.Popen([ sys.executable, os.path.abspath(__file__), "stage", report_path ] + args,
+            cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        # wait4 reports the CPU time of that one process only.
+        _, status, usage = os.wait4(p.pid, 0)
+        t = time.perf_counter() - t
+        p.returncode = os.waitstatus_to_exitcode(status)
+
+        rss = 0
+
+        if os.path.exists(report_path):
+            with open(report_path, "r") as f:
+                rss = json.load(f)["peak_rss_kb"]
+
+    return p.returncode, t, usage.ru_utime + usage.ru_stime, rss
+
+def compare_runs(run, baseline, tolerance):
+    """
+    Prints how much slower or faster every stage got compared to an
+    earlier run. Returns the names of the stages that got slower
+    by more than the tolerance (0.1 = 10%).
+    """
+    before = { x["stage"]: x for x in baseline["stages"] }
+    slower = []
+
+    print()
+    print("Compared to {} ({} URLs):".format(baseline["date"], baseline["urls"]))
+
+    # Times of datasets of different sizes can't be compared.
+    if baseline["urls"] != run["urls"]:
+        print("Baseline was run on {} URLs instead of {}, pass --urls={}".format(baseline["urls"], run["urls"], baseline["urls"]))
+        return []
+
+    for x in run["stages"]:
+        if x["stage"] not in before or x["status"] != 0:
+            continue
+
+        ratio = x["wall"] / before[x["stage"]]["wall"]
+        rss_ratio = x["peak_rss_kb"] / before[x["stage"]]["peak_rss_kb"]
+
+        if ratio > 1 + tolerance:
+            slower.append(x["stage"])
+
+        print("{:>16} {:>+9.1f}% time {:>+9.1f}% rss{}".format(x["stage"], (ratio - 1) * 100, (rss_ratio - 1) * 100,
+            "  SLOWER" if ratio > 1 + tolerance else ""))
+
+    return slower
+
+def bench_suite():
+    """
+    Generates a dataset (see generate.py) and runs every stage of the
+    pipeline on it, each in its own process. Records the wall time,
+    the throughput in URLs per second and the peak resident set of
+    every stage.
+
+    Options:
+        --urls=N            size of the dataset, e.g. 1k, 100k or 1M (1k)
+        --seed=N            seed of the generated dataset (1)
+        --pack              generate packs instead of millions of files
+        --dir=path          where to put the dataset, which is kept
+                            (a temporary directory that is removed).
+                            It is replaced if generate runs
+        --stages=a,b,...    only run these stages
+        --repeat=N          run all stages N times and keep the fastest
+                            run of every stage (1)
+        --out=path          save the results as JSON
+        --baseline=path     compare with the results of an earlier run
+                            and fail if a stage got slower
+        --tolerance=x       how much slower is fine (0.1 = 10%)
+    """
+    from generate import parse_count
+
+    urls = parse_count(get_option("urls", "1k"))
+    seed = int(get_option("seed", 1))
+    stages = get_option("stages")
+    out_path = get_option("out")
+    baseline_path = get_option("baseline")
+    tolerance = float(get_option("tolerance", 0.1))
+    repeat = int(get_option("repeat", 1))
+    pack = get_option("pack", False)
+
+    dir_path = get_option("dir")
+    tmp_dir_path = None
+
+    if dir_path is None:
+        tmp_dir_path = tempfile.mkdtemp(prefix="bench_")
+        dir_path = os.path.join(tmp_dir_path, "output")
+
+    blacklist_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "blacklist.txt")
+    selected = [ x for x in suite_stages if stages is None or x[0] in stages.split(",") ]
+
+    run = {
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "urls": urls,
+        "seed": seed,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "repeat": repeat,
+        "pack": pack,
+        "stages": []
+    }
+
+    # Every stage keeps its fastest run, which is the one least
+    # disturbed by whatever else is running on the machine.
+    best = {}
+
+    try:
+        for i in range(repeat):
+            for name, args in selected:
+                # Later stages would skip work that is already done
+                # otherwise, e.g. plots that are up to date.
+                if name == "generate" and os.path.exists(dir_path):
+                    shutil.rmtree(dir_path)
+
+                args = [ x.format(dir=dir_path, blacklist=blacklist_path, urls=urls, seed=seed, pack="--pack" if pack else "") for x in args ]
+                args = [ x for x in args if len(x) > 0 ]
+                status, t, cpu, rss = run_stage(args)
+
+                if name not in best or status != 0 or t < best[name]["wall"]:
+                    best[name] = { "stage": name, "status": status, "wall": t, "cpu": cpu, "urls_per_s": urls / t, "peak_rss_kb": rss }
+    finally:
+        if tmp_dir_path is not None:
+            shutil.rmtree(tmp_dir_path)
+
+    run["stages"] = [ best[name] for name, _ in selected ]
+
+    print("{:>16} {:>10} {:>10} {:>12} {:>14}".format("stage", "time (s)", "cpu (s)", "URLs/s", "peak rss (KB)"))
+
+    for x in run["stages"]:
+        print("{:>16} {:>10.3f} {:>10.3f} {:>12.0f} {:>14}{}".format(x["stage"], x["wall"], x["cpu"], x["urls_per_s"], x["peak_rss_kb"],
+            "" if x["status"] == 0 else "  FAILED ({})".format(x["status"])))
+
+    if out_path is not None:
+        with open(out_path, "w") as f:
+            json.dump(run, f, indent=2)
+
+    failed = [ x["stage"] for x in run["stages"] if x["status"] != 0 ]
+    slower = []
+
+    if baseline_path is not None:
+        with open(baseline_path, "r") as f:
+            slower = compare_runs(run, json.load(f), tolerance)
+
+    if len(failed) > 0 or len(slower) > 0:
+        sys.exit(1)
+
+benchmarks = {
+    "signatures": bench_signatures,
+    "csv": bench_csv,
+    "parse": bench_parse,
+    "suite": bench_suite,
+    "stage": bench_stage
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print("usage: {} <{}> [args...]".format(sys.argv[0], "|".join(benchmarks)))
+        sys.exit(2)
+
+    benchmarks[sys.argv[1]]()
@@ -1,41 +1,63 @@
 """
 Removes redundant files in the subdirectories of the output
 file that don't belong to any row present in the main table.
+Pass --dry-run to only report what would be removed.
 """
-from util import get_paths, parse_csv_line, try_remove
-from util import benchmark_columns as columns
-
-import os
-
-bm_file_path, metrics_dir_path, noscript_dir_path, screenshots_dir_path = get_paths()
-
-# List all subdirectory contents.
-metrics_dir_list = os.listdir(metrics_dir_path)
-noscript_dir_list = os.listdir(noscript_dir_path)
-screenshots_dir_list = os.listdir(screenshots_dir_path)
-
-with open(bm_file_path, "r") as f:
-    # Skip CSV header.
-    next(f)
-
-    # Remove the files from the directory listings that are
-    # referenced in the main table. In the end, the lists will
-    # only contain files that need to be deleted.
-    for line in f:
-        data_file_name = parse_csv_line(line)[columns["dataFileName"]]
-
-        try_remove(metrics_dir_list, data_file_name + ".json")
-        try_remove(noscript_dir_list, data_file_name + ".html")
-        try_remove(screenshots_dir_list, data_file_name + ".png")
-
-# Remove unnecessary metrics files.
-for x in metrics_dir_list:
-    os.remove(os.path.join(metrics_dir_path, x))
-
-# Remove unnecessary noscript files.
-for x in noscript_dir_list:
-    os.remove(os.path.join(noscript_dir_path, x))
-
-# Remove unnecessary screenshots.
-for x in screenshots_dir_list:
-    os.remove(os.path.join(screenshots_dir_path, x))
+from util import get_output_paths, read_benchmark, find_orphans, remove_files
+import profiling
+
+def get_data_file_names(bm_file_path):
+    """
+    Returns the set of the names of all files that are referenced
+    in the main table.
+    """
+    data_file_names = set()
+
+    with open(bm_file_path, "r") as f:
+        for row in read_benchmark(f):
+            data_file_names.add(row.data_file_name)
+
+    return data_file_names
+
+def clean(base_dir_path, dry_run=False):
+    """
+    Removes the files that don't belong to any row of the main table
+    of an output directory, or only reports them if dry_run is set.
+    """
+    bm_file_path, metrics_dir_path, noscript_dir_path, screenshots_dir_path = get_output_paths(base_dir_path)
+    data_file_names = get_data_file_names(bm_file_path)
+
+    for dir_path, ext in [
+        ( metrics_dir_path, ".json" ),
+        ( noscript_dir_path, ".html" ),
+        ( screenshots_dir_path, ".png" )
+    ]:
+        # Everything that isn't referenced in the main table
+        # needs to be deleted.
+        with profiling.stage("scan"):
+            orphans = find_orphans(dir_path, ext, data_file_names)
+            orphan_bytes = sum([ size for _, size in orphans ])
+            profiling.count(files=len(orphans), bytes=orphan_bytes)
+
+        if dry_run:
+            print("{}: {} files to remove ({} bytes)".format(dir_path, len(orphans), orphan_bytes))
+            continue
+
+        removed = 0
+
+        with profiling.stage("remove"):
+            for n in remove_files([ path for path, _ in orphans ]):
+                removed += n
+
+        print("{}: removed {} files ({} bytes)".format(dir_path, removed, orphan_bytes))
+
+def add_arguments(parser):
+    parser.add_argument("outputdir")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be removed")
+
+def run(args, session):
+    clean(args.outputdir, args.dry_run)
+
+if __name__ == "__main__":
+    from cli import run_script
+    run_script("clean")
@@ -0,0 +1,137 @@
+"""
+Runs the scripts as subcommands of a single command, e.g.
+
+    python3 -m cli summarize ../output --incremental
+    python3 -m cli split ../output + summarize ../output + stats ../output
+
+Commands that are separated by a + run one after another in the same
+process. They share a session that keeps the tables and packs that
+were already loaded, so later commands don't have to load them again
+(see util.Session). Pass --help after a command to list its
+arguments. Every command also takes --profile and --cprofile, see
+profiling.py.
+
+Every script still runs on its own as well, e.g. python3 stats.py
+../output does the same as python3 -m cli stats ../output.
+"""
+from util import Session, UsageError
+import profiling
+
+from importlib import import_module
+import argparse, cProfile, sys, time
+
+# Every command is implemented by the script of the same name.
+# Scripts are only imported once they're used, so commands that
+# don't need lxml or matplotlib don't pay for importing them.
+commands = [ "trunc", "clean", "split", "summarize", "stats", "noscr", "metr", "plot", "pipeline", "sketch", "pack", "unpack", "generate", "logparse" ]
+
+# Separates chained commands.
+separator = "+"
+
+def split_commands(argv):
+    """
+    Splits the arguments at every separator. Returns a list of
+    argument lists that each start with the name of a command.
+    """
+    chain = [ [] ]
+
+    for x in argv:
+        if x == separator:
+            chain.append([])
+        else:
+            chain[-1].append(x)
+
+    return chain
+
+def get_parser(name, prog=None):
+    """
+    Returns the module of a command and the argument parser for it.
+    """
+    if name not in commands:
+        raise UsageError("command must be one of: {}".format(", ".join(commands)))
+
+    module = import_module(name)
+    parser = argparse.ArgumentParser(prog=prog or "cli {}".format(name), description=module.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    module.add_arguments(parser)
+
+    # Shared by all commands.
+    parser.add_argument("--profile", nargs="?", const="-", metavar="path",
+        help="report the time and memory of every stage as JSON to stderr, or append it to a file")
+    parser.add_argument("--cprofile", metavar="path", help="dump cProfile stats to a file, see pstats")
+
+    return module, parser
+
+def run(argv, session, prog=None):
+    """
+    Runs a single command given its name and arguments.
+    """
+    module, parser = get_parser(argv[0], prog)
+    args = parser.parse_args(argv[1:])
+
+    if args.profile is None and args.cprofile is None:
+        module.run(args, session)
+        return
+
+    if args.profile is not None:
+        profiling.start()
+
+    cprofile = cProfile.Profile() if args.cprofile is not None else None
+    wall = time.perf_counter()
+    cpu = time.process_time()
+
+    try:
+        if cprofile is not None:
+            cprofile.enable()
+
+        module.run(args, session)
+    finally:
+        if cprofile is not None:
+            cprofile.disable()
+            cprofile.dump_stats(args.cprofile)
+
+        if args.profile is not None:
+            report = profiling.make_report(profiling.stop(), argv[0], argv[1:], time.perf_counter() - wall, time.process_time() - cpu)
+            profiling.write_report(report, args.profile)
+
+def main(argv=None, prog=None):
+    """
+    Runs the commands given on the command line, or in the given list
+    of arguments. The name of the program in usage messages can be
+    changed with prog, which only makes sense for a single command.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+
+    chain = split_commands(argv)
+
+    if any([ len(x) == 0 for x in chain ]):
+        print("usage: python3 -m cli <command> [args...] [+ <command> [args...]]...")
+        print("commands: {}".format(", ".join(commands)))
+        sys.exit(2)
+
+    session = Session()
+
+    try:
+        # Check every command first, so a typo in the last one
+        # doesn't show up after the others are done.
+        for x in chain:
+            get_parser(x[0], prog)[1].parse_args(x[1:])
+
+        for x in chain:
+            run(x, session, prog)
+    except UsageError as e:
+        print(e)
+        sys.exit(2)
+    finally:
+        session.close()
+
+def run_script(name):
+    """
+    Runs a script that was called directly with the arguments it
+    was called with.
+    """
+    main([ name ] + sys.argv[1:], prog=sys.argv[0])
+
+if __name__ == "__main__":
+    main()
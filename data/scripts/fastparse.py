@@ -0,0 +1,197 @@
+"""
+Fast path for reading the noscript tags of a file without building
+a full lxml document. The file goes through the same HTML parser, but
+its events are handled right away and only the content of noscript
+tags is kept, as light elements that offer the few parts of the lxml
+element API that the handlers in noscr.py are using.
+"""
+import lxml.etree
+
+# Elements that can't have any content, so they aren't closed when
+# serializing them.
+void_tags = set([ "area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr" ])
+
+class LightElement:
+
+    __slots__ = [ "tag", "attrib", "text", "tail", "children", "parent" ]
+
+    def __init__(self, tag, attrib, parent):
+        """
+        Creates an element with the given tag name, dictionary of
+        attributes and parent element (or None).
+        """
+        self.tag = tag
+        self.attrib = attrib
+        self.text = None
+        self.tail = None
+        self.children = []
+        self.parent = parent
+
+    def get(self, name, default=None):
+        return self.attrib.get(name, default)
+
+    def findall(self, path):
+        """
+        Returns the child elements. Only "*" is supported.
+        """
+        if path != "*":
+            raise ValueError("Unsupported path: {}".format(path))
+
+        return list(self.children)
+
+    def iter(self):
+        """
+        Yields this element and all of its descendants in document order.
+        """
+        yield self
+
+        for child in self.children:
+            yield from child.iter()
+
+    def getparent(self):
+        return self.parent
+
+    def index(self, child):
+        return self.children.index(child)
+
+    def __getitem__(self, i):
+        return self.children[i]
+
+    def __len__(self):
+        return len(self.children)
+
+    def text_content(self):
+        """
+        Returns the text of this element and all of its descendants.
+        """
+        parts = [ self.text or "" ]
+
+        for child in self.children:
+            parts.append(child.text_content())
+            parts.append(child.tail or "")
+
+        return "".join(parts)
+
+    def markup(self, transform_value=None):
+        """
+        Serializes the element without its tail. Attribute values are
+        passed through transform_value first if it's set.
+        """
+        attribs = []
+
+        for name, value in self.attrib.items():
+            if transform_value is not None:
+                value = transform_value(value)
+
+            attribs.append(" {}=\"{}\"".format(name, value.replace("\"", "&quot;")))
+
+        parts = [ "<", self.tag ] + attribs + [ ">", self.text or "" ]
+
+        if self.tag in void_tags and len(self.children) == 0 and not self.text:
+            return "".join(parts)
+
+        for child in self.children:
+            parts.append(child.markup(transform_value))
+            parts.append(child.tail or "")
+
+        parts.append("</{}>".format(self.tag))
+        return "".join(parts)
+
+class NoscriptTarget:
+
+    def __init__(self):
+        """
+        Parser target that collects the noscript tags that are direct
+        children of the body, like get_noscript_tags in noscr.py.
+        """
+        self.reset()
+
+    def reset(self):
+        """
+        Gets ready for the next document.
+        """
+        self.noscript_tags = []
+
+        # Tag names of the open elements outside of a noscript tag
+        # and the innermost open element inside of one (or None).
+        self.outer = []
+        self.current = None
+
+        # Element whose text or tail the next text belongs to, and
+        # whether it's the tail.
+        self.text_owner = None
+        self.is_tail = False
+
+    def start(self, tag, attrib):
+        if self.current is None:
+            if tag == "noscript" and len(self.outer) > 0 and self.outer[-1] == "body":
+                self.current = LightElement(tag, dict(attrib), None)
+                self.noscript_tags.append(self.current)
+                self.text_owner, self.is_tail = self.current, False
+            else:
+                self.outer.append(tag)
+
+            return
+
+        el = LightElement(tag, dict(attrib), self.current)
+        self.current.children.append(el)
+        self.current = el
+        self.text_owner, self.is_tail = el, False
+
+    def end(self, tag):
+        if self.current is None:
+            self.outer.pop()
+            return
+
+        el = self.current
+        self.current = el.parent
+
+        if self.current is None:
+            self.text_owner = None
+        else:
+            self.text_owner, self.is_tail = el, True
+
+    def data(self, data):
+        if self.text_owner is None:
+            return
+
+        if self.is_tail:
+            self.text_owner.tail = (self.text_owner.tail or "") + data
+        else:
+            self.text_owner.text = (self.text_owner.text or "") + data
+
+    def comment(self, text):
+        # Comments don't count as elements or text.
+        pass
+
+    def close(self):
+        noscript_tags = self.noscript_tags
+        self.reset()
+
+        return noscript_tags
+
+# Setting up a parser takes longer than parsing most noscript files,
+# so the same one is used for all of them.
+target = NoscriptTarget()
+parser = lxml.etree.HTMLParser(target=target)
+
+def parse_noscript_tags(data):
+    """
+    Returns the list of noscript tags that are direct children of
+    the body in the given HTML document as light elements.
+    """
+    global parser
+
+    try:
+        parser.feed(data)
+        return parser.close()
+    except Exception:
+        # The parser still holds the rest of this file, which would end
+        # up in the next one. Close it or start over with a new one.
+        try:
+            parser.close()
+        except Exception:
+            parser = lxml.etree.HTMLParser(target=target)
+
+        target.reset()
+        raise
@@ -0,0 +1,326 @@
+"""
+Generates a synthetic output directory that looks like one written
+by index.js, so the scripts can be tried and benchmarked without the
+real dataset: benchmark.csv with the same header and formatting, a
+metrics file with page.metrics() snapshots for every row, noscript
+files made of the trackers and alternative content that noscr.py knows
+and placeholder screenshots. The first URLs are the ones in pages.txt,
+the rest are made up. The same seed always gives the same directory.
+
+Options:
+    --urls=N            amount of URLs, e.g. 1000, 1k, 100k or 1M (1k)
+    --iterations=N      amount of samples per timing (5)
+    --seed=N            seed of the random generator (1)
+    --pack              write the files into packs right away instead
+                        of single files, see pack.py
+"""
+from util import get_output_paths, get_pack_paths
+from signatures import iframe_signatures, img_signatures
+
+import json, math, os, random, struct, sys, time, zlib
+import profiling
+
+# Header of the main table without the timing columns.
+benchmark_header = [ "url", "timestamp", "jsEnabled", "scriptCount", "noscript", "dataFileName" ]
+
+# Metrics that page.metrics() returns, in the same order.
+metric_keys = [ "Timestamp", "Documents", "Frames", "JSEventListeners", "Nodes", "LayoutCount", "RecalcStyleCount",
+    "LayoutDuration", "RecalcStyleDuration", "ScriptDuration", "TaskDuration", "JSHeapUsedSize", "JSHeapTotalSize" ]
+
+# Share of pages that send noscript tags.
+noscript_share = 0.6
+
+# Made up hostnames are spread across these TLDs.
+tlds = [ "com", "com", "com", "org", "net", "de", "co.uk", "ru", "jp", "io" ]
+
+# Alternative content and other noscript content that isn't about
+# tracking, {} is replaced with a random number.
+other_snippets = [
+    "<p>Please enable JavaScript to use this site.</p>",
+    "<div class=\"noscript-warning\">You need to enable <b>JavaScript</b> to run this app.</div>",
+    "<style>.js-only { display: none; } #banner-{} { display: block; }</style>",
+    "<link rel=\"stylesheet\" href=\"/static/nojs-{}.css\">",
+    "<meta http-equiv=\"refresh\" content=\"0; url=/nojs?ref={}\">",
+    "<img src=\"/static/logo-{}.png\" alt=\"Logo\">",
+    "<img src=\"data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7\" alt=\"\">",
+    "<a href=\"/nojs/{}\"><img src=\"/static/banner.jpg\" alt=\"Banner\"></a>",
+    "<div><img src=\"/img/hero-{}.jpg\" srcset=\"/img/hero-{}@2x.jpg 2x\"></div>",
+    "<video src=\"/media/intro-{}.mp4\"></video>",
+    "<iframe src=\"/embed/{}.html\"></iframe>",
+    ""
+]
+
+def parse_count(x):
+    """
+    Parses an amount with an optional k or M suffix, e.g. 100k.
+    """
+    x = str(x)
+
+    for suffix, factor in [ ( "k", 1000 ), ( "M", 1000000 ) ]:
+        if x.endswith(suffix):
+            return int(float(x[:-1]) * factor)
+
+    return int(x)
+
+def make_png():
+    """
+    Returns a valid PNG with a single white pixel.
+    """
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(b"\x00\xff\xff\xff")) + chunk(b"IEND", b""))
+
+def get_hosts(count, rng):
+    """
+    Yields the given amount of distinct hostnames, starting with the
+    ones in pages.txt.
+    """
+    pages_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pages.txt")
+    seen = set()
+
+    if os.path.exists(pages_path):
+        with open(pages_path, "r") as f:
+            for line in f:
+                host = line.strip()
+
+                if len(host) == 0 or host in seen:
+                    continue
+
+                if len(seen) == count:
+                    return
+
+                seen.add(host)
+                yield host
+
+    for i in range(count - len(seen)):
+        yield "{}site{}.{}".format("www." if rng.random() < 0.5 else "", i, rng.choice(tlds))
+
+def format_csv_row(values):
+    """
+    Formats a row like writeCSVRow in util.js: strings are quoted,
+    everything else is written as it is.
+    """
+    return ",".join([ "\"{}\"".format(x) if isinstance(x, str) else format_value(x) for x in values ]) + "\n"
+
+def format_value(x):
+    if isinstance(x, bool):
+        return "true" if x else "false"
+
+    return str(x)
+
+def make_times(rng, iterations, js_enabled):
+    """
+    Returns the load, DOMContentLoaded and idle times of every
+    iteration in milliseconds. Pages without JS load faster.
+    """
+    base = rng.lognormvariate(math.log(1500), 0.7) * (1 if js_enabled else 0.6)
+    domload = []
+    load = []
+    idle = []
+
+    for _ in range(iterations):
+        d = base * rng.lognormvariate(0, 0.2)
+        l = d + rng.lognormvariate(math.log(base * 0.5), 0.5)
+        i = l + rng.lognormvariate(math.log(500), 0.8)
+
+        domload.append(round(d, 4))
+        load.append(round(l, 4))
+        idle.append(round(i, 4))
+
+    return load, domload, idle
+
+def make_metrics(rng, iterations, js_enabled, start):
+    """
+    Returns the contents of a metrics file: one snapshot before the
+    first iteration and one after every iteration, like index.js
+    takes them.
+    """
+    snapshots = []
+    values = { x: 0 for x in metric_keys }
+    values["Documents"] = rng.randint(1, 8)
+    values["Frames"] = rng.randint(1, 6)
+    values["JSHeapTotalSize"] = rng.choice([ 4, 8, 16, 32 ]) * 1048576
+    values["LayoutDuration"] = values["RecalcStyleDuration"] = values["ScriptDuration"] = values["TaskDuration"] = 0.0
+
+    scale = 1 if js_enabled else 0.1
+
+    for i in range(iterations + 1):
+        values["Timestamp"] = round(start + i * rng.uniform(1, 20), 6)
+        values["JSEventListeners"] = int(rng.randint(0, 2000) * scale)
+        values["Nodes"] = rng.randint(100, 5000)
+        values["LayoutCount"] += rng.randint(1, 20)
+        values["RecalcStyleCount"] += rng.randint(1, 40)
+        values["LayoutDuration"] += rng.uniform(0.005, 0.2)
+        values["RecalcStyleDuration"] += rng.uniform(0.005, 0.1)
+        values["ScriptDuration"] += rng.uniform(0.01, 1.5) * scale
+        values["TaskDuration"] += values["ScriptDuration"] + rng.uniform(0.05, 0.5)
+        values["JSHeapUsedSize"] = int(rng.uniform(0.1, 0.9) * values["JSHeapTotalSize"] * scale) + 1048576
+
+        snapshots.append(dict(values))
+
+    # Same as JSON.stringify, which doesn't add any whitespace.
+    return json.dumps(snapshots, separators=( ",", ":" ))
+
+def make_tracker_url(rng, pattern):
+    """
+    Returns a URL that contains the given signature.
+    """
+    n = rng.randint(1, 10 ** 8)
+
+    if "/" in pattern:
+        return "https://{}?id={}&noscript=1".format(pattern, n)
+
+    return "https://{}/p?id={}".format(pattern, n)
+
+def make_noscript(rng, tracker_ids):
+    """
+    Returns the contents of a noscript file like index.js saves it:
+    the outer HTML of every noscript tag, one per line. Tracker IDs
+    are kept per site, so the same site sends the same snippets.
+    """
+    tags = []
+
+    for _ in range(min(1 + int(rng.expovariate(1.2)), 6)):
+        r = rng.random()
+
+        if r < 0.35:
+            # By far the most common one.
+            content = "<iframe src=\"https://www.googletagmanager.com/ns.html?id=GTM-{}\" height=\"0\" width=\"0\" style=\"display:none;visibility:hidden\"></iframe>".format(tracker_ids[0])
+        elif r < 0.55:
+            content = "<img height=\"1\" width=\"1\" style=\"display:none\" src=\"https://www.facebook.com/tr?id={}&amp;ev=PageView&amp;noscript=1\">".format(tracker_ids[1])
+        elif r < 0.65:
+            pattern, _, _ = rng.choice(iframe_signatures)
+            content = "<iframe src=\"{}\" width=\"1\" height=\"1\" frameborder=\"0\"></iframe>".format(make_tracker_url(rng, pattern))
+        elif r < 0.8:
+            pattern, _, _ = rng.choice(img_signatures)
+            content = "<img src=\"{}\" width=\"1\" height=\"1\" alt=\"\">".format(make_tracker_url(rng, pattern))
+        else:
+            content = rng.choice(other_snippets).replace("{}", str(rng.randint(1, 10 ** 6)))
+
+        tags.append("<noscript>{}</noscript>".format(content))
+
+    return "\n".join(tags)
+
+class ArtifactWriter:
+
+    def __init__(self, dir_path, ext, pack=False):
+        """
+        Writes files with the given extension to a subdirectory of
+        the output directory, or to its pack if pack is set.
+        """
+        self.dir_path = dir_path
+        self.ext = ext
+        self.pack_file = None
+        self.index_lines = []
+
+        os.makedirs(dir_path, exist_ok=True)
+
+        if pack:
+            pack_path, index_path = get_pack_paths(dir_path)
+            self.pack_file = open(pack_path, "wb")
+            self.index_file = open(index_path, "w")
+
+    def write(self, name, data):
+        if self.pack_file is None:
+            with open(os.path.join(self.dir_path, name + self.ext), "wb") as f:
+                f.write(data)
+
+            return
+
+        offset = self.pack_file.tell()
+        self.pack_file.write(data)
+        self.index_lines.append("{} {} {}\n".format(name, offset, len(data)))
+
+    def close(self):
+        if self.pack_file is None:
+            return
+
+        # Same as pack.py, the data goes first.
+        self.pack_file.close()
+        self.index_file.writelines(self.index_lines)
+        self.index_file.close()
+
+def generate(base_dir_path, urls, iterations=5, seed=1, pack=False):
+    """
+    Writes a synthetic output directory with the given amount of URLs,
+    each benchmarked with JS enabled and disabled. Returns the amount
+    of written rows.
+    """
+    rng = random.Random(seed)
+    bm_file_path, metrics_dir_path, noscript_dir_path, screenshots_dir_path = get_output_paths(base_dir_path)
+    os.makedirs(base_dir_path, exist_ok=True)
+
+    metrics_writer = ArtifactWriter(metrics_dir_path, ".json", pack)
+    noscript_writer = ArtifactWriter(noscript_dir_path, ".html", pack)
+    screenshots_writer = ArtifactWriter(screenshots_dir_path, ".png", pack)
+
+    png = make_png()
+    header = benchmark_header + [ "{}{}".format(h, i + 1) for h in [ "load", "domload", "idle" ] for i in range(iterations) ]
+
+    # Date.now() of the first page, 2020-07-02.
+    now = 1593700000000
+    rows = 0
+    start_time = time.perf_counter()
+
+    with profiling.stage("generate"), open(bm_file_path, "w") as f:
+        f.write(format_csv_row(header))
+
+        for i, host in enumerate(get_hosts(urls, rng)):
+            url = "https://{}/".format(host)
+            has_noscript = rng.random() < noscript_share
+            script_count = rng.randint(1, 80) if rng.random() < 0.9 else 0
+            tracker_ids = [ "".join(rng.choice("ABCDEFGHJKLMNPQRSTUVWXYZ23456789") for _ in range(7)), rng.randint(10 ** 14, 10 ** 15) ]
+            noscript = make_noscript(rng, tracker_ids).encode() if has_noscript else None
+
+            # Scripts that are added by other scripts are missing without JS.
+            script_counts = [ script_count, int(script_count * rng.uniform(0.5, 1)) ]
+
+            for js_enabled, page_script_count in zip([ True, False ], script_counts):
+                name = "{}_{}js_{}".format(host.replace(".", "_", 1), "" if js_enabled else "no", now)
+                load, domload, idle = make_times(rng, iterations, js_enabled)
+
+                metrics_writer.write(name, make_metrics(rng, iterations, js_enabled, now / 1000 % 100000).encode())
+                screenshots_writer.write(name, png)
+
+                # Sites mostly send the same noscript tags without JS.
+                if noscript is not None:
+                    noscript_writer.write(name, noscript if js_enabled or rng.random() < 0.9 else make_noscript(rng, tracker_ids).encode())
+
+                # The row is written once all iterations are done.
+                now += int(sum(idle)) + rng.randint(2000, 8000)
+                f.write(format_csv_row([ url, now, js_enabled, page_script_count, has_noscript, name ] + load + domload + idle))
+                rows += 1
+
+            if (i + 1) % 10000 == 0:
+                elapsed = time.perf_counter() - start_time
+                sys.stderr.write("\r{} URLs ({:.0f} URLs/s)".format(i + 1, (i + 1) / elapsed))
+                sys.stderr.flush()
+
+            now += rng.randint(500, 3000)
+
+        profiling.count(rows=rows)
+
+    for writer in [ metrics_writer, noscript_writer, screenshots_writer ]:
+        writer.close()
+
+    if urls >= 10000:
+        sys.stderr.write("\n")
+
+    return rows
+
+def add_arguments(parser):
+    parser.add_argument("outputdir")
+    parser.add_argument("--urls", type=parse_count, default=1000, help="amount of URLs, e.g. 1000, 1k, 100k or 1M")
+    parser.add_argument("--iterations", type=int, default=5, help="amount of samples per timing")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the random generator")
+    parser.add_argument("--pack", action="store_true", help="write the files into packs right away")
+
+def run(args, session):
+    rows = generate(args.outputdir, args.urls, args.iterations, args.seed, args.pack)
+    print("Wrote {} rows to {}".format(rows, get_output_paths(args.outputdir)[0]))
+
+if __name__ == "__main__":
+    from cli import run_script
+    run_script("generate")
@@ -0,0 +1,396 @@
+"""
+Parses the log of a crawl (noscript.log) into a table with a row for
+every run of index.js, e.g. noscript_runs.csv for noscript.log, and
+prints which phases the crawl spent its time in. The log is read
+line by line and every row is written as soon as its run is over, so
+this needs the same memory for a log of any size. Logs compressed
+with gzip can be read as they are.
+
+The time of a run is split into these phases:
+
+    unlogged    before the first and after the last line of the run,
+                mostly starting Node and closing the browser
+    startup     finding and launching the browser
+    load        first visit of the page, noscript tags and scripts
+    screenshot  taking the screenshot
+    iterations  all timed visits of the page
+    save        saving the metrics and opening the next page
+    error       from an error to the next attempt or the end
+
+Phases with JS enabled and disabled add up. The lines of a run need
+the dates that debug adds when it doesn't write to a terminal, which
+is the case when the output goes to a file. Logs written by crawl.py
+work as well, in which case a URL that was tried several times has a
+row for every attempt.
+"""
+from sketch import DDSketch, chunk_size
+import profiling
+
+from collections import Counter
+import calendar, csv, gzip, os, re, time
+
+# Namespace of the debug lines of index.js.
+namespace = " no-noscript "
+
+# Phases in the order they happen in a run.
+phases = [ "unlogged", "startup", "load", "screenshot", "iterations", "save", "error" ]
+
+# Quantiles of the phase durations to print.
+quantiles = [ 0.5, 0.9, 0.99 ]
+
+# Lines that are only written at the start of a run.
+start_messages = ( "Output directory doesn't exist yet", "Creating directory at", "Selected revision", "No revision specified",
+    "URL required", "Invalid URL", "Output directory required" )
+
+# Gaps between runs of run.sh that are longer than this many seconds
+# are counted as pauses of the crawl, not as part of the next run.
+max_gap = 60
+
+# Header that crawl.py writes before the output of every run.
+crawl_header = re.compile(r"^crawl: (\S+) attempt (\d+)/\d+ (.*) in ([\d.]+) s$")
+
+# Seconds since the epoch of the days that were seen so far, and of
+# the minute of the last date.
+day_starts = {}
+last_minute = [ None, 0 ]
+
+def parse_time(stamp):
+    """
+    Returns the seconds since the epoch of a date like the ones that
+    debug writes (2020-07-02T12:34:56.789Z), or None if it isn't one.
+    Way quicker than strptime, which matters for large logs.
+    """
+    if len(stamp) != 24 or stamp[10] != "T" or stamp[23] != "Z":
+        return None
+
+    minute = stamp[:16]
+
+    if minute != last_minute[0]:
+        day = stamp[:10]
+
+        if day not in day_starts:
+            try:
+                day_starts[day] = calendar.timegm(time.strptime(day, "%Y-%m-%d"))
+            except ValueError:
+                return None
+
+        last_minute[0] = minute
+        last_minute[1] = day_starts[day] + int(stamp[11:13]) * 3600 + int(stamp[14:16]) * 60
+
+    return last_minute[1] + float(stamp[17:23])
+
+def format_time(t):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t))
+
+class Run:
+
+    def __init__(self, url=None, crawl_attempt=None, crawl_outcome=None, crawl_seconds=None):
+        """
+        Holds the counters and phase durations of a single run of
+        index.js. The arguments come from the header of crawl.py.
+        """
+        self.url = url
+        self.crawl_attempt = crawl_attempt
+        self.crawl_outcome = crawl_outcome
+        self.crawl_seconds = crawl_seconds
+
+        self.first = None
+        self.last = None
+        self.launched = False
+        self.phase = None
+        self.phase_start = None
+        self.durations = { x: 0.0 for x in phases }
+
+        self.attempts = 0
+        self.errors = 0
+        self.crashed = False
+        self.cache_warnings = 0
+
+        # Saved metrics of the current attempt, one per page.
+        self.saves = 0
+
+    def enter(self, phase, t):
+        """
+        Ends the current phase and starts another one at the given time.
+        """
+        if self.phase is not None:
+            self.durations[self.phase] += t - self.phase_start
+
+        self.phase = phase
+        self.phase_start = t
+
+    def add(self, t, message):
+        if self.first is None:
+            self.first = t
+            self.enter("startup", t)
+
+        self.last = t
+
+        # Most frequent lines first.
+        word, _, rest = message.partition(" ")
+
+        if word == "Iteration":
+            if self.phase != "iterations":
+                self.enter("iterations", t)
+        elif word == "Saving":
+            if rest.startswith("metrics"):
+                self.saves += 1
+                self.enter("save", t)
+            elif rest.startswith("screenshot"):
+                self.enter("screenshot", t)
+        elif word == "Testing":
+            if self.url is None:
+                self.url = rest[:rest.rfind(". (")]
+
+            self.launched = True
+            self.enter("load", t)
+        elif word == "WARNING!":
+            if rest.startswith("Response from cache"):
+                self.cache_warnings += 1
+        elif word == "Attempt":
+            self.attempts += 1
+            self.saves = 0
+            self.launched = True
+        elif word == "Launching":
+            self.launched = True
+        elif word == "Error" and rest.startswith("during benchmark"):
+            self.errors += 1
+            self.enter("error", t)
+        elif word == "Top-level":
+            self.crashed = True
+            self.enter("error", t)
+
+    def finish(self, gap=None):
+        """
+        Ends the last phase. The unlogged time is what crawl.py measured
+        beyond the logged lines, or else the given gap since the run
+        before. Runs of crawl.py without any lines (e.g. when the
+        command couldn't start) only have the time it measured.
+        """
+        if self.first is None:
+            if self.crawl_seconds is not None:
+                self.durations["unlogged" if self.done else "error"] = self.crawl_seconds
+
+            return
+
+        self.enter(None, self.last)
+
+        if self.crawl_seconds is not None:
+            self.durations["unlogged"] = max(self.crawl_seconds - (self.last - self.first), 0.0)
+        elif gap is not None and 0 <= gap <= max_gap:
+            self.durations["unlogged"] = gap
+
+    @property
+    def empty(self):
+        # Runs of crawl.py are kept even if they didn't log anything.
+        return self.first is None and self.crawl_seconds is None
+
+    @property
+    def done(self):
+        if self.crawl_outcome is not None:
+            return self.crawl_outcome == "done"
+
+        # Both pages of the last attempt were saved.
+        return self.saves >= 2 and not self.crashed
+
+    @property
+    def total(self):
+        return sum(self.durations.values())
+
+def parse_log(lines):
+    """
+    Yields a Run for every run of index.js in the lines of a log once
+    its last line was read. Lines of other programs and continued
+    lines of errors are skipped.
+    """
+    run = None
+    last = None
+
+    def finish(run):
+        # Runs of run.sh follow each other, so the gap to the one
+        # before is the unlogged part of a run.
+        run.finish(None if last is None or run.first is None else run.first - last)
+        return run
+
+    for line in lines:
+        if line.startswith("crawl: "):
+            match = crawl_header.match(line.rstrip("\n"))
+
+            if match is not None:
+                if run is not None and not run.empty:
+                    yield finish(run)
+                    last = run.last
+
+                url, attempt, outcome, seconds = match.groups()
+                run = Run(url, int(attempt), outcome, float(seconds))
+                continue
+
+        stamp, _, message = line.partition(namespace)
+
+        # Lines of the measured times are indented and don't change
+        # the phase, so they're skipped early.
+        if len(message) == 0 or message[0] == " ":
+            continue
+
+        t = parse_time(stamp)
+
+        if t is None:
+            continue
+
+        message = message.rstrip("\n")
+
+        # Every run of run.sh begins with the same lines.
+        if run is None or (run.launched and message.startswith(start_messages)):
+            if run is not None and not run.empty:
+                yield finish(run)
+                last = run.last
+
+            run = Run()
+
+        run.add(t, message)
+
+    if run is not None and not run.empty:
+        yield finish(run)
+
+def format_run(run):
+    return [ run.url or "", "" if run.first is None else format_time(run.first), run.crawl_attempt or "", run.attempts, run.errors, run.cache_warnings,
+        "done" if run.done else "failed", "{:.3f}".format(run.total) ] + [ "{:.3f}".format(run.durations[x]) for x in phases ]
+
+class LogSummary:
+
+    def __init__(self, relative_accuracy=0.01):
+        """
+        Adds up the runs of a log. The durations of every phase go
+        into a sketch (see sketch.py) to get their quantiles.
+        """
+        self.runs = 0
+        self.done = 0
+        self.retried = 0
+        self.errors = 0
+        self.cache_warnings = 0
+        self.runs_with_cache_warnings = 0
+        self.failed_seconds = 0.0
+
+        self.first = None
+        self.last = None
+        self.totals = Counter()
+
+        self.sketches = { x: DDSketch(relative_accuracy) for x in phases + [ "total" ] }
+        self.pending = { x: [] for x in self.sketches }
+
+    def add(self, run):
+        self.runs += 1
+        self.done += int(run.done)
+        self.retried += int(run.attempts > 1 or (run.crawl_attempt or 1) > 1)
+        self.errors += run.errors
+        self.cache_warnings += run.cache_warnings
+        self.runs_with_cache_warnings += int(run.cache_warnings > 0)
+
+        total = run.total
+
+        if not run.done:
+            self.failed_seconds += total
+
+        # Runs of crawl.py without lines have no dates.
+        if run.first is not None:
+            self.first = run.first if self.first is None else min(self.first, run.first)
+            self.last = run.last if self.last is None else max(self.last, run.last)
+
+        for x in phases:
+            self.totals[x] += run.durations[x]
+            self.pending[x].append(run.durations[x])
+
+        self.totals["total"] += total
+        self.pending["total"].append(total)
+
+        if len(self.pending["total"]) >= chunk_size:
+            self.flush()
+
+    def flush(self):
+        for name, values in self.pending.items():
+            self.sketches[name].add_many(values)
+            values.clear()
+
+def analyze_log(log_path, out_path, relative_accuracy=0.01):
+    """
+    Writes the table of runs of a log and returns their LogSummary.
+    """
+    summary = LogSummary(relative_accuracy)
+    opener = gzip.open if log_path.endswith(".gz") else open
+
+    with profiling.stage("parse"), opener(log_path, "rt", errors="replace") as f, open(out_path, "w", newline="") as out_file:
+        writer = csv.writer(out_file)
+        writer.writerow([ "url", "start", "crawl_attempt", "attempts", "errors", "cache_warnings", "status", "total" ] + phases)
+
+        for run in parse_log(f):
+            writer.writerow(format_run(run))
+            summary.add(run)
+
+        profiling.count(rows=summary.runs, files=1, bytes=os.path.getsize(log_path))
+
+    summary.flush()
+    return summary
+
+def format_hours(seconds):
+    return "{:.2f} h".format(seconds / 3600)
+
+def print_summary(summary):
+    if summary.runs == 0:
+        print("No runs found")
+        return
+
+    # Only runs of crawl.py without any lines leave no dates behind.
+    wall = 0 if summary.first is None else summary.last - summary.first
+    busy = summary.totals["total"]
+
+    print("Runs: {} ({} done, {} failed, {} retried)".format(summary.runs, summary.done, summary.runs - summary.done, summary.retried))
+    print("Errors: {}".format(summary.errors))
+    print("Cache warnings: {} in {} runs".format(summary.cache_warnings, summary.runs_with_cache_warnings))
+    if summary.first is not None:
+        print("Crawl time: {} from {} to {}".format(format_hours(wall), format_time(summary.first), format_time(summary.last)))
+
+    # More time in runs than the crawl took means runs were parallel.
+    if wall > 0:
+        print("Time in runs: {} ({:.2f} at a time), {:.0f} runs per hour".format(format_hours(busy), busy / wall, summary.runs / wall * 3600))
+
+    if busy > 0:
+        print("Time in failed runs: {} ({:.2f} %)".format(format_hours(summary.failed_seconds), summary.failed_seconds / busy * 100))
+
+    print()
+    print("{:<12} {:>10} {:>8} {:>10} ".format("phase", "time", "share", "mean (s)") + " ".join([ "{:>10}".format("p{:g} (s)".format(q * 100)) for q in quantiles ]))
+
+    for name in phases + [ "total" ]:
+        sketch = summary.sketches[name]
+        share = summary.totals[name] / busy * 100 if busy > 0 else 0
+
+        print("{:<12} {:>10} {:>6.2f} % {:>10.2f} ".format(name, format_hours(summary.totals[name]), share, summary.totals[name] / summary.runs) +
+            " ".join([ "{:>10.2f}".format(sketch.quantile(q)) for q in quantiles ]))
+
+    if busy > 0:
+        slowest = max(phases, key=lambda x: summary.totals[x])
+        print()
+        print("Most of the time goes to {} ({:.2f} %)".format(slowest, summary.totals[slowest] / busy * 100))
+
+def add_arguments(parser):
+    parser.add_argument("log", help="log of the crawl, e.g. ../noscript.log (or .log.gz)")
+    parser.add_argument("--out", metavar="path", help="table of runs to write (default: next to the log, e.g. noscript_runs.csv)")
+    parser.add_argument("--accuracy", type=float, default=0.01, help="relative accuracy of the quantiles")
+
+def run(args, session):
+    out_path = args.out
+
+    if out_path is None:
+        base = args.log[:-3] if args.log.endswith(".gz") else args.log
+        out_path = os.path.splitext(base)[0] + "_runs.csv"
+
+    try:
+        summary = analyze_log(args.log, out_path, args.accuracy)
+    except IOError as e:
+        print("File IO error: {}".format(e))
+        return
+
+    print_summary(summary)
+
+if __name__ == "__main__":
+    from cli import run_script
+    run_script("logparse")
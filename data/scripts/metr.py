@@ -1,38 +1,255 @@
 """
-Computes the median script execution time for every
-website (doesn't work).
+Computes the median script execution time (and a few other browser
+metrics) for every website and writes them to benchmark_metrics.csv.
+
+The metrics directory is processed in chunks of files, so memory
+usage doesn't grow with the size of the dataset. Pass --jobs=N to
+spread the chunks across N processes. A manifest of several output
+directories can be passed instead of a single one, see pipeline.py.
 """
-from util import get_paths, parse_csv_line
-from util import benchmark_columns as columns
-
-import os, json
-
-_, metrics_dir_path, _, _ = get_paths()
-metrics_file_names = os.listdir(metrics_dir_path)
-
-for file_name in metrics_file_names:
-    # Skip metrics taken when JS was disabled.
-    if "nojs" in file_name:
-        continue
-
-    file_path = os.path.join(metrics_dir_path, file_name)
-
-    # List to load the JSON array with browser metrics into.
-    metrics = []
-    # List of script execution durations.
-    script_timings = []
-
-    with open(file_path, "r") as f:
-        metrics = json.load(f)
-    
-    # Compute the difference in time between the current and
-    # the previous sample taken.
-    for i in range(1, len(metrics)):
-        t = metrics[i]["ScriptDuration"] - metrics[i - 1]["ScriptDuration"]
-        script_timings.append(t)
-    
-    script_timings.sort()
-    median = script_timings[2] # len will always be 5 so hardcoding this (I know I shouldn't)
-
-    # Beautifully pythonic
-    print("{}:\t {} {}".format(file_name, "{:.2f}".format(median), [ "{:.2f}".format(x) for x in script_timings ]))
\ No newline at end of file
+from util import open_dataset, get_output_paths, append_to_filename, chunked, ArtifactStore
+import profiling
+
+from multiprocessing import Pool
+import re, sys, json, time
+import numpy as np
+
+# Metrics to pull from the snapshots of page.metrics().
+metric_names = [ "ScriptDuration", "TaskDuration", "LayoutDuration", "JSHeapUsedSize" ]
+
+# Metrics that add up over time, so the difference between two
+# snapshots is what happened during an iteration. The others are
+# sampled after every iteration.
+cumulative_metrics = [ "ScriptDuration", "TaskDuration", "LayoutDuration" ]
+
+# Puppeteer writes numbers only and JSON.stringify doesn't add any
+# whitespace, so the values can be picked out without parsing
+# the whole file.
+metric_pattern = re.compile(rb'"(' + "|".join(metric_names).encode() + rb')":(-?[0-9.eE+]+)')
+
+# Header of the output file.
+metrics_header = [ "dataFileName", "iterations" ] + [ "median_" + x for x in metric_names ]
+
+# Stores that the metrics files are read from, one for every
+# shard of the dataset, see open_stores.
+metrics_stores = None
+
+def open_stores(metrics_dir_paths, session=None, profile=False):
+    """
+    Opens the stores of metrics files. Needs to be called once in
+    every process that loads metrics. Stores that are already open
+    in the session are used if one is given. Worker processes pass
+    profile to collect what --profile reports.
+    """
+    global metrics_stores
+
+    if profile:
+        profiling.start(worker=True)
+
+    if session is not None:
+        metrics_stores = [ session.open_store(x, ".json") for x in metrics_dir_paths ]
+    else:
+        metrics_stores = [ ArtifactStore(x, ".json") for x in metrics_dir_paths ]
+
+def load_metrics(data_file):
+    """
+    Loads the snapshots of a metrics file, given as a tuple of the
+    shard index and data file name, into a (snapshots x metrics)
+    array, in the order of metric_names.
+    """
+    shard, data_file_name = data_file
+    data = metrics_stores[shard].read(data_file_name)
+    values = { x: [] for x in metric_names }
+
+    profiling.count(files=1, bytes=len(data))
+
+    for name, value in metric_pattern.findall(data):
+        values[name.decode()].append(float(value))
+
+    # Fall back to parsing everything if the file doesn't look
+    # like what Puppeteer writes.
+    counts = set([ len(x) for x in values.values() ])
+
+    if len(counts) != 1 or 0 in counts:
+        snapshots = json.loads(data)
+        values = { x: [ float(s.get(x, np.nan)) for s in snapshots ] for x in metric_names }
+
+    return np.array([ values[x] for x in metric_names ], dtype=np.float64).T.reshape(-1, len(metric_names))
+
+def stack_metrics(arrays):
+    """
+    Stacks the arrays of several pages into a (pages x snapshots x
+    metrics) array. Pages with fewer snapshots are padded with NaN.
+    """
+    snapshots = max([ len(x) for x in arrays ], default=0)
+    stacked = np.full(( len(arrays), snapshots, len(metric_names) ), np.nan)
+
+    for i, x in enumerate(arrays):
+        stacked[i, :len(x)] = x
+
+    return stacked
+
+def summarize_metrics(stacked):
+    """
+    Computes the median of every metric over all iterations for
+    every page. Returns the amount of iterations and the medians
+    as a (pages x metrics) array.
+    """
+    # The first snapshot is taken before the first iteration.
+    deltas = np.diff(stacked, axis=1)
+    samples = stacked[:, 1:]
+
+    cumulative = np.array([ x in cumulative_metrics for x in metric_names ])
+    per_iteration = np.where(cumulative, deltas, samples)
+
+    iterations = np.count_nonzero(~np.isnan(per_iteration[:, :, 0]), axis=1)
+
+    # Pages without any iterations would only produce warnings.
+    medians = np.full(( len(stacked), len(metric_names) ), np.nan)
+    has_iterations = iterations > 0
+    medians[has_iterations] = np.nanmedian(per_iteration[has_iterations], axis=1)
+
+    return iterations, medians
+
+def new_aggregates():
+    """
+    Returns empty aggregates of the per-page medians: amount of
+    pages, sum, minimum and maximum for every metric.
+    """
+    n = len(metric_names)
+    return { "count": np.zeros(n, dtype=np.int64), "sum": np.zeros(n), "min": np.full(n, np.inf), "max": np.full(n, -np.inf) }
+
+def aggregate_medians(medians):
+    """
+    Computes the aggregates of a (pages x metrics) array of medians.
+    """
+    aggregates = new_aggregates()
+    valid = ~np.isnan(medians)
+
+    aggregates["count"] += np.count_nonzero(valid, axis=0)
+    aggregates["sum"] += np.nansum(medians, axis=0)
+
+    if len(medians) > 0:
+        aggregates["min"] = np.fmin(aggregates["min"], np.nanmin(np.where(valid, medians, np.inf), axis=0))
+        aggregates["max"] = np.fmax(aggregates["max"], np.nanmax(np.where(valid, medians, -np.inf), axis=0))
+
+    return aggregates
+
+def merge_aggregates(a, b):
+    """
+    Merges two aggregates into the first one.
+    """
+    a["count"] += b["count"]
+    a["sum"] += b["sum"]
+    a["min"] = np.minimum(a["min"], b["min"])
+    a["max"] = np.maximum(a["max"], b["max"])
+
+def process_chunk(data_files):
+    """
+    Processes a chunk of metrics files, see load_metrics. Returns the
+    lines for the output file, the amount of processed files, the
+    aggregates of the chunk and what a worker process collected for
+    --profile, which are all small enough to send back from a worker
+    process.
+    """
+    with profiling.stage("load"):
+        stacked = stack_metrics([ load_metrics(x) for x in data_files ])
+
+    with profiling.stage("summarize"):
+        iterations, medians = summarize_metrics(stacked)
+        profiling.count(rows=len(data_files))
+
+    names = [ name for _, name in data_files ]
+
+    return format_metrics_rows(names, iterations, medians), len(data_files), aggregate_medians(medians), profiling.take()
+
+def format_metrics_rows(names, iterations, medians):
+    """
+    Formats the summarized metrics of several pages as lines
+    of the output file.
+    """
+    lines = []
+
+    for name, n, row in zip(names, iterations.tolist(), medians.tolist()):
+        lines.append(",".join([ "\"{}\"".format(name), str(n) ] + [ str(x) for x in row ]) + "\n")
+
+    return lines
+
+def list_metrics_files(stores):
+    """
+    Yields (shard index, data file name) tuples for all metrics files
+    taken with JS enabled.
+    """
+    for shard, store in enumerate(stores):
+        for name in store.names():
+            # Skip metrics taken when JS was disabled.
+            if "nojs" not in name:
+                yield shard, name
+
+def write_metrics(metrics_dir_paths, out_file_path, jobs=1, chunk_size=1000, session=None):
+    """
+    Writes the summarized metrics of every page to the output file.
+    Chunks of files are spread across the given amount of processes.
+    Returns the amount of pages and their aggregates, see new_aggregates.
+    """
+    open_stores(metrics_dir_paths, session)
+
+    chunks = chunked(list_metrics_files(metrics_stores), chunk_size)
+    pool = None
+
+    if jobs > 1:
+        pool = Pool(jobs, initializer=open_stores, initargs=( metrics_dir_paths, None, profiling.active is not None ))
+        chunk_results = pool.imap(process_chunk, chunks)
+    else:
+        chunk_results = map(process_chunk, chunks)
+
+    aggregates = new_aggregates()
+    files = 0
+    start_time = time.perf_counter()
+
+    with open(out_file_path, "w") as f:
+        f.write(",".join(metrics_header) + "\n")
+
+        for lines, n, chunk_aggregates, profile in chunk_results:
+            profiling.merge(profile)
+
+            with profiling.stage("write"):
+                f.writelines(lines)
+                merge_aggregates(aggregates, chunk_aggregates)
+                profiling.count(rows=len(lines))
+
+            files += n
+            elapsed = time.perf_counter() - start_time
+
+            sys.stderr.write("\r{} files ({:.0f} files/s)".format(files, files / elapsed if elapsed > 0 else 0))
+            sys.stderr.flush()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    sys.stderr.write("\n")
+    return files, aggregates
+
+def add_arguments(parser):
+    parser.add_argument("dataset", help="output directory or manifest")
+    parser.add_argument("--jobs", type=int, default=1, help="amount of worker processes")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="amount of files per chunk")
+
+def run(args, session):
+    bm_file_path, shards = open_dataset(args.dataset)
+    metrics_dir_paths = [ get_output_paths(x)[1] for x in shards ]
+    out_file_path = append_to_filename(bm_file_path, "_metrics")
+
+    files, aggregates = write_metrics(metrics_dir_paths, out_file_path, args.jobs, args.chunk_size, session)
+    print("Wrote metrics of {} pages to {}".format(files, out_file_path))
+
+    for i, name in enumerate(metric_names):
+        count = aggregates["count"][i]
+
+        if count > 0:
+            print("{}: mean {:.4f}, min {:.4f}, max {:.4f}".format(name, aggregates["sum"][i] / count, aggregates["min"][i], aggregates["max"][i]))
+
+if __name__ == "__main__":
+    from cli import run_script
+    run_script("metr")
@@ -1,25 +1,69 @@
 """
 Analyzes the uses of the noscript tag.
 """
-from util import get_paths, parse_csv_line, as_bool
-from util import benchmark_columns as columns
+from util import open_dataset, get_output_paths, load_columns, pair_rows, iter_columns, ArtifactStore
+from util import read_shards, duplicate_policies
+from util import append_to_filename, format_url
+from signatures import cat_alt, cat_track, cat_other, iframe_matcher, img_matcher
+from signatures import iframe_signatures, img_signatures
+from results_cache import ResultsCache
+from fastparse import LightElement, parse_noscript_tags
+import profiling
 
 from urllib.parse import urlparse
+from multiprocessing import Pool
+from collections import Counter
+from hashlib import sha1
+import csv
+import io
+import json
 import os
+import re
 import lxml.html
 
-bm_file_path, _, noscript_dir_path, _ = get_paths()
+# Tags that couldn't be recognized on the page that is currently
+# being processed.
+tag_warnings = []
 
-# Category definitions.
-cat_alt = "alternative_content"
-cat_track = "tracking_metrics"
-cat_other = "other"
+# Stores that the noscript files are read from, one for every
+# shard of the dataset, see open_store.
+noscript_stores = None
+
+# Cache of classified files (or None), see open_store.
+results_cache = None
+
+# Bump this whenever the handlers below change in a way that
+# changes their results. Changes to the signatures are picked
+# up by the cache on its own.
+classifier_version = 1
+signature_tables = { "iframe": iframe_signatures, "img": img_signatures }
+
+# Parses the noscript tags of a file, see open_store.
+noscript_parser = None
+
+# Classified snippets by their hash if --dedup is passed, see
+# process_noscript_tags_dedup.
+snippets = None
+
+# Results of whole files by the hashes of their raw and normalized
+# contents if --dedup is passed, so files that were seen before aren't
+# even parsed, see classify_file.
+snippet_files = None
+
+# Absolute URLs with a query in a piece of markup (without their
+# scheme, which lets re look for the slashes first) and the query
+# values in them that look like IDs, which are masked before comparing
+# snippets. They can't contain any of the signatures since all of
+# those contain a dot or a slash.
+url_pattern = re.compile(r"//[^\s\"'<>?]*\?[^\s\"'<>]*")
+id_value_pattern = re.compile(r"=[A-Za-z0-9_-]*[0-9][A-Za-z0-9_-]*(?=[&#]|$)")
 
 def warn_tag(tag, url):
     """
-    Warns about a tag not being recognized properly.
+    Warns about a tag not being recognized properly. Warnings are
+    collected and printed once the whole page has been processed.
     """
-    print("Unrecognized tag for {}: {} {}".format(url.hostname, tag.tag, tag.attrib))
+    tag_warnings.append(tag)
 
 def is_url_relative(url):
     """
@@ -45,21 +89,11 @@ def process_iframe(tag, url):
     iframe_src = tag.get("src")
 
     if iframe_src is not None:
-        # Google Tag Manager
-        if "googletagmanager.com" in iframe_src:
-            return [( cat_track, "google_tag_manager" )]
-        
-        # Google Analytics
-        if "google-analytics.com" in iframe_src:
-            return [( cat_track, "google_analytics" )]
-        
-        # DoubleClick
-        if "fls.doubleclick.net" in iframe_src:
-            return [( cat_track, "doubleclick" )]
-        
-        # TheBrightTag
-        if "thebrighttag.com" in iframe_src:
-            return [( cat_track, "the_bright_tag" )]
+        # Known trackers
+        r = iframe_matcher.match(iframe_src)
+
+        if r is not None:
+            return [r]
         
         # Relative framed content
         if is_url_relative(iframe_src):
@@ -193,192 +227,16 @@ def process_img(tag, url):
     img_src = tag.get("src")
 
     if img_src is not None:
-        # Scorecard
-        if "b.scorecardresearch.com" in img_src:
-            return [( cat_track, "scorecard_research" )]
-        
-        # Facebook
-        if "facebook.com/tr" in img_src:
-            return [( cat_track, "facebook" )]
-        
-        # Pinterest
-        if "ct.pinterest.com" in img_src:
-            return [( cat_track, "pinterest" )]
-        
-        # IMR Worldwide
-        if "imrworldwide.com" in img_src:
-            return [( cat_track, "imr_worldwide" )]
-        
-        # Google Ad Conversion
-        if "googleadservices.com/pagead/conversion" in img_src:
-            return [( cat_track, "google_ad_conversion" )]
-        
-        # LinkedIn
-        if "ads.linkedin.com/collect" in img_src:
-            return [( cat_track, "linkedin" )]
-        
-        # Microsoft
-        if "web.vortex.data.microsoft.com" in img_src:
-            return [( cat_track, "microsoft" )]
-        
-        # TNS Counter
-        if "tns-counter.ru" in img_src:
-            return [( cat_track, "tns_counter" )]
-        
-        # Quantcast
-        if "pixel.quantserve.com" in img_src:
-            return [( cat_track, "quantcast" )]
-        
-        # Twitter
-        if "analytics.twitter.com" in img_src or "t.co/i/adsct" in img_src:
-            return [( cat_track, "twitter" )]
-        
-        # ABC.ES
-        if "rrss.abc.es/pixel" in img_src:
-            return [( cat_track, "abc_es" )]
-        
-        # AdForm
-        if "adform.net/Serving/TrackPoint" in img_src:
-            return [( cat_track, "adform" )]
-        
-        # Bing Conversion
-        if "bat.bing.com" in img_src:
-            return [( cat_track, "bing" )]
-        
-        # DoubleClick
-        if "doubleclick.net/pagead" in img_src or "ad.doubleclick.net" in img_src:
-            return [( cat_track, "doubleclick" )]
-        
-        # Google Analytics
-        if "google-analytics.com" in img_src:
-            return [( cat_track, "google_analytics" )]
-        
-        # Quora
-        if "quora.com/_/ad" in img_src:
-            return [( cat_track, "quora" )]
-        
-        # Amazon
-        if "fls-na.amazon.com" in img_src:
-            return [( cat_track, "amazon" )]
-        
-        # BBC
-        if "ssc.api.bbc.com" in img_src or "api.bbc.co.uk" in img_src:
-            return [( cat_track, "bbc" )]
-        
-        # EFF
-        if "anon-stats.eff.org" in img_src:
-            return [( cat_track, "eff" )]
-        
-        # Taboola
-        if "trc.taboola.com" in img_src:
-            return [( cat_track, "taboola" )]
-        
-        # Wordpress
-        if "pixel.wp.com" in img_src:
-            return [( cat_track, "wordpreess" )]
-        
-        # Bizographics
-        if "bizographics.com/collect" in img_src:
-            return [( cat_track, "bizographics" )]
-        
-        # Buzzfeed
-        if "pixiedust.buzzfeed.com" in img_src:
-            return [( cat_track, "buzzfeed" )]
-        
-        # El Mundo
-        if "smetrics.el-mundo.net" in img_src:
-            return [( cat_track, "el_mundo" )]
-        
-        # Ziff Davis
-        if "zdbb.net/l" in img_src:
-            return [( cat_track, "ziff_davis" )]
+        # Known trackers and hosts
+        r = img_matcher.match(img_src)
 
-        # Guardian
-        if "phar.gu-web.net" in img_src:
-            return [( cat_track, "the_guardian" )]
-        
-        # Timeout
-        if "smetrics.timeout.com" in img_src:
-            return [( cat_track, "timeout")]
-        
-        # Amazon Cloudfront
-        if "cloudfront.net/atrk.gif" in img_src:
-            return [( cat_track, "amazon_cloudfront" )]
-        
-        # Rambler
-        if "counter.rambler.ru" in img_src:
-            return [( cat_track, "rambler" )]
-        
-        # Yandex
-        if "mc.yandex.ru" in img_src or "yabs.yandex.ru" in img_src:
-            return [( cat_track, "yandex" )]
-        
-        # Mail.ru
-        if "r3.mail.ru" in img_src or "mail.ru/counter" in img_src:
-           return [( cat_track, "mail_ru" )]
-        
-        # XiTi
-        if "xiti.com" in img_src:
-            return [( cat_track, "xiti" )]
-        
-        # Archive
-        if "analytics.archive.org" in img_src:
-            return [( cat_track, "archive" )]
-        
-        # Financial Times
-        if "ft.com/px.gif" in img_src:
-            return [( cat_track, "financial_times" )]
-        
-        # Adobe Digital Marketing
-        if "omtrdc.net" in img_src:
-            return [( cat_track, "adobe_digital_marketing" )]
-        
-        # Omniture
-        if "2o7.net" in img_src or "2O7.net" in img_src:
-            return [( cat_track, "omniture" )]
-        
-        # Matomo/Piwik
-        if "analytics.ietf.org" in img_src or "athena.iubenda.com/js" in img_src or "piwik.itzbund.de" in img_src:
-            return [( cat_track, "matomo_piwik" )]
-        
-        # Offerlogic
-        if "saffron.760main.com/oll" in img_src:
-            return [( cat_track, "offerlogic" )]
-
-        # Rakuten
-        if "rakuten.112.2O7.net" in img_src:
-            return [( cat_track, "rakuten" )]
-
-        # Alexa
-        if "alexametrics.com/atrk.gif" in img_src:
-            return [( cat_track, "alexa" )]
-        
-        # Spotify
-        if "pixel.spotify.com" in img_src:
-            return [( cat_track, "spotify" )]
+        if r is not None:
+            return [r]
         
         # Relative images
         if is_url_relative(img_src):
             return [( cat_alt, "static_content" )]
         
-        # Lots of hosts
-        if one_of_in([
-            "i.ytimg.com",                      # Youtube thumbnails
-            "s.w-x.co",                         # Wetter.de
-            "googleusercontent.com",            # Google hosted
-            "images.arcpublishing.com",         # The Globe And Mail
-            "cloudfront.net/thumbnails",        # Thumbnail hosted on Cloudfront
-            "wp-content/uploads",               # Wordpress uploads
-            "imageserver/image",                # Times UK
-            "images/thumb",                     # More thumbnails
-            "springernature.com/springer-cms",  # Springer
-            "imagesvc.meredithcorp.io",         # People
-            "cdn.vox-cdn.com",                  # Vox
-            "cdni.rt.com",                      # RT
-            "www.theglobeandmail.com/resizer",  # The Globe And Mail (again)
-        ], img_src):
-            return [( cat_alt, "static_content" )]
-        
         img_src_url = urlparse(img_src)
 
         # Hosted on CDNs
@@ -435,6 +293,10 @@ register_all([ "br", "label" ], process_noop)
 register_all([ "h1", "h2", "h3", "h4", "h5", "h6", "em", "strong", "b", "i", "p", "figcaption", "form" ], process_text)
 register_all([ "p", "td", "span" ], process_container)
 
+# Functions whose calls are counted with --profile, see profiling.py.
+profiled_functions = [ "process_noscript_tags", "process_tag", "process_iframe", "process_style", "process_link", "process_picture",
+    "process_meta", "process_a", "process_video", "process_noop", "process_text", "process_container", "process_div", "process_img" ]
+
 def process_tag(tag, url):
     """
     Processes a tag by passing it to the according
@@ -474,61 +336,472 @@ def process_noscript_tags(noscript_tags, url):
     
     return results
 
-def get_noscript_tags(file_path):
+def mask_ids(url):
+    # No backreferences, so re doesn't have to expand a template.
+    return id_value_pattern.sub("=0", url.group(0))
+
+def mask_urls(markup):
     """
-    Returns a list of parsed noscript tags from the given
-    file path, assuming that the file contains nothing but
-    noscript elements in the document root.
+    Masks the query values that look like IDs in every absolute URL
+    of a piece of markup. Works on raw files as well as on serialized
+    tags, so neither has to be taken apart.
     """
-    return lxml.html.parse(file_path).find("body").findall("noscript")
+    if "?" not in markup:
+        return markup
 
-with open(bm_file_path, "r") as f:
-    # Skip CSV header
-    next(f)
+    return url_pattern.sub(mask_ids, markup)
 
-    results = {}
-    pages_scanned = 0
+def get_snippet_key(tag, url):
+    """
+    Returns the normalized markup of a tag, which is the same for
+    tags that are classified the same way.
+    """
+    if isinstance(tag, LightElement):
+        key = mask_urls(tag.markup())
+    else:
+        key = mask_urls(lxml.html.tostring(tag, with_tail=False, encoding="unicode"))
 
-    for line in f:
-        # Scan line for both JS and no JS.
-        row_js = parse_csv_line(line)
-        row_no_js = parse_csv_line(next(f))
+    # The URL of the page only matters for images with srcset.
+    if "srcset" in key:
+        key = url.netloc + " " + key
 
-        noscript_tags = []
-        url = urlparse(row_js[columns["url"]])
+    return key
 
-        # Check if page with JS enabled sent any noscript tags.
-        if as_bool(row_js[columns["noscript"]]):
-            file_path = os.path.join(noscript_dir_path, row_js[columns["dataFileName"]] + ".html")
-            noscript_tags.extend(get_noscript_tags(file_path))
-        
-        # Check if page with JS disabled sent any noscript tags.
-        if as_bool(row_no_js[columns["noscript"]]):
-            file_path = os.path.join(noscript_dir_path, row_no_js[columns["dataFileName"]] + ".html")
-            noscript_tags.extend(get_noscript_tags(file_path))
+def get_raw_file_key(data, url):
+    """
+    Returns the hash of the contents of a noscript file, which is
+    cheaper than get_file_key but only the same for identical files.
+    """
+    if b"srcset" in data:
+        return sha1(url.netloc.encode() + b" " + data).digest()
+
+    return sha1(data).digest()
+
+def get_file_key(data, url):
+    """
+    Returns the hash of the normalized contents of a noscript file,
+    which is the same for files that are classified the same way,
+    see get_snippet_key.
+    """
+    # Every byte is a character in latin-1, so nothing can go wrong.
+    key = mask_urls(data.decode("latin-1"))
+
+    if "srcset" in key:
+        key = url.netloc + " " + key
+
+    # Prefixed, so it's never mistaken for a key of get_raw_file_key.
+    return sha1(b"masked " + key.encode()).digest()
+
+def get_element_path(root, el):
+    """
+    Returns the list of child indices that lead from an element
+    to one of its descendants.
+    """
+    path = []
+
+    while el is not root:
+        parent = el.getparent()
+        path.append(parent.index(el))
+        el = parent
+
+    return path[::-1]
+
+def get_element(root, path):
+    """
+    Returns the descendant of an element at the given path.
+    """
+    for i in path:
+        root = root[i]
+
+    return root
+
+def process_noscript_tags_dedup(noscript_tags, url, snippet_uses):
+    """
+    Same as process_noscript_tags, but every child of a noscript tag
+    is only classified once per process. Unrecognized tags are kept
+    as paths within the snippet and looked up in every tag that uses
+    it. Appends (hash, markup) tuples for the used snippets to the
+    given list, with markup only set for the first use.
+    Returns the list of results and of unrecognized tags.
+    """
+    results = []
+    warnings = []
+
+    for noscript_tag in noscript_tags:
+        tags = noscript_tag.findall("*")
+
+        if len(tags) == 0:
+            results.append(( cat_other, "empty" ))
+            continue
         
-        if len(noscript_tags) > 0:
-            print("Processing {}".format(url.hostname))
+        for tag in tags:
+            key = get_snippet_key(tag, url)
+            digest = sha1(key.encode()).hexdigest()
+
+            if digest in snippets:
+                r, paths = snippets[digest]
+                snippet_uses.append(( digest, None ))
+            else:
+                del tag_warnings[:]
+                r = process_tag(tag, url)
+
+                if r is None:
+                    warn_tag(tag, url)
+                    r = []
+
+                paths = [ get_element_path(tag, t) for t in tag_warnings ]
+                snippets[digest] = ( r, paths )
+                snippet_uses.append(( digest, key ))
+
+            results.extend(r)
+
+            for path in paths:
+                t = get_element(tag, path)
+                warnings.append(( t.tag, dict(t.attrib) ))
+    
+    return results, warnings
+
+def open_store(noscript_dir_paths, cache_path=None, dedup=False, fast=False, session=None, profile=False):
+    """
+    Opens the stores of noscript files of every shard and the cache
+    of results if a path is given. Needs to be called once in every
+    process that classifies pages. Stores that are already open in
+    the session are used if one is given. Worker processes pass
+    profile to collect what --profile reports.
+    """
+    global noscript_stores, results_cache, snippets, snippet_files, noscript_parser
+
+    if profile:
+        profiling.start(worker=True)
+
+    if session is not None:
+        noscript_stores = [ session.open_store(x, ".html") for x in noscript_dir_paths ]
+    else:
+        noscript_stores = [ ArtifactStore(x, ".html") for x in noscript_dir_paths ]
+
+    noscript_parser = parse_noscript_tags if fast else get_noscript_tags
 
+    # Left over from an earlier run in the same process.
+    if results_cache is not None:
+        results_cache.close()
+
+    results_cache = None if cache_path is None else ResultsCache(cache_path, classifier_version, signature_tables, readonly=True)
+    snippets = {} if dedup else None
+    snippet_files = {} if dedup else None
+
+def get_noscript_tags(data):
+    """
+    Returns a list of parsed noscript tags from the contents of
+    a noscript file, assuming that the file contains nothing but
+    noscript elements in the document root.
+    """
+    return lxml.html.parse(io.BytesIO(data)).find("body").findall("noscript")
+
+def classify_file(data_file, url, cache_updates, snippet_uses):
+    """
+    Classifies the noscript tags of a single file, given as a tuple
+    of the shard index and data file name. Returns the
+    amount of noscript tags, the list of detected (category, detail)
+    tuples and the list of unrecognized tags. Updates for the cache
+    and used snippets are appended to the given lists.
+    """
+    shard, data_file_name = data_file
+
+    with profiling.stage("read"):
+        data = noscript_stores[shard].read(data_file_name)
+        profiling.count(files=1, bytes=len(data))
+
+    key = None
+
+    if results_cache is not None:
+        with profiling.stage("cache"):
+            key = results_cache.get_key(data, url.netloc)
+            cached = results_cache.get(key, data)
+
+        if cached is not None:
+            cache_updates.append(( key, None ))
+
+            tags, r, warnings = cached
+            return tags, [ tuple(x) for x in r ], [ tuple(x) for x in warnings ]
+    
+    if snippet_files is not None:
+        # Most files are either the same as another one or only differ
+        # in IDs, which takes a bit longer to find out.
+        with profiling.stage("dedup"):
+            raw_key = get_raw_file_key(data, url)
+            known = snippet_files.get(raw_key)
+
+            if known is None:
+                file_key = get_file_key(data, url)
+                known = snippet_files.get(file_key)
+
+                if known is not None:
+                    snippet_files[raw_key] = known
+
+        if known is not None:
+            tags, r, digests = known
+            snippet_uses.extend([ ( x, None ) for x in digests ])
+
+            if key is not None:
+                cache_updates.append(( key, ( tags, r, [] ) ))
+
+            return tags, r, []
+
+    with profiling.stage("parse"):
+        noscript_tags = noscript_parser(data)
+        profiling.count(files=1, bytes=len(data))
+
+    with profiling.stage("handlers"):
+        if snippets is not None:
+            first_use = len(snippet_uses)
+            r, warnings = process_noscript_tags_dedup(noscript_tags, url, snippet_uses)
+
+            # Unrecognized tags are reported with their attributes,
+            # so files with them have to be parsed every time.
+            if len(warnings) == 0:
+                known = ( len(noscript_tags), r, [ x for x, _ in snippet_uses[first_use:] ] )
+                snippet_files[raw_key] = known
+                snippet_files[file_key] = known
+        else:
+            del tag_warnings[:]
             r = process_noscript_tags(noscript_tags, url)
-            pages_scanned += 1
-
-            # Only keep unique results
-            r = list(set(r))
-
-            for cat, detail in r:
-                # Check if category exists
-                if cat not in results:
-                    results[cat] = {}
-                
-                # Check if detailed description exists
-                if detail not in results[cat]:
-                    results[cat][detail] = 0
-                
-                results[cat][detail] += 1
+            warnings = [ ( t.tag, dict(t.attrib) ) for t in tag_warnings ]
+
+        profiling.count(rows=len(noscript_tags))
+
+    if key is not None:
+        cache_updates.append(( key, ( len(noscript_tags), r, warnings ) ))
+
+    return len(noscript_tags), r, warnings
+
+def classify_page(page):
+    """
+    Classifies the noscript content of a page. Expects a tuple
+    with the URL and the noscript files that were saved with JS
+    enabled and disabled as (shard index, data file name) tuples
+    (None if there is no file).
+    Returns the URL and hostname of the page, the list of detected
+    (category, detail) tuples, the list of unrecognized tags, the
+    updates for the cache, the used snippets and what a worker process
+    collected for --profile, or None if the page didn't send any
+    noscript tags (only the last item is set then in a worker that
+    collects for --profile).
+    """
+    page_url, js_file, no_js_file = page
+
+    url = urlparse(page_url)
+    tags = 0
+    r = []
+    warnings = []
+    cache_updates = []
+    snippet_uses = []
+
+    # Tags are processed one by one, so classifying the files on
+    # their own gives the same result as classifying them together.
+    for data_file in [ js_file, no_js_file ]:
+        if data_file is not None:
+            file_tags, file_r, file_warnings = classify_file(data_file, url, cache_updates, snippet_uses)
+
+            tags += file_tags
+            r.extend(file_r)
+            warnings.extend(file_warnings)
+    
+    profile = profiling.take()
+
+    if tags == 0:
+        # Workers still have to hand over what they collected.
+        return None if profile is None else ( None, None, None, None, None, None, profile )
+
+    return page_url, url.hostname, r, warnings, cache_updates, snippet_uses, profile
+
+def read_pages(rows):
+    """
+    Pairs the rows with JS enabled and disabled by their URL and
+    yields the tuples expected by classify_page. Expects (shard index,
+    url, timestamp, js_enabled, noscript, data_file_name) tuples.
+    """
+    rows = (( url, timestamp, js_enabled, ( url, noscript, ( shard, data_file_name ) ) )
+        for shard, url, timestamp, js_enabled, noscript, data_file_name in rows)
+
+    # Scan rows for both JS and no JS.
+    for row_js, row_no_js in pair_rows(rows):
+        data_files = []
+
+        # Check if pages with JS enabled and disabled sent
+        # any noscript tags.
+        for _, noscript, data_file in [ row_js, row_no_js ]:
+            data_files.append(data_file if noscript else None)
+        
+        yield row_js[0], data_files[0], data_files[1]
+
+def read_rows(shards, duplicates, loader=load_columns):
+    """
+    Yields the rows of a dataset in the form that read_pages expects.
+    A single output directory is read from its columns, which are
+    loaded with the given function, several are merged with read_shards.
+    """
+    if len(shards) == 1:
+        columns = loader(get_output_paths(shards[0])[0])
+        names = [ "url", "timestamp", "js_enabled", "noscript", "data_file_name" ]
+
+        for x in iter_columns(columns, names):
+            yield ( 0, ) + tuple(x)
+
+        return
     
+    for shard, row in read_shards(shards, duplicates):
+        yield shard, row.url, row.timestamp, row.js_enabled, row.noscript, row.data_file_name
+
+def analyze(bm_file_path, shards, duplicates="all", jobs=1, cache_path=None, cache_size=100000, dedup=False, fast=False, structured=False, session=None):
+    """
+    Classifies the noscript tags of every page of a dataset, see
+    open_dataset. The options are the same as on the command line.
+    Prints the unrecognized tags of every page or writes them to files
+    along with the results of every page if structured is set.
+    Returns a dictionary with the amount of pages per category and
+    detail ("results") and counters of the run.
+    """
+    noscript_dir_paths = [ get_output_paths(x)[2] for x in shards ]
+    pool = None
+    cache = None
+
+    rows_file = None
+    tag_counts = Counter()
+    tag_urls = {}
+
+    if structured:
+        rows_file = open(append_to_filename(bm_file_path, "_noscript"), "w")
+        rows_file.write("url,category,detail,count\n")
+
+    if cache_path is not None:
+        # Opened for writing before the workers open it, so changes
+        # to the signatures are recorded first.
+        cache = ResultsCache(cache_path, classifier_version, signature_tables)
+
+    pages = read_pages(read_rows(shards, duplicates, load_columns if session is None else session.load_columns))
+
+    if jobs > 1:
+        # Pages are handed out in chunks and imap returns them in
+        # order, so the output is the same as in a serial run.
+        pool = Pool(jobs, initializer=open_store, initargs=( noscript_dir_paths, cache_path, dedup, fast, None, profiling.active is not None ))
+        page_results = pool.imap(classify_page, pages, chunksize=32)
+    else:
+        open_store(noscript_dir_paths, cache_path, dedup, fast, session)
+        page_results = map(classify_page, pages)
+
+    results = {}
+    pages_scanned = 0
+    cache_hits = 0
+    cache_misses = 0
+    evicted = 0
+    snippet_counts = Counter()
+    snippet_markup = {}
+
+    # Pages are read and classified while looping over the results,
+    # so this covers all of it.
+    try:
+        with profiling.stage("classify"):
+            for page_result in page_results:
+                if page_result is None:
+                    continue
+        
+                page_url, hostname, r, warnings, cache_updates, snippet_uses, profile = page_result
+                profiling.merge(profile)
+
+                if page_url is None:
+                    continue
+
+                profiling.count(rows=1)
+
+                for digest, markup in snippet_uses:
+                    snippet_counts[digest] += 1
+
+                    if markup is not None and digest not in snippet_markup:
+                        snippet_markup[digest] = markup
+
+                if cache is not None:
+                    cache.update(cache_updates)
+
+                    hits = sum([ 1 for _, value in cache_updates if value is None ])
+                    cache_hits += hits
+                    cache_misses += len(cache_updates) - hits
+
+                if structured:
+                    for ( cat, detail ), count in Counter(r).items():
+                        rows_file.write("{},{},{},{}\n".format(format_url(page_url), cat, detail, count))
+
+                    # Same tags are only reported once, along with the first
+                    # page they showed up on.
+                    for tag, attrib in warnings:
+                        key = ( tag, json.dumps(attrib, sort_keys=True) )
+                        tag_counts[key] += 1
+
+                        if key not in tag_urls:
+                            tag_urls[key] = page_url
+                else:
+                    print("Processing {}".format(hostname))
+
+                    for tag, attrib in warnings:
+                        print("Unrecognized tag for {}: {} {}".format(hostname, tag, attrib))
+
+                pages_scanned += 1
+
+                # Only keep unique results
+                r = list(set(r))
+
+                for cat, detail in r:
+                    # Check if category exists
+                    if cat not in results:
+                        results[cat] = {}
+            
+                    # Check if detailed description exists
+                    if detail not in results[cat]:
+                        results[cat][detail] = 0
+            
+                    results[cat][detail] += 1
+    finally:
+        # Keep what was classified so far if the run stops early.
+        if cache is not None:
+            cache.commit()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if structured:
+        rows_file.close()
+
+        with open(append_to_filename(bm_file_path, "_noscript_tags"), "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow([ "tag", "attributes", "count", "url" ])
+
+            for ( tag, attrib ), count in tag_counts.most_common():
+                writer.writerow([ tag, attrib, count, tag_urls[( tag, attrib )] ])
+
+    if cache is not None:
+        with profiling.stage("cache"):
+            evicted = cache.evict(cache_size)
+            cache.close()
+
+    return {
+        "results": results,
+        "pages": pages_scanned,
+        "cache_hits": cache_hits,
+        "cache_misses": cache_misses,
+        "evicted": evicted,
+        "snippet_counts": snippet_counts,
+        "snippet_markup": snippet_markup
+    }
+
+def print_summary(summary, cache=False, dedup=False, top=10):
+    """
+    Prints the results returned by analyze and the counters of the
+    cache and the most common snippets if they were used.
+    """
+    results = summary["results"]
+
     print()
-    print("Pages scanned: {}".format(pages_scanned))
+    print("Pages scanned: {}".format(summary["pages"]))
     print("Results:")
 
     for cat in results:
@@ -537,4 +810,45 @@ with open(bm_file_path, "r") as f:
         details = sorted(results[cat].items(), key=lambda x: x[1], reverse=True)
 
         for d in details:
-            print("\t\t{} ({})".format(d[0], d[1]))
\ No newline at end of file
+            print("\t\t{} ({})".format(d[0], d[1]))
+    
+    if cache:
+        print("Cache: {} hits, {} misses, {} evicted".format(summary["cache_hits"], summary["cache_misses"], summary["evicted"]))
+
+    if dedup:
+        snippet_counts = summary["snippet_counts"]
+        uses = sum(snippet_counts.values())
+        unique = len(snippet_counts)
+
+        print()
+        print("Snippets: {} uses, {} unique ({:.1f} uses per snippet)".format(uses, unique, uses / unique if unique > 0 else 0))
+        print("Top snippets:")
+
+        for digest, count in snippet_counts.most_common(top):
+            print("\t{} ({:.1f}%) {}".format(count, 100 * count / uses, " ".join(summary["snippet_markup"][digest].split())[:120]))
+
+def add_arguments(parser):
+    parser.add_argument("dataset", help="output directory or manifest")
+    parser.add_argument("--jobs", type=int, default=1, help="amount of worker processes")
+    parser.add_argument("--cache", nargs="?", const=True, metavar="path", help="keep the results of classified files (in noscr_cache.sqlite)")
+    parser.add_argument("--cache-size", type=int, default=100000, help="amount of cache entries to keep")
+    parser.add_argument("--dedup", action="store_true", help="classify identical snippets only once and report the most common ones")
+    parser.add_argument("--top", type=int, default=10, help="amount of snippets to report")
+    parser.add_argument("--fast", action="store_true", help="skip building a document for every file")
+    parser.add_argument("--structured", action="store_true", help="write the results of every page and the unrecognized tags to files")
+    parser.add_argument("--duplicates", choices=duplicate_policies, default="all", help="what to do with URLs that are in several shards")
+
+def run(args, session):
+    bm_file_path, shards = open_dataset(args.dataset)
+    cache_path = args.cache
+
+    if cache_path is True:
+        cache_path = os.path.join(os.path.dirname(bm_file_path), "noscr_cache.sqlite")
+
+    summary = analyze(bm_file_path, shards, args.duplicates, args.jobs, cache_path, args.cache_size,
+        args.dedup, args.fast, args.structured, session)
+    print_summary(summary, cache_path is not None, args.dedup, args.top)
+
+if __name__ == "__main__":
+    from cli import run_script
+    run_script("noscr")
@@ -0,0 +1,83 @@
+"""
+Packs the files in the subdirectories of the output directory into
+a single data file per subdirectory, along with an index that holds
+the offset and length of every file by its data file name, e.g.
+noscript.pack and noscript.idx for the noscript directory.
+
+Packs are append-only. Running the script again only adds files
+that aren't in the pack yet. Pass --remove to delete the files from
+the subdirectories once they're packed. unpack.py restores them.
+"""
+from util import get_output_paths, get_pack_paths, read_pack_index, remove_files
+
+import os
+
+def pack(base_dir_path, remove=False):
+    """
+    Adds the files of the subdirectories of an output directory that
+    aren't packed yet to their packs. With remove set, the files are
+    deleted from the subdirectories once they're packed.
+    """
+    _, metrics_dir_path, noscript_dir_path, screenshots_dir_path = get_output_paths(base_dir_path)
+
+    for dir_path, ext in [
+        ( metrics_dir_path, ".json" ),
+        ( noscript_dir_path, ".html" ),
+        ( screenshots_dir_path, ".png" )
+    ]:
+        pack_path, index_path = get_pack_paths(dir_path)
+        index = read_pack_index(index_path) if os.path.exists(index_path) else {}
+
+        packed = []
+        entries = []
+        packed_bytes = 0
+
+        with open(pack_path, "ab") as data_file:
+            offset = data_file.tell()
+
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    name, entry_ext = os.path.splitext(entry.name)
+
+                    if entry_ext != ext:
+                        continue
+
+                    packed.append(entry.path)
+
+                    # Already packed by a previous run.
+                    if name in index:
+                        continue
+
+                    with open(entry.path, "rb") as f:
+                        data = f.read()
+
+                    data_file.write(data)
+                    entries.append("{} {} {}\n".format(name, offset, len(data)))
+
+                    offset += len(data)
+                    packed_bytes += len(data)
+
+            # The index must never point past the end of the data, so the
+            # data has to be on disk before the index is written.
+            data_file.flush()
+            os.fsync(data_file.fileno())
+
+        with open(index_path, "a") as f:
+            f.writelines(entries)
+
+        print("{}: packed {} files ({} bytes)".format(dir_path, len(entries), packed_bytes))
+
+        if remove:
+            removed = sum(remove_files(packed))
+            print("{}: removed {} files".format(dir_path, removed))
+
+def add_arguments(parser):
+    parser.add_argument("outputdir")
+    parser.add_argument("--remove", action="store_true", help="delete the packed files")
+
+def run(args, session):
+    pack(args.outputdir, args.remove)
+
+if __name__ == "__main__":
+    from cli import run_script
+    run_script("pack")
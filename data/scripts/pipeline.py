@@ -0,0 +1,176 @@
+"""
+Runs trunc.py, clean.py, split.py and summarize.py in a single
+pass over the main table. Every step is a generator stage that rows
+flow through, so the main table is only read once and intermediate
+files are only written if they're asked for.
+
+Instead of an output directory, a manifest that lists several of them
+can be passed. They are read as one dataset and the output files are
+named after the manifest. The main tables of the shards are left alone.
+
+Options:
+    --blacklist=path    remove blacklisted URLs from the main table
+    --clean             remove files that don't belong to any row
+    --dry-run           only report what --clean would remove
+    --intermediates     also write the split tables (_js and _no_js)
+    --duplicates=x      what to do with URLs that are in several shards
+                        (all, first, latest or error)
+"""
+from util import open_dataset, get_output_paths, read_benchmark, read_shards, append_to_filename
+from util import find_orphans, remove_files, duplicate_policies, Blacklist
+from util import results_header, summarize_rows, format_results_row, pair_rows
+
+import os
+import profiling
+
+# Rows flow through the stages as (shard index, row) tuples.
+
+def filter_blacklist(rows, blacklist, out_file):
+    """
+    Drops rows that belong to a blacklisted URL and writes the
+    remaining ones to the given file (if there is one).
+    """
+    for shard, row in rows:
+        if row.url in blacklist:
+            continue
+
+        if out_file is not None:
+            out_file.write(row.line)
+
+        yield shard, row
+
+def collect_names(rows, data_file_names):
+    """
+    Adds the data file name of every row to the set of its shard
+    in the given list.
+    """
+    for shard, row in rows:
+        data_file_names[shard].add(row.data_file_name)
+        yield shard, row
+
+def split_rows(rows, js_file, no_js_file):
+    """
+    Writes rows to the table with JS enabled or disabled
+    depending on the jsEnabled column.
+    """
+    for shard, row in rows:
+        if row.js_enabled:
+            js_file.write(row.line)
+        else:
+            no_js_file.write(row.line)
+
+        yield shard, row
+
+def pair_by_url(rows):
+    """
+    Pairs rows with JS enabled and disabled by their URL.
+    """
+    return pair_rows(( row.url, row.timestamp, row.js_enabled, row ) for _, row in rows)
+
+def summarize_pairs(pairs, out_file):
+    """
+    Writes the summarized results of every pair of rows.
+    """
+    for js_row, no_js_row in pairs:
+        out_file.write(format_results_row(summarize_rows(js_row, no_js_row)))
+        yield js_row, no_js_row
+
+def run_pipeline(bm_file_path, shards, bl_file_path=None, clean=False, dry_run=False, intermediates=False, duplicates="all"):
+    """
+    Runs all stages over a dataset, see open_dataset, and writes the
+    results file. The options are the same as on the command line.
+    """
+    # Shards are only read, the main table of a single output
+    # directory is truncated in place like trunc.py does.
+    sharded = len(shards) > 1
+
+    # Files that are written to in the process, closed in the end.
+    files = []
+
+    def open_output(suffix, header):
+        f = open(append_to_filename(bm_file_path, suffix), "w")
+        f.write(header)
+        files.append(f)
+
+        return f
+
+    data_file_names = [ set() for _ in shards ]
+    pages = 0
+
+    with open(get_output_paths(shards[0])[0], "r") as f:
+        csv_header = next(f)
+
+    if sharded:
+        rows = read_shards(shards, duplicates)
+    else:
+        bm_file = open(bm_file_path, "r")
+        files.append(bm_file)
+        rows = (( 0, row ) for row in read_benchmark(bm_file))
+
+    if bl_file_path is not None:
+        blacklist = Blacklist(bl_file_path)
+        rows = filter_blacklist(rows, blacklist, None if sharded else open_output("_trunc", csv_header))
+
+    if clean or dry_run:
+        rows = collect_names(rows, data_file_names)
+
+    if intermediates:
+        rows = split_rows(rows, open_output("_js", csv_header), open_output("_no_js", csv_header))
+
+    results_file = open_output("_results", ",".join(results_header) + "\n")
+
+    # Pull all rows through the stages. They are interleaved, so
+    # they are profiled as one.
+    with profiling.stage("pipeline"):
+        for _ in summarize_pairs(pair_by_url(rows), results_file):
+            pages += 1
+
+        profiling.count(rows=pages * 2)
+
+    for out_file in files:
+        out_file.close()
+
+    # Same as trunc.py, keep the original and swap in the truncated table.
+    if bl_file_path is not None and not sharded:
+        os.replace(bm_file_path, append_to_filename(bm_file_path, "_orig"))
+        os.replace(append_to_filename(bm_file_path, "_trunc"), bm_file_path)
+
+    print("Summarized {} pages".format(pages))
+
+    if clean or dry_run:
+        for shard, names in zip(shards, data_file_names):
+            _, metrics_dir_path, noscript_dir_path, screenshots_dir_path = get_output_paths(shard)
+
+            for dir_path, ext in [
+                ( metrics_dir_path, ".json" ),
+                ( noscript_dir_path, ".html" ),
+                ( screenshots_dir_path, ".png" )
+            ]:
+                with profiling.stage("scan"):
+                    orphans = find_orphans(dir_path, ext, names)
+                    orphan_bytes = sum([ size for _, size in orphans ])
+                    profiling.count(files=len(orphans), bytes=orphan_bytes)
+
+                if dry_run:
+                    print("{}: {} files to remove ({} bytes)".format(dir_path, len(orphans), orphan_bytes))
+                    continue
+
+                with profiling.stage("remove"):
+                    removed = sum(remove_files([ path for path, _ in orphans ]))
+                print("{}: removed {} files ({} bytes)".format(dir_path, removed, orphan_bytes))
+
+def add_arguments(parser):
+    parser.add_argument("dataset", help="output directory or manifest")
+    parser.add_argument("--blacklist", metavar="path", help="remove blacklisted URLs from the main table")
+    parser.add_argument("--clean", action="store_true", help="remove files that don't belong to any row")
+    parser.add_argument("--dry-run", action="store_true", help="only report what --clean would remove")
+    parser.add_argument("--intermediates", action="store_true", help="also write the split tables")
+    parser.add_argument("--duplicates", choices=duplicate_policies, default="all", help="what to do with URLs that are in several shards")
+
+def run(args, session):
+    bm_file_path, shards = open_dataset(args.dataset)
+    run_pipeline(bm_file_path, shards, args.blacklist, args.clean, args.dry_run, args.intermediates, args.duplicates)
+
+if __name__ == "__main__":
+    from cli import run_script
+    run_script("pipeline")
@@ -1,81 +1,73 @@
-from util import get_paths, parse_csv_line, as_bool, append_to_filename
-from util import results_columns as columns
-
-import sys, os
-
-# Determine amount of command line arguments.
-argc = len(sys.argv) - 1
-
-if argc < 2:
-    print("usage: {} outputdir plot".format(sys.argv[0]))
-    exit()
-
-action = sys.argv[2]
-plot_types = [ "hist_load", "hist_domload", "hist_idle" ]
-
-if action not in plot_types:
-    print("plot argument must be one of: {}".format(", ".join(plot_types)))
-    exit()
-
-# matplotlib is quite massive so we're only importing it now.
-import matplotlib
-import matplotlib.pyplot as plt
-
-bm_file_path, _, _, _ = get_paths()
-bm_results_file_path = append_to_filename(bm_file_path, "_results")
-
-# Read results file into rows field.
-rows = []
-
-with open(bm_results_file_path) as f:
-    # Skip CSV header.
-    next(f)
-
-    for line in f:
-        line = parse_csv_line(line)
-        line[1] = as_bool(line[1])
-        line[2] = as_bool(line[2])
-
-        for i in range(3, len(line)):
-            line[i] = float(line[i])
-        
-        rows.append(line)
-
-# Create basic figure.
-fig, axes = plt.subplots(figsize=(6, 3))
-
-if action.startswith("hist_"):
-    hist_data = action[5:] # Strip hist_ at beginning.
-    hist_title = ""
-    # Contains indices of column containing measurements for
-    # when JS is on (index 0) and JS is off (index 1).
-    data_columns = ()
-
-    if hist_data == "load":
-        hist_title = "Median time until load event fired"
-        data_columns = (columns["js_on_median_load"], columns["js_off_median_load"])
-    elif hist_data == "domload":
-        hist_title = "Median time until DOMContentLoaded event fired"
-        data_columns = (columns["js_on_median_domload"], columns["js_off_median_domload"])
-    elif hist_data == "idle":
-        hist_title = "Median time until no more network connections"
-        data_columns = (columns["js_on_median_idle"], columns["js_off_median_idle"])
-    
-    # Prepre lists for x values.
-    x_js = []
-    x_nojs = []
-
-    for row in rows:
+"""
+Plots the results. Pass one of the plot types to show it in a window.
+Pass "all" or several types (or --format=png|svg) to render them to
+files in the plots directory of the output directory instead, which
+doesn't need a display. Files are only rendered again if the results
+changed since.
+"""
+from util import get_output_paths, read_results, append_to_filename, load_columns, UsageError
+from util import load_state, save_state
+
+from hashlib import sha1
+import os, json
+import numpy as np
+import profiling
+
+# Title and the names of the columns containing measurements for
+# when JS is on (index 0) and JS is off (index 1) for every plot.
+plots = {
+    "hist_load": ( "Median time until load event fired", ( "js_on_median_load", "js_off_median_load" ) ),
+    "hist_domload": ( "Median time until DOMContentLoaded event fired", ( "js_on_median_domload", "js_off_median_domload" ) ),
+    "hist_idle": ( "Median time until no more network connections", ( "js_on_median_idle", "js_off_median_idle" ) ),
+}
+
+# 30 seconds, 120 bins = 1 bin is 250 milliseconds.
+hist_bins = 120
+hist_range = ( 0, 30 )
+
+def hash_file(file_path, chunk_size=1 << 20):
+    """
+    Returns the SHA-1 hash of the contents of a file.
+    """
+    h = sha1()
+
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+def get_histogram(columns, name, histograms):
+    """
+    Returns the counts and bin edges of a column in seconds. Every
+    column is only counted once, the result is kept in histograms.
+    """
+    if name not in histograms:
         # Divide by 1000 so we get time in seconds.
-        x_js.append(row[data_columns[0]] / 1000)
-        x_nojs.append(row[data_columns[1]] / 1000)
-    
+        histograms[name] = np.histogram(columns[name] / 1000, bins=hist_bins, range=hist_range)
+
+    return histograms[name]
+
+def draw_plot(plt, action, columns, histograms):
+    """
+    Draws a plot into a new figure and returns it.
+    """
+    hist_title, data_columns = plots[action]
+
+    # Create basic figure.
+    fig, axes = plt.subplots(figsize=(6, 3))
+
     # Draw grid.
     axes.grid(True)
 
-    # 30 seconds, 120 bins = 1 bin is 250 milliseconds.
-    axes.hist(x_js, histtype="step", bins=120, range=(0, 30), label="JS enabled", fill=True, facecolor="#17becf40")
-    axes.hist(x_nojs, histtype="step", bins=120, range=(0, 30), label="JS disabled", fill=True, facecolor="#bcbd2240")
+    for name, label, color in [
+        ( data_columns[0], "JS enabled", "#17becf40" ),
+        ( data_columns[1], "JS disabled", "#bcbd2240" )
+    ]:
+        counts, edges = get_histogram(columns, name, histograms)
+
+        # Draws the counted bins the same way as counting them right here.
+        axes.hist(edges[:-1], bins=edges, weights=counts, histtype="step", label=label, fill=True, facecolor=color)
 
     axes.legend()
     axes.set_xlabel("Time in seconds")
@@ -83,4 +75,110 @@ if action.startswith("hist_"):
     axes.set_title(hist_title)
 
     fig.tight_layout()
-    plt.show()
\ No newline at end of file
+    return fig
+
+def get_actions(names):
+    """
+    Returns the list of plots to draw given their names, where
+    "all" stands for every plot.
+    """
+    if names == [ "all" ]:
+        return list(plots)
+
+    for name in names:
+        if name not in plots:
+            raise UsageError("plot argument must be one of: all, {}".format(", ".join(plots)))
+
+    return names
+
+def show_plot(results_file_path, action, loader=load_columns):
+    """
+    Shows a single plot in a window.
+    """
+    # matplotlib is quite massive so we're only importing it now.
+    import matplotlib.pyplot as plt
+
+    draw_plot(plt, action, loader(results_file_path, read_results), {})
+    plt.show()
+
+def render_plots(results_file_path, actions, out_format, out_dir_path, loader=load_columns):
+    """
+    Renders plots to files in the given directory, skipping the ones
+    that are up to date. Returns the list of written files.
+    """
+    os.makedirs(out_dir_path, exist_ok=True)
+
+    # Hashes of the results and the plot settings that every file
+    # was rendered from.
+    state_path = os.path.join(out_dir_path, "plots_state.json")
+    state = load_state(state_path) or {}
+    results_hash = hash_file(results_file_path)
+
+    todo = []
+    written = []
+
+    for action in actions:
+        out_file_name = "{}.{}".format(action, out_format)
+        out_file_path = os.path.join(out_dir_path, out_file_name)
+        input_hash = sha1(json.dumps([ results_hash, plots[action], hist_bins, hist_range ]).encode()).hexdigest()
+
+        if os.path.exists(out_file_path) and state.get(out_file_name) == input_hash:
+            print("{} is up to date".format(out_file_path))
+            continue
+
+        todo.append(( action, out_file_name, input_hash ))
+
+    if len(todo) > 0:
+        # Render without a display.
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+
+        columns = loader(results_file_path, read_results)
+        histograms = {}
+
+        for action, out_file_name, input_hash in todo:
+            out_file_path = os.path.join(out_dir_path, out_file_name)
+
+            with profiling.stage("render"):
+                fig = draw_plot(plt, action, columns, histograms)
+                fig.savefig(out_file_path)
+                plt.close(fig)
+                profiling.count(files=1)
+
+            state[out_file_name] = input_hash
+            written.append(out_file_path)
+            print("Wrote {}".format(out_file_path))
+
+        save_state(state_path, state)
+
+    return written
+
+def add_arguments(parser):
+    parser.add_argument("outputdir")
+    parser.add_argument("plots", nargs="+", metavar="plot", help="all or any of: {}".format(", ".join(plots)))
+    parser.add_argument("--format", metavar="png|svg", help="render to files of this format")
+    parser.add_argument("--out", metavar="dir", help="directory to render to (plots in the output directory)")
+
+def run(args, session):
+    actions = get_actions(args.plots)
+
+    bm_file_path, _, _, _ = get_output_paths(args.outputdir)
+    bm_results_file_path = append_to_filename(bm_file_path, "_results")
+
+    out_format = args.format
+
+    # Several plots can't be shown at once, so they're saved instead.
+    if out_format is None and len(actions) > 1:
+        out_format = "png"
+
+    if out_format is None:
+        show_plot(bm_results_file_path, actions[0], session.load_columns)
+        return
+
+    out_dir_path = args.out or os.path.join(os.path.dirname(bm_file_path), "plots")
+    render_plots(bm_results_file_path, actions, out_format, out_dir_path, session.load_columns)
+
+if __name__ == "__main__":
+    from cli import run_script
+    run_script("plot")
@@ -0,0 +1,393 @@
+"""
+Profiling of the scripts, turned on with --profile (see cli.py).
+
+Scripts mark their stages with stage() and count the rows, files and
+bytes they processed with count(). Both do next to nothing while
+profiling is off, so they can stay in the code. A stage that is
+entered several times (e.g. once per file) adds up. Stages can be
+nested, e.g. parse is part of classify in noscr.py, so their times
+overlap. Modules can also list functions in profiled_functions, which
+are wrapped to count their calls and time once profiling starts.
+
+The report is a JSON object per run with the wall time, CPU time,
+rows, files and bytes of every stage and the calls of every tracked
+function. stage_peak_rss_kb is the highest resident set of the process
+while the stage ran (of any worker process for stages that ran in
+workers). It's measured by resetting the peak that Linux keeps on
+entering a stage, so it's null on other systems. peak_rss_kb is the
+peak of the whole run. Pass two files of reports to compare the last
+run of each:
+
+    python3 profiling.py before.jsonl after.jsonl
+"""
+from contextlib import contextmanager, nullcontext
+import functools, json, os, platform, resource, sys, time
+
+# Version of the report format.
+report_version = 2
+
+# Profiler of this process, or None if profiling is off.
+active = None
+
+def get_peak_rss():
+    """
+    Returns the peak resident set of this process in KB. Linux keeps
+    ru_maxrss across exec, so it would include the process that
+    started this one, which is why VmHWM is used if it's there. While
+    profiling, it's only the peak since the last stage was entered.
+    """
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def new_stage():
+    return { "calls": 0, "wall": 0.0, "cpu": 0.0, "rows": 0, "files": 0, "bytes": 0, "stage_peak_rss_kb": 0 }
+
+def new_calls():
+    return { "calls": 0, "total": 0.0, "own": 0.0 }
+
+class Profiler:
+
+    def __init__(self, worker=False):
+        """
+        Collects the stages and calls of this process. A worker hands
+        over what it collected with take() after every piece of work.
+        """
+        self.worker = worker
+        self.stages = {}
+        self.calls = {}
+
+        # Stages that are currently entered, innermost last, and the
+        # time spent in tracked calls made by the current call.
+        self.current = []
+        self.call_stack = []
+
+        # Peak resident set of the whole process, since the one that
+        # Linux keeps is reset for every stage.
+        self.peak_rss_kb = 0
+
+        # Opened once, reading them by path for every stage is slow.
+        # Both refer to this process, so workers open their own.
+        try:
+            self.status_fd = os.open("/proc/self/status", os.O_RDONLY)
+            self.clear_refs_fd = os.open("/proc/self/clear_refs", os.O_WRONLY)
+        except OSError:
+            self.status_fd = None
+            self.clear_refs_fd = None
+
+        self.measures_stage_peaks = self.clear_refs_fd is not None
+
+    def close(self):
+        for fd in [ self.status_fd, self.clear_refs_fd ]:
+            if fd is not None:
+                os.close(fd)
+
+        self.status_fd = None
+        self.clear_refs_fd = None
+
+    def update_peaks(self, reset):
+        """
+        Adds the peak resident set since the last reset to the stages
+        that are entered, and resets it if asked to.
+        """
+        if self.clear_refs_fd is None:
+            return
+
+        status = os.pread(self.status_fd, 8192, 0)
+        i = status.index(b"VmHWM:")
+        peak = int(status[i + 6:status.index(b"kB", i)])
+
+        self.peak_rss_kb = max(self.peak_rss_kb, peak)
+
+        for s in self.current:
+            s["stage_peak_rss_kb"] = max(s["stage_peak_rss_kb"], peak)
+
+        if reset:
+            os.write(self.clear_refs_fd, b"5")
+
+    @contextmanager
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = new_stage()
+
+        s = self.stages[name]
+
+        # The stages around this one get the peak up to here, this one
+        # starts from what's used now.
+        self.update_peaks(reset=True)
+        self.current.append(s)
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+
+        try:
+            yield s
+        finally:
+            s["calls"] += 1
+            s["wall"] += time.perf_counter() - wall
+            s["cpu"] += time.process_time() - cpu
+            self.update_peaks(reset=False)
+            self.current.pop()
+
+    def count(self, rows=0, files=0, bytes=0):
+        """
+        Adds to the counters of the innermost stage.
+        """
+        if len(self.current) == 0:
+            return
+
+        s = self.current[-1]
+        s["rows"] += rows
+        s["files"] += files
+        s["bytes"] += bytes
+
+    def call(self, name, fn, args, kwargs):
+        """
+        Calls a tracked function and records the time it took, in
+        total and without the tracked functions that it called.
+        """
+        self.call_stack.append(0.0)
+        t = time.perf_counter()
+
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            t = time.perf_counter() - t
+            children = self.call_stack.pop()
+
+            if name not in self.calls:
+                self.calls[name] = new_calls()
+
+            c = self.calls[name]
+            c["calls"] += 1
+            c["total"] += t
+            c["own"] += t - children
+
+            if len(self.call_stack) > 0:
+                self.call_stack[-1] += t
+
+    def take(self):
+        """
+        Returns the stages and calls collected so far and starts over.
+        """
+        collected = { "stages": self.stages, "calls": self.calls }
+        self.stages = {}
+        self.calls = {}
+
+        return collected
+
+    def merge(self, collected):
+        """
+        Adds the stages and calls that another process collected.
+        """
+        for name, s in collected["stages"].items():
+            own = self.stages.setdefault(name, new_stage())
+
+            for key, value in s.items():
+                own[key] = max(own[key], value) if key == "stage_peak_rss_kb" else own[key] + value
+
+        for name, c in collected["calls"].items():
+            own = self.calls.setdefault(name, new_calls())
+
+            for key, value in c.items():
+                own[key] += value
+
+def start(worker=False):
+    """
+    Turns profiling on in this process.
+    """
+    global active
+    active = Profiler(worker)
+
+    # Functions of modules that are imported later aren't tracked.
+    for module in list(sys.modules.values()):
+        names = getattr(module, "profiled_functions", None)
+
+        # A script that was run directly is imported again by cli.py.
+        if names is not None and module.__name__ != "__main__":
+            track_calls(module, names)
+
+    return active
+
+def stop():
+    """
+    Turns profiling off and returns the profiler.
+    """
+    global active
+    profiler, active = active, None
+    profiler.close()
+
+    return profiler
+
+def stage(name):
+    """
+    Returns a context manager that adds the time spent in it to the
+    stage with the given name.
+    """
+    return nullcontext() if active is None else active.stage(name)
+
+def count(rows=0, files=0, bytes=0):
+    if active is not None:
+        active.count(rows, files, bytes)
+
+def take():
+    """
+    Returns what a worker process collected since the last call, to
+    be sent back along with its results, or None outside of workers.
+    """
+    if active is None or not active.worker:
+        return None
+
+    return active.take()
+
+def merge(collected):
+    """
+    Adds what a worker process collected, see take.
+    """
+    if active is not None and collected is not None:
+        active.merge(collected)
+
+def track_calls(module, names):
+    """
+    Replaces the functions with the given names in a module with
+    wrappers that record their calls while profiling is on. Tables
+    in the module that refer to them, like dictionaries of handlers,
+    are updated as well. Functions that are tracked already are
+    left alone.
+    """
+    namespace = vars(module)
+    replaced = {}
+
+    for name in names:
+        fn = namespace[name]
+
+        if hasattr(fn, "tracked"):
+            continue
+
+        def wrap(fn, qualified_name):
+            @functools.wraps(fn)
+            def tracked(*args, **kwargs):
+                if active is None:
+                    return fn(*args, **kwargs)
+
+                return active.call(qualified_name, fn, args, kwargs)
+
+            tracked.tracked = fn
+            return tracked
+
+        namespace[name] = wrap(fn, "{}.{}".format(module.__name__, name))
+        replaced[id(fn)] = namespace[name]
+
+    for value in list(namespace.values()):
+        if isinstance(value, dict):
+            for key, x in value.items():
+                if id(x) in replaced:
+                    value[key] = replaced[id(x)]
+
+def make_report(profiler, command, args, wall, cpu):
+    """
+    Returns the report of a run as a dictionary that can be dumped
+    as JSON. Calls are sorted by their total time.
+    """
+    def rounded(d):
+        return { k: round(v, 6) if isinstance(v, float) else v for k, v in d.items() }
+
+    def stage(name, s):
+        s = dict(name=name, **rounded(s))
+
+        if not profiler.measures_stage_peaks:
+            s["stage_peak_rss_kb"] = None
+
+        return s
+
+    return {
+        "version": report_version,
+        "command": command,
+        "args": args,
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "wall": round(wall, 6),
+        "cpu": round(cpu, 6),
+        "peak_rss_kb": max(profiler.peak_rss_kb, get_peak_rss()),
+        "stages": [ stage(name, s) for name, s in profiler.stages.items() ],
+        "calls": [ dict(name=name, **rounded(c)) for name, c in sorted(profiler.calls.items(), key=lambda x: x[1]["total"], reverse=True) ]
+    }
+
+def write_report(report, path):
+    """
+    Appends a report to a file as a single line, or writes it to
+    stderr if the path is "-".
+    """
+    if path == "-":
+        sys.stderr.write(json.dumps(report, indent=2) + "\n")
+        return
+
+    with open(path, "a") as f:
+        f.write(json.dumps(report) + "\n")
+
+def read_last_report(path):
+    """
+    Returns the last report in a file written by write_report.
+    """
+    report = None
+
+    with open(path, "r") as f:
+        for line in f:
+            if len(line.strip()) > 0:
+                report = json.loads(line)
+
+    return report
+
+def format_change(before, after):
+    if not before or after is None:
+        return "{:>9}".format("-")
+
+    return "{:>+8.1f}%".format((after / before - 1) * 100)
+
+def compare_reports(before, after):
+    """
+    Prints the time and memory of every stage and tracked function
+    of two reports side by side.
+    """
+    print("{} ({}) vs. {} ({})".format(before["command"], before["date"], after["command"], after["date"]))
+    print()
+    print("{:<24} {:>10} {:>10} {:>9} {:>12} {:>12} {:>9}".format("stage", "before (s)", "after (s)", "time", "rows", "rss (KB)", "rss"))
+
+    stages = { x["name"]: x for x in before["stages"] }
+
+    for x in [ dict(name="total", wall=after["wall"], rows=0, stage_peak_rss_kb=after["peak_rss_kb"]) ] + after["stages"]:
+        b = stages.get(x["name"], dict(wall=before["wall"], stage_peak_rss_kb=before["peak_rss_kb"]) if x["name"] == "total" else None)
+
+        if b is None:
+            print("{:<24} {:>10} {:>10.3f}".format(x["name"], "-", x["wall"]))
+            continue
+
+        print("{:<24} {:>10.3f} {:>10.3f} {} {:>12} {:>12} {}".format(x["name"], b["wall"], x["wall"], format_change(b["wall"], x["wall"]),
+            x["rows"], "-" if x.get("stage_peak_rss_kb") is None else x["stage_peak_rss_kb"],
+            format_change(b.get("stage_peak_rss_kb"), x.get("stage_peak_rss_kb"))))
+
+    if len(after["calls"]) == 0:
+        return
+
+    calls = { x["name"]: x for x in before["calls"] }
+
+    print()
+    print("{:<32} {:>10} {:>10} {:>10} {:>9}".format("function", "calls", "own (s)", "total (s)", "total"))
+
+    for x in after["calls"]:
+        b = calls.get(x["name"])
+        print("{:<32} {:>10} {:>10.3f} {:>10.3f} {}".format(x["name"], x["calls"], x["own"], x["total"],
+            format_change(b["total"], x["total"]) if b is not None else "{:>9}".format("-")))
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("usage: {} before.jsonl after.jsonl".format(sys.argv[0]))
+        sys.exit(2)
+
+    compare_reports(read_last_report(sys.argv[1]), read_last_report(sys.argv[2]))
@@ -0,0 +1,211 @@
+"""
+Persistent cache for the classification results of noscript files,
+so noscr.py only has to parse files that it hasn't seen before.
+
+Entries are keyed by the hash of the file contents and the netloc of
+the page (some handlers look at it). The whole cache is dropped when
+the version of the classifier changes. When only the signature tables
+change, entries are kept and checked lazily instead: an entry is only
+classified again if the raw file contains one of the patterns that
+were added, removed or changed since the entry was stored.
+"""
+from hashlib import sha1
+from bisect import bisect_left
+
+import json
+import sqlite3
+
+def get_moved(sequence):
+    """
+    Returns the indices of the items in a sequence of distinct
+    numbers that are not part of its longest increasing subsequence.
+    Any two items that are out of order include at least one of them.
+    """
+    # tails[i] holds the index of the smallest item that ends an
+    # increasing subsequence of length i + 1, tail_values the item.
+    tails = []
+    tail_values = []
+    previous = [ None ] * len(sequence)
+
+    for i, x in enumerate(sequence):
+        j = bisect_left(tail_values, x)
+
+        if j > 0:
+            previous[i] = tails[j - 1]
+
+        if j == len(tails):
+            tails.append(i)
+            tail_values.append(x)
+        else:
+            tails[j] = i
+            tail_values[j] = x
+
+    kept = set()
+    i = tails[-1] if len(tails) > 0 else None
+
+    while i is not None:
+        kept.add(i)
+        i = previous[i]
+
+    return [ i for i in range(len(sequence)) if i not in kept ]
+
+def diff_signatures(old_tables, new_tables):
+    """
+    Returns the set of patterns that differ between two versions of
+    the signature tables, which are dictionaries that map the name of
+    a table to a list of (pattern, category, detail) tuples. Patterns
+    that were added or removed count as changed, as well as patterns
+    with a different category or detail. If the priorities of patterns
+    were swapped, one of each pair counts as changed, which is enough
+    to catch every file that contains both.
+    """
+    changed = set()
+
+    for name in set(old_tables) | set(new_tables):
+        # The first entry of duplicate patterns is the one that counts.
+        old = {}
+        new = {}
+
+        for signatures, d in [ ( old_tables.get(name, []), old ), ( new_tables.get(name, []), new ) ]:
+            for pattern, cat, detail in signatures:
+                if pattern not in d:
+                    d[pattern] = ( len(d), cat, detail )
+
+        changed.update(set(old) ^ set(new))
+
+        # Patterns in the order of the new version, with their
+        # positions in the old one.
+        common = sorted([ x for x in new if x in old ], key=lambda x: new[x][0])
+        changed.update([ common[i] for i in get_moved([ old[x][0] for x in common ]) ])
+        changed.update([ x for x in common if old[x][1:] != new[x][1:] ])
+
+    return changed
+
+class ResultsCache:
+
+    def __init__(self, path, version, signature_tables, readonly=False, commit_every=1000):
+        """
+        Opens the cache at the given path. The version identifies the
+        classifier rules and signature_tables holds the signatures they
+        are using, see diff_signatures. Only one process should open the
+        cache for writing, which also records changes to the signatures.
+        Other processes can look up entries with readonly set to True.
+        Updates are committed every commit_every entries, so they're
+        not lost if the run stops before the cache is closed.
+        """
+        self.commit_every = commit_every
+        self.uncommitted = 0
+
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, generation INTEGER, value TEXT, last_used INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS changes (generation INTEGER PRIMARY KEY, patterns TEXT)")
+
+        meta = dict(self.db.execute("SELECT key, value FROM meta"))
+        signatures = json.dumps(signature_tables)
+
+        if not readonly:
+            # Lookups go through connections of their own (even in a
+            # serial run), which must not be locked out while updates
+            # are written.
+            self.db.execute("PRAGMA journal_mode=WAL")
+
+            if meta.get("version") != str(version):
+                # Different rules, nothing in here can be trusted.
+                self.db.execute("DELETE FROM entries")
+                self.db.execute("DELETE FROM changes")
+
+                meta = { "version": str(version), "generation": "0", "run": "0", "signatures": signatures }
+            elif meta["signatures"] != signatures:
+                changed = diff_signatures(json.loads(meta["signatures"]), signature_tables)
+                meta["generation"] = str(int(meta["generation"]) + 1)
+                meta["signatures"] = signatures
+
+                self.db.execute("INSERT INTO changes VALUES (?, ?)", ( int(meta["generation"]), json.dumps(sorted(changed)) ))
+
+            # Entries that are used in this run are marked with it.
+            meta["run"] = str(int(meta["run"]) + 1)
+
+            self.db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", meta.items())
+            self.db.commit()
+
+        self.generation = int(meta.get("generation", 0))
+        self.run = int(meta.get("run", 0))
+        self.changes = [ ( g, [ x.encode() for x in json.loads(p) ] )
+            for g, p in self.db.execute("SELECT generation, patterns FROM changes ORDER BY generation") ]
+
+        # Patterns that changed since a generation, by generation.
+        self.changed_since = {}
+
+    @staticmethod
+    def get_key(data, netloc):
+        """
+        Returns the key for the contents of a file on the page with
+        the given netloc.
+        """
+        return sha1(netloc.encode() + b"\0" + data).hexdigest()
+
+    def get_changed_patterns(self, generation):
+        """
+        Returns the patterns that changed after the given generation.
+        """
+        if generation not in self.changed_since:
+            self.changed_since[generation] = set([ p for g, patterns in self.changes if g > generation for p in patterns ])
+
+        return self.changed_since[generation]
+
+    def get(self, key, data):
+        """
+        Returns the cached value for a key or None if there is none or
+        if it might be affected by changes to the signatures. The raw
+        file contents are needed to check for the latter.
+        """
+        row = self.db.execute("SELECT generation, value FROM entries WHERE key = ?", ( key, )).fetchone()
+
+        if row is not None:
+            generation, value = row
+
+            if generation == self.generation or not any(p in data for p in self.get_changed_patterns(generation)):
+                return json.loads(value)
+
+        return None
+
+    def update(self, updates):
+        """
+        Applies a list of (key, value) updates. A value of None marks
+        an entry that was used without changing it.
+        """
+        for key, value in updates:
+            if value is None:
+                self.db.execute("UPDATE entries SET generation = ?, last_used = ? WHERE key = ?", ( self.generation, self.run, key ))
+            else:
+                self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", ( key, self.generation, json.dumps(value), self.run ))
+
+        self.uncommitted += len(updates)
+
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        """
+        Writes all updates so far to the cache file.
+        """
+        self.db.commit()
+        self.uncommitted = 0
+
+    def evict(self, max_entries):
+        """
+        Removes the least recently used entries until there are at
+        most the given amount left. Returns the amount of removed entries.
+        """
+        count = self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+        if count <= max_entries:
+            return 0
+
+        self.db.execute("DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY last_used LIMIT ?)", ( count - max_entries, ))
+        return count - max_entries
+
+    def close(self):
+        self.commit()
+        self.db.close()
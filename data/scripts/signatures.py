@@ -0,0 +1,259 @@
+"""
+Known signatures of trackers and content hosts that show up in
+the src attributes of noscript content, and a matcher that checks
+a string against all of them (at once if there are enough of them).
+"""
+from collections import deque
+
+# Category definitions.
+cat_alt = "alternative_content"
+cat_track = "tracking_metrics"
+cat_other = "other"
+
+# Signatures for iframe sources. Each entry is a substring that
+# needs to be present in the src attribute along with the category
+# and the more specific description it maps to. If several
+# signatures match, the one listed first wins.
+iframe_signatures = [
+    # Google Tag Manager
+    ( "googletagmanager.com",   cat_track, "google_tag_manager" ),
+    # Google Analytics
+    ( "google-analytics.com",   cat_track, "google_analytics" ),
+    # DoubleClick
+    ( "fls.doubleclick.net",    cat_track, "doubleclick" ),
+    # TheBrightTag
+    ( "thebrighttag.com",       cat_track, "the_bright_tag" ),
+]
+
+# Signatures for image sources, same rules as above.
+img_signatures = [
+    # Scorecard
+    ( "b.scorecardresearch.com",                    cat_track, "scorecard_research" ),
+    # Facebook
+    ( "facebook.com/tr",                            cat_track, "facebook" ),
+    # Pinterest
+    ( "ct.pinterest.com",                           cat_track, "pinterest" ),
+    # IMR Worldwide
+    ( "imrworldwide.com",                           cat_track, "imr_worldwide" ),
+    # Google Ad Conversion
+    ( "googleadservices.com/pagead/conversion",     cat_track, "google_ad_conversion" ),
+    # LinkedIn
+    ( "ads.linkedin.com/collect",                   cat_track, "linkedin" ),
+    # Microsoft
+    ( "web.vortex.data.microsoft.com",              cat_track, "microsoft" ),
+    # TNS Counter
+    ( "tns-counter.ru",                             cat_track, "tns_counter" ),
+    # Quantcast
+    ( "pixel.quantserve.com",                       cat_track, "quantcast" ),
+    # Twitter
+    ( "analytics.twitter.com",                      cat_track, "twitter" ),
+    ( "t.co/i/adsct",                               cat_track, "twitter" ),
+    # ABC.ES
+    ( "rrss.abc.es/pixel",                          cat_track, "abc_es" ),
+    # AdForm
+    ( "adform.net/Serving/TrackPoint",              cat_track, "adform" ),
+    # Bing Conversion
+    ( "bat.bing.com",                               cat_track, "bing" ),
+    # DoubleClick
+    ( "doubleclick.net/pagead",                     cat_track, "doubleclick" ),
+    ( "ad.doubleclick.net",                         cat_track, "doubleclick" ),
+    # Google Analytics
+    ( "google-analytics.com",                       cat_track, "google_analytics" ),
+    # Quora
+    ( "quora.com/_/ad",                             cat_track, "quora" ),
+    # Amazon
+    ( "fls-na.amazon.com",                          cat_track, "amazon" ),
+    # BBC
+    ( "ssc.api.bbc.com",                            cat_track, "bbc" ),
+    ( "api.bbc.co.uk",                              cat_track, "bbc" ),
+    # EFF
+    ( "anon-stats.eff.org",                         cat_track, "eff" ),
+    # Taboola
+    ( "trc.taboola.com",                            cat_track, "taboola" ),
+    # Wordpress
+    ( "pixel.wp.com",                               cat_track, "wordpreess" ),
+    # Bizographics
+    ( "bizographics.com/collect",                   cat_track, "bizographics" ),
+    # Buzzfeed
+    ( "pixiedust.buzzfeed.com",                     cat_track, "buzzfeed" ),
+    # El Mundo
+    ( "smetrics.el-mundo.net",                      cat_track, "el_mundo" ),
+    # Ziff Davis
+    ( "zdbb.net/l",                                 cat_track, "ziff_davis" ),
+    # Guardian
+    ( "phar.gu-web.net",                            cat_track, "the_guardian" ),
+    # Timeout
+    ( "smetrics.timeout.com",                       cat_track, "timeout" ),
+    # Amazon Cloudfront
+    ( "cloudfront.net/atrk.gif",                    cat_track, "amazon_cloudfront" ),
+    # Rambler
+    ( "counter.rambler.ru",                         cat_track, "rambler" ),
+    # Yandex
+    ( "mc.yandex.ru",                               cat_track, "yandex" ),
+    ( "yabs.yandex.ru",                             cat_track, "yandex" ),
+    # Mail.ru
+    ( "r3.mail.ru",                                 cat_track, "mail_ru" ),
+    ( "mail.ru/counter",                            cat_track, "mail_ru" ),
+    # XiTi
+    ( "xiti.com",                                   cat_track, "xiti" ),
+    # Archive
+    ( "analytics.archive.org",                      cat_track, "archive" ),
+    # Financial Times
+    ( "ft.com/px.gif",                              cat_track, "financial_times" ),
+    # Adobe Digital Marketing
+    ( "omtrdc.net",                                 cat_track, "adobe_digital_marketing" ),
+    # Omniture
+    ( "2o7.net",                                    cat_track, "omniture" ),
+    ( "2O7.net",                                    cat_track, "omniture" ),
+    # Matomo/Piwik
+    ( "analytics.ietf.org",                         cat_track, "matomo_piwik" ),
+    ( "athena.iubenda.com/js",                      cat_track, "matomo_piwik" ),
+    ( "piwik.itzbund.de",                           cat_track, "matomo_piwik" ),
+    # Offerlogic
+    ( "saffron.760main.com/oll",                    cat_track, "offerlogic" ),
+    # Rakuten (never hit since Omniture comes first, kept for reference)
+    ( "rakuten.112.2O7.net",                        cat_track, "rakuten" ),
+    # Alexa
+    ( "alexametrics.com/atrk.gif",                  cat_track, "alexa" ),
+    # Spotify
+    ( "pixel.spotify.com",                          cat_track, "spotify" ),
+
+    # Lots of hosts. Relative images are static content too, but
+    # the trackers above take precedence over those.
+    ( "i.ytimg.com",                                cat_alt, "static_content" ),   # Youtube thumbnails
+    ( "s.w-x.co",                                   cat_alt, "static_content" ),   # Wetter.de
+    ( "googleusercontent.com",                      cat_alt, "static_content" ),   # Google hosted
+    ( "images.arcpublishing.com",                   cat_alt, "static_content" ),   # The Globe And Mail
+    ( "cloudfront.net/thumbnails",                  cat_alt, "static_content" ),   # Thumbnail hosted on Cloudfront
+    ( "wp-content/uploads",                         cat_alt, "static_content" ),   # Wordpress uploads
+    ( "imageserver/image",                          cat_alt, "static_content" ),   # Times UK
+    ( "images/thumb",                               cat_alt, "static_content" ),   # More thumbnails
+    ( "springernature.com/springer-cms",            cat_alt, "static_content" ),   # Springer
+    ( "imagesvc.meredithcorp.io",                   cat_alt, "static_content" ),   # People
+    ( "cdn.vox-cdn.com",                            cat_alt, "static_content" ),   # Vox
+    ( "cdni.rt.com",                                cat_alt, "static_content" ),   # RT
+    ( "www.theglobeandmail.com/resizer",            cat_alt, "static_content" ),   # The Globe And Mail (again)
+]
+
+# Below this many signatures, checking one after another is faster
+# than the automaton (see bench.py signatures).
+automaton_threshold = 250
+
+class SignatureMatcher:
+
+    def __init__(self, signatures, threshold=automaton_threshold):
+        """
+        Compiles a list of (substring, category, detail) tuples into
+        an Aho-Corasick automaton, so a string can be checked against
+        all signatures in a single pass regardless of how many there are.
+        Lists with fewer signatures than the threshold are simply
+        checked in order, which is faster for short lists.
+        """
+        self.signatures = signatures
+        self.scan = None
+
+        if len(signatures) < threshold:
+            self.scan = [ ( pattern, ( cat, detail ) ) for pattern, cat, detail in signatures ]
+            return
+
+        # Transitions, failure links and the index of the first listed
+        # signature that ends in each state (or None).
+        self.goto = [ {} ]
+        self.fail = [ 0 ]
+        self.out = [ None ]
+
+        for i, (pattern, _, _) in enumerate(signatures):
+            state = 0
+
+            for c in pattern:
+                next_state = self.goto[state].get(c)
+
+                if next_state is None:
+                    next_state = len(self.goto)
+
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(None)
+                    self.goto[state][c] = next_state
+
+                state = next_state
+
+            # Duplicate signatures keep the priority of the first one.
+            if self.out[state] is None:
+                self.out[state] = i
+
+        # Compute failure links breadth first. Every state also inherits
+        # the best signature of the state its failure link points to
+        # since that one is a suffix of the current match.
+        queue = deque(self.goto[0].values())
+
+        while len(queue) > 0:
+            state = queue.popleft()
+
+            for c, next_state in self.goto[state].items():
+                f = self.fail[state]
+
+                while f != 0 and c not in self.goto[f]:
+                    f = self.fail[f]
+
+                self.fail[next_state] = self.goto[f].get(c, 0) if state != 0 else 0
+                self.out[next_state] = self._first(self.out[next_state], self.out[self.fail[next_state]])
+
+                queue.append(next_state)
+
+    @staticmethod
+    def _first(a, b):
+        """
+        Returns the lower one of two signature indices, treating
+        None as no match.
+        """
+        if a is None:
+            return b
+
+        if b is None:
+            return a
+
+        return min(a, b)
+
+    def match(self, s):
+        """
+        Returns the (category, detail) tuple of the first listed
+        signature that occurs in the given string, or None if
+        none of them do.
+        """
+        if self.scan is not None:
+            for pattern, r in self.scan:
+                if pattern in s:
+                    return r
+
+            return None
+
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+
+        state = 0
+        best = None
+
+        for c in s:
+            while state != 0 and c not in goto[state]:
+                state = fail[state]
+
+            state = goto[state].get(c, 0)
+            i = out[state]
+
+            if i is not None and (best is None or i < best):
+                best = i
+
+                # Nothing can beat the very first signature.
+                if best == 0:
+                    break
+
+        if best is None:
+            return None
+
+        _, cat, detail = self.signatures[best]
+        return ( cat, detail )
+
+iframe_matcher = SignatureMatcher(iframe_signatures)
+img_matcher = SignatureMatcher(img_signatures)
@@ -0,0 +1,275 @@
+"""
+Builds quantile sketches (DDSketch) of the load, DOMContentLoaded and
+idle times with JS enabled and disabled in a single pass over the main
+table and saves them next to it, e.g. benchmark_sketch.json. Quantiles
+are accurate up to a relative error and can be answered from the saved
+sketches alone. Sketches of several crawls can be merged. A manifest
+of several output directories can be passed instead of a single one,
+see pipeline.py.
+
+Options:
+    --accuracy=x        relative accuracy of new sketches (0.01)
+    --merge=a,b,...     merge other sketch files with the one of the
+                        output directory instead of reading the table
+    --out=path          where to save merged sketches
+                        (benchmark_sketch_merged.json)
+    --query             only print the quantiles of the saved sketches
+                        (of --out if it's given)
+    --duplicates=x      what to do with URLs that are in several shards
+"""
+from util import open_dataset, read_shards, timing_columns, duplicate_policies, append_to_filename
+
+import json, math, os
+import numpy as np
+import profiling
+
+# Quantiles to print.
+quantiles = [ 0.5, 0.9, 0.99 ]
+
+# Rows are handed to the sketches in chunks of this many samples.
+chunk_size = 65536
+
+class DDSketch:
+
+    # Values closer to zero than this all end up in the zero bucket.
+    min_value = 1e-9
+
+    def __init__(self, relative_accuracy=0.01):
+        """
+        Creates an empty sketch. Every quantile it returns is within
+        the given relative error of the exact quantile.
+        """
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+
+        # Counts of positive values and of the absolute values of
+        # negative values by bucket index, and values close to zero.
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add_many(self, values):
+        """
+        Adds an array of values, ignoring NaN.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+
+        if len(values) == 0:
+            return
+
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        for store, x in [ ( self.positive, values[values > self.min_value] ), ( self.negative, -values[values < -self.min_value] ) ]:
+            # Bucket i holds the values in (gamma^(i - 1), gamma^i].
+            keys, counts = np.unique(np.ceil(np.log(x) / self.log_gamma).astype(np.int64), return_counts=True)
+
+            for key, count in zip(keys.tolist(), counts.tolist()):
+                store[key] = store.get(key, 0) + count
+
+        self.zero_count += int(np.count_nonzero(np.abs(values) <= self.min_value))
+
+    def add(self, value):
+        self.add_many([ value ])
+
+    def merge(self, other):
+        """
+        Adds all values of another sketch with the same accuracy.
+        """
+        if other.gamma != self.gamma:
+            raise ValueError("Can't merge sketches with different accuracies")
+
+        for store, other_store in [ ( self.positive, other.positive ), ( self.negative, other.negative ) ]:
+            for key, count in other_store.items():
+                store[key] = store.get(key, 0) + count
+
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def get_value(self, key):
+        """
+        Returns the value that represents a bucket.
+        """
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantile(self, q):
+        """
+        Returns the approximate q-quantile (0 <= q <= 1) or NaN if
+        the sketch is empty.
+        """
+        if self.count == 0:
+            return math.nan
+
+        rank = q * (self.count - 1)
+        seen = 0
+
+        # From the smallest to the largest value.
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+
+            if seen > rank:
+                return max(-self.get_value(key), self.min)
+
+        seen += self.zero_count
+
+        if seen > rank:
+            return 0.0
+
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+
+            if seen > rank:
+                return min(self.get_value(key), self.max)
+
+        return self.max
+
+    def to_dict(self):
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "positive": { str(k): v for k, v in self.positive.items() },
+            "negative": { str(k): v for k, v in self.negative.items() },
+            "zero_count": self.zero_count,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count > 0 else None,
+            "max": self.max if self.count > 0 else None
+        }
+
+    @staticmethod
+    def from_dict(d):
+        sketch = DDSketch(d["relative_accuracy"])
+        sketch.positive = { int(k): v for k, v in d["positive"].items() }
+        sketch.negative = { int(k): v for k, v in d["negative"].items() }
+        sketch.zero_count = d["zero_count"]
+        sketch.count = d["count"]
+        sketch.sum = d["sum"]
+
+        if sketch.count > 0:
+            sketch.min = d["min"]
+            sketch.max = d["max"]
+
+        return sketch
+
+def get_sketch_path(csv_path):
+    """
+    Returns the path of the sketch file that belongs to a table.
+    """
+    return os.path.splitext(csv_path)[0] + "_sketch.json"
+
+def get_sketch_names():
+    """
+    Returns the names of all sketches, one for every timing with
+    JS enabled and disabled.
+    """
+    return [ "{}_{}".format(t, js) for t in timing_columns for js in [ "js_on", "js_off" ] ]
+
+def build_sketches(rows, relative_accuracy=0.01):
+    """
+    Builds the sketches from the rows of the main table in one pass.
+    Returns a dictionary of sketches by name.
+    """
+    sketches = { x: DDSketch(relative_accuracy) for x in get_sketch_names() }
+    pending = { x: [] for x in sketches }
+    pending_count = 0
+
+    for row in rows:
+        js = "js_on" if row.js_enabled else "js_off"
+        profiling.count(rows=1)
+
+        for t in timing_columns:
+            values = getattr(row, t)
+            pending["{}_{}".format(t, js)].extend(values)
+            pending_count += len(values)
+
+        if pending_count >= chunk_size:
+            for name, values in pending.items():
+                sketches[name].add_many(values)
+                values.clear()
+
+            pending_count = 0
+
+    for name, values in pending.items():
+        sketches[name].add_many(values)
+
+    return sketches
+
+def load_sketches(path):
+    """
+    Loads the sketches saved at the given path.
+    """
+    with open(path, "r") as f:
+        return { name: DDSketch.from_dict(d) for name, d in json.load(f).items() }
+
+def save_sketches(path, sketches):
+    """
+    Saves sketches to the given path, replacing the file in one go.
+    """
+    with open(path + ".tmp", "w") as f:
+        json.dump({ name: x.to_dict() for name, x in sketches.items() }, f)
+
+    os.replace(path + ".tmp", path)
+
+def merge_sketches(a, b):
+    """
+    Merges the sketches in b into the ones with the same name in a.
+    """
+    for name, sketch in b.items():
+        if name in a:
+            a[name].merge(sketch)
+        else:
+            a[name] = sketch
+
+def print_quantiles(sketches):
+    print("{:<16} {:>10} ".format("", "samples") + " ".join([ "{:>10}".format("p{:g}".format(q * 100)) for q in quantiles ]))
+
+    for name, sketch in sketches.items():
+        print("{:<16} {:>10} ".format(name, sketch.count) + " ".join([ "{:>10.1f}".format(sketch.quantile(q)) for q in quantiles ]))
+
+def add_arguments(parser):
+    parser.add_argument("dataset", help="output directory or manifest")
+    parser.add_argument("--accuracy", type=float, default=0.01, help="relative accuracy of new sketches")
+    parser.add_argument("--merge", metavar="a,b,...", help="merge other sketch files with the one of the output directory")
+    parser.add_argument("--out", metavar="path", help="where to save merged sketches (default: benchmark_sketch_merged.json)")
+    parser.add_argument("--query", action="store_true", help="only print the quantiles of the saved sketches (of --out if it's given)")
+    parser.add_argument("--duplicates", choices=duplicate_policies, default="all", help="what to do with URLs that are in several shards")
+
+def run(args, session):
+    bm_file_path, shards = open_dataset(args.dataset)
+    sketch_path = get_sketch_path(bm_file_path)
+
+    if args.query:
+        sketches = load_sketches(args.out or sketch_path)
+    elif args.merge is not None:
+        # The sketches of the output directory stay as they are, so
+        # merging again doesn't count the other crawls twice.
+        sketches = load_sketches(sketch_path) if os.path.exists(sketch_path) else {}
+
+        for path in args.merge.split(","):
+            merge_sketches(sketches, load_sketches(path))
+
+        save_sketches(args.out or append_to_filename(sketch_path, "_merged"), sketches)
+    else:
+        rows = ( row for _, row in read_shards(shards, args.duplicates) )
+
+        with profiling.stage("build"):
+            sketches = build_sketches(rows, args.accuracy)
+
+        save_sketches(sketch_path, sketches)
+
+    print_quantiles(sketches)
+
+if __name__ == "__main__":
+    from cli import run_script
+    run_script("sketch")
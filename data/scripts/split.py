@@ -1,33 +1,66 @@
 """
 Splits main table into two tables: one only containing rows
 where JS was enabled and one where JS was disabled.
+
+With --incremental, only rows that were appended to the main table
+since the last run are appended to both tables.
 """
-from util import get_paths, parse_csv_line, append_to_filename, as_bool
-from util import benchmark_columns as columns
+from util import get_output_paths, parse_benchmark_rows, append_to_filename
+from util import get_state_path, load_state, save_state, open_appended
 
 import os
+import profiling
+
+def split(bm_file_path, incremental=False):
+    """
+    Writes the rows of the main table to the tables with JS enabled
+    (_js) and disabled (_no_js). With incremental set, only the rows
+    that were appended since the last incremental run are added.
+    """
+    bm_js_file_path = append_to_filename(bm_file_path, "_js")
+    bm_no_js_file_path = append_to_filename(bm_file_path, "_no_js")
+
+    state_path = get_state_path(append_to_filename(bm_file_path, "_split"))
+    state = load_state(state_path) if incremental else None
+
+    # Start over if the split tables are gone.
+    if not (os.path.exists(bm_js_file_path) and os.path.exists(bm_no_js_file_path)):
+        state = None
+
+    csv_header, restarted, lines, watermark = open_appended(bm_file_path, None if state is None else state["watermark"])
+
+    # Append to the tables unless everything is read again.
+    mode = "w" if restarted else "a"
+
+    with profiling.stage("split"), open(bm_js_file_path, mode) as out_js, open(bm_no_js_file_path, mode) as out_no_js:
+        # Write CSV header to both output files.
+        if restarted:
+            out_js.write(csv_header)
+            out_no_js.write(csv_header)
+
+        for row in parse_benchmark_rows(csv_header, lines):
+            profiling.count(rows=1, bytes=len(row.line))
+
+            # Write to respective file if the jsenabled column
+            # is either true or false.
+            if row.js_enabled:
+                out_js.write(row.line)
+            else:
+                out_no_js.write(row.line)
+
+    if incremental:
+        save_state(state_path, { "watermark": watermark })
+    elif os.path.exists(state_path):
+        os.remove(state_path)
+
+def add_arguments(parser):
+    parser.add_argument("outputdir")
+    parser.add_argument("--incremental", action="store_true", help="only split rows that were appended since the last run")
+
+def run(args, session):
+    bm_file_path, _, _, _ = get_output_paths(args.outputdir)
+    split(bm_file_path, args.incremental)
 
-bm_file_path, _, _, _ = get_paths()
-bm_js_file_path = append_to_filename(bm_file_path, "_js")
-bm_no_js_file_path = append_to_filename(bm_file_path, "_no_js")
-
-with open(bm_file_path, "r") as f:
-    out_js = open(bm_js_file_path, "w")
-    out_no_js = open(bm_no_js_file_path, "w")
-
-    # Get CSV header and write them to both output files.
-    csv_header = next(f)
-
-    out_js.write(csv_header)
-    out_no_js.write(csv_header)
-
-    for line in f:
-        # Write to respective file if the jsenabled column
-        # is either true or false.
-        if as_bool(parse_csv_line(line)[columns["jsEnabled"]]):
-            out_js.write(line)
-        else:
-            out_no_js.write(line)
-    
-    out_js.close()
-    out_no_js.close()
\ No newline at end of file
+if __name__ == "__main__":
+    from cli import run_script
+    run_script("split")
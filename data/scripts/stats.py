@@ -1,10 +1,14 @@
 """
 Computes some general stats about the results.
+
+With --incremental, the counters that summarize.py --incremental
+keeps up to date are printed without reading the results at all.
 """
-from util import parse_csv_line, append_to_filename, get_paths, as_bool
-from util import results_columns as columns
+from util import read_results, append_to_filename, get_output_paths, load_columns
+from util import get_state_path, load_state, stats_counters
 
-import os
+import numpy as np
+import profiling
 
 def pct_format(x, y):
     """
@@ -13,52 +17,68 @@ def pct_format(x, y):
     """
     return "{:.2f} %".format((x / y) * 100)
 
-bm_file_path, _, _, _ = get_paths()
-bm_results_path = append_to_filename(bm_file_path, "_results")
+def count_stats(columns):
+    """
+    Returns the counters of stats_counters for the columns of
+    a results file.
+    """
+    noscript = columns["noscript"]
+    scripts = columns["scripts"]
 
-# Collect all CSV rows into this list.
-rows = []
+    return {
+        # Total amount of rows.
+        "count": len(noscript),
+        # Counters for several values.
+        "noscript": int(np.count_nonzero(noscript)),
+        "noscript_without_scripts": int(np.count_nonzero(noscript & ~scripts)),
+        "scripts": int(np.count_nonzero(scripts)),
+        "scripts_without_noscript": int(np.count_nonzero(scripts & ~noscript))
+    }
 
-with open(bm_results_path) as f:
-    # Skip CSV header.
-    next(f)
+def get_stats(bm_results_path, incremental=False, loader=load_columns):
+    """
+    Returns the counters of a results file, or the ones kept by
+    summarize.py --incremental (None if there are none). The columns
+    are loaded with the given function.
+    """
+    if incremental:
+        state = load_state(get_state_path(bm_results_path))
+        return None if state is None else { x: state["stats"][x] for x in stats_counters }
 
-    for line in f:
-        line = parse_csv_line(line)
-        line[1] = as_bool(line[1])
-        line[2] = as_bool(line[2])
+    columns = loader(bm_results_path, read_results)
 
-        for i in range(3, len(line)):
-            line[i] = float(line[i])
-        
-        rows.append(line)
+    with profiling.stage("count"):
+        profiling.count(rows=len(columns["noscript"]))
+        return count_stats(columns)
 
-# Total amount of rows.
-count = len(rows)
+def print_stats(stats):
+    count = stats["count"]
+    script_count = stats["scripts"]
+    script_without_noscript_count = stats["scripts_without_noscript"]
+    noscript_count = stats["noscript"]
+    noscript_without_scripts_count = stats["noscript_without_scripts"]
 
-# Counters for several values.
-noscript_count = 0
-noscript_without_scripts_count = 0
+    # Beautiful output.
+    print("Number of websites: {}".format(count))
+    print("Sites with scripts: {} ({})".format(script_count, pct_format(script_count, count)))
+    print("Sites with scripts without noscript: {} ({})".format(script_without_noscript_count, pct_format(script_without_noscript_count, count)))
+    print("Sites with noscript: {} ({})".format(noscript_count, pct_format(noscript_count, count)))
+    print("Sites with noscript without scripts: {} ({})".format(noscript_without_scripts_count, pct_format(noscript_without_scripts_count, noscript_count)))
 
-script_count = 0
-script_without_noscript_count = 0
+def add_arguments(parser):
+    parser.add_argument("outputdir")
+    parser.add_argument("--incremental", action="store_true", help="print the counters kept by summarize.py --incremental")
 
-for row in rows:
-    if row[columns["noscript"]]:
-        noscript_count += 1
+def run(args, session):
+    bm_file_path, _, _, _ = get_output_paths(args.outputdir)
+    stats = get_stats(append_to_filename(bm_file_path, "_results"), args.incremental, session.load_columns)
 
-        if not row[columns["scripts"]]:
-            noscript_without_scripts_count += 1
-    
-    if row[columns["scripts"]]:
-        script_count += 1
+    if stats is None:
+        print("No incremental results found, run summarize.py with --incremental first")
+        return
 
-        if not row[columns["noscript"]]:
-            script_without_noscript_count += 1
+    print_stats(stats)
 
-# Beautiful output.
-print("Number of websites: {}".format(count))
-print("Sites with scripts: {} ({})".format(script_count, pct_format(script_count, count)))
-print("Sites with scripts without noscript: {} ({})".format(script_without_noscript_count, pct_format(script_without_noscript_count, count)))
-print("Sites with noscript: {} ({})".format(noscript_count, pct_format(noscript_count, count)))
-print("Sites with noscript without scripts: {} ({})".format(noscript_without_scripts_count, pct_format(noscript_without_scripts_count, noscript_count)))
+if __name__ == "__main__":
+    from cli import run_script
+    run_script("stats")
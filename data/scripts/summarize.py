@@ -2,104 +2,191 @@
 Creates a table containing the sanitized results of the benchmark.
 This assumes that the main table has been split up.
 
-This file is probably the jankiest out of all.
+Rows with JS enabled and disabled are paired by their URL, so
+gaps in either table don't throw off the rows after them. The medians
+are computed on whole (rows x iterations) matrices at once, so this
+doesn't care about the amount of iterations.
+
+With --incremental, the results are updated straight from the main
+table instead. Only rows that were appended since the last run are
+parsed, every URL keeps its latest result and the counters of
+stats.py are updated along the way (see stats.py --incremental).
+Rows of blacklisted URLs are skipped with --blacklist=path.
 """
-from util import parse_csv_line, get_paths, as_bool, append_to_filename
-from util import benchmark_columns as columns
+from util import get_output_paths, append_to_filename, load_columns, format_url, Blacklist
+from util import results_header, timing_columns, pair_rows, iter_columns, summarize_rows, format_results_row
+from util import get_state_path, load_state, save_state, open_appended, parse_benchmark_rows
+from util import stats_counters, update_stats
 
-import os
-from math import floor, ceil
+from heapq import merge
+from itertools import chain
+import csv, os
+import numpy as np
+import profiling
 
-def median(lst):
+def keyed_rows(columns, js_enabled):
     """
-    Computes the median value in a list of 
-    numeric values.
+    Yields the (url, timestamp, js_enabled, index) tuples of a
+    split table that pair_rows expects.
     """
-    lst.sort()
-    l = len(lst)
+    for i, (url, timestamp) in enumerate(iter_columns(columns, [ "url", "timestamp" ])):
+        yield url, timestamp, js_enabled, i
 
-    if l % 2 == 0:
-        return (lst[floor(l / 2)] + lst[ceil(l / 2)]) / 2
-    else:
-        return lst[floor(l / 2)]
+def summarize_incremental(bm_file_path, results_file_path, blacklist):
+    """
+    Updates the results file with the rows that were appended to the
+    main table since the last run. The state file next to the results
+    file holds the watermark, rows that are still waiting for their
+    counterpart and the noscript and scripts flags of every URL.
+    """
+    state_path = get_state_path(results_file_path)
+    state = load_state(state_path)
 
-bm_file_path, _, _, _ = get_paths()
+    if not os.path.exists(results_file_path):
+        state = None
 
-# File handles.
-js_file = None
-no_js_file = None
-out_file = None
+    header, restarted, lines, watermark = open_appended(bm_file_path, None if state is None else state["watermark"])
 
-try:
-    # Prepare header for output file.
-    out_file = open(append_to_filename(bm_file_path, "_results"), "w")
+    if restarted:
+        state = {
+            "watermark": watermark,
+            "pending": [],
+            "urls": {},
+            "stats": { x: 0 for x in stats_counters }
+        }
 
-    csv_header = [ "url", "noscript", "scripts" ]
+        with open(results_file_path, "w") as f:
+            f.write(",".join(results_header) + "\n")
     
-    # Append headers for the median values.
-    for x in [ "js", "no_js" ]:
-        csv_header.append("median_load_" + x)
-        csv_header.append("median_domload_" + x)
-        csv_header.append("median_idle_" + x)
+    # Rows that were waiting for their counterpart come first.
+    rows = parse_benchmark_rows(header, chain(state["pending"], lines))
+
+    def keyed(rows):
+        for row in rows:
+            if blacklist is not None and row.url in blacklist:
+                continue
+
+            yield row.url, row.timestamp, row.js_enabled, row
     
-    out_file.write(",".join(csv_header) + "\n")
+    leftovers = []
 
-    js_file = open(append_to_filename(bm_file_path, "_js"), "r")
-    nojs_file = open(append_to_filename(bm_file_path, "_no_js"), "r")
+    # Result lines of URLs that are new and of URLs that are already
+    # in the results file.
+    added = {}
+    replaced = {}
 
-    # Skip CSV headers.
-    next(js_file)
-    next(nojs_file)
+    with profiling.stage("update"):
+        for js_row, nojs_row in pair_rows(keyed(rows), leftovers=leftovers):
+            out_row = summarize_rows(js_row, nojs_row)
+            profiling.count(rows=2)
+            url, noscript, scripts = out_row[0], out_row[1], out_row[2]
 
-    while True:
-        # Both are None if EOF is reached.
-        js_line = next(js_file, None)
-        nojs_line = next(nojs_file, None)
+            if url in added or url not in state["urls"]:
+                added[url] = format_results_row(out_row)
+            else:
+                replaced[url] = format_results_row(out_row)
 
-        if js_line is None or nojs_line is None:
-            break
+            # Replace the counters of a URL that was seen before.
+            if url in state["urls"]:
+                update_stats(state["stats"], *state["urls"][url], sign=-1)
         
-        js_row = parse_csv_line(js_line)
-        nojs_row = parse_csv_line(nojs_line)
-
-        # 6 = index first median col.
-        for i in range(6, len(js_row)):
-            # Parse values into floats.
-            js_row[i] = float(js_row[i])
-            nojs_row[i] = float(nojs_row[i])
+            update_stats(state["stats"], noscript, scripts)
+            state["urls"][url] = [ noscript, scripts ]
+
+    # Replacing rows requires rewriting the results file, everything
+    # else is appended.
+    if len(replaced) > 0:
+        with open(results_file_path, "r") as in_file, open(results_file_path + ".tmp", "w") as out_file:
+            out_file.write(next(in_file))
+
+            for line in in_file:
+                url = next(csv.reader([ line ]))[0]
+                out_file.write(replaced.get(url, line))
         
-        out_row = [
-            # col 1: url
-            js_row[columns["url"]],
-            # col 2: noscript exists?
-            as_bool(js_row[columns["noscript"]]) or as_bool(nojs_row[columns["noscript"]]),
-            # col 3: script exists?
-            (int(js_row[columns["scriptCount"]]) > 0) or (int(nojs_row[columns["scriptCount"]]) > 0),
-            # col 4: median load (js on)
-            median(js_row[6:11]),
-            # col 5: median domload (js on)
-            median(js_row[11:16]),
-            # col 6: median idle (js on)
-            median(js_row[16:21]),
-            # col 7: median load (js off)
-            median(nojs_row[6:11]),
-            # col 8: median domload (js off)
-            median(nojs_row[11:16]),
-            # col 9: median idle (js off)
-            median(nojs_row[16:21])
-        ]
-
-        out_file.write(",".join([ str(x) for x in out_row ]) + "\n")
-except IOError as e:
-    print("File IO error: {}".format(e))
-finally:
-    # The error handling may be the cleanest out of
-    # all scripts though.
-    if js_file is not None:
-        js_file.close()
-    
-    if nojs_file is not None:
-        nojs_file.close()
+        os.replace(results_file_path + ".tmp", results_file_path)
     
-    if out_file is not None:
-        out_file.close()
\ No newline at end of file
+    with open(results_file_path, "a") as f:
+        f.writelines(added.values())
+
+    state["watermark"] = watermark
+    state["pending"] = [ row.line for _, _, _, row in leftovers ]
+    save_state(state_path, state)
+
+    print("{} new, {} updated, {} waiting for their counterpart".format(len(added), len(replaced), len(leftovers)))
+
+def summarize(bm_file_path, results_file_path, loader=load_columns):
+    """
+    Writes the results file from the split tables, which are loaded
+    with the given function. Returns the list of (url, timestamp,
+    js_enabled) tuples of rows that have no counterpart.
+    """
+    # A full run invalidates the state of incremental runs.
+    if os.path.exists(get_state_path(results_file_path)):
+        os.remove(get_state_path(results_file_path))
+
+    js = loader(append_to_filename(bm_file_path, "_js"))
+    nojs = loader(append_to_filename(bm_file_path, "_no_js"))
+
+    # Both tables are merged by time, which puts the rows that belong
+    # together right next to each other.
+    rows = merge(keyed_rows(js, True), keyed_rows(nojs, False), key=lambda x: x[1])
+    unmatched = []
+
+    with profiling.stage("pair"):
+        pairs = np.array(list(pair_rows(rows, on_unmatched=lambda *x: unmatched.append(x))), dtype=np.int64).reshape(-1, 2)
+        profiling.count(rows=len(js["url"]) + len(nojs["url"]))
+
+    i_js = pairs[:, 0]
+    i_nojs = pairs[:, 1]
+
+    # col 1: url
+    urls = [ format_url(x) for x in js["url"][i_js].tolist() ]
+    # col 2: noscript exists?
+    noscript = js["noscript"][i_js] | nojs["noscript"][i_nojs]
+    # col 3: script exists?
+    scripts = (js["script_count"][i_js] > 0) | (nojs["script_count"][i_nojs] > 0)
+
+    out_columns = [ urls, list(map(str, noscript.tolist())), list(map(str, scripts.tolist())) ]
+
+    # col 4-6: median load, domload and idle (js on)
+    # col 7-9: median load, domload and idle (js off)
+    with profiling.stage("medians"):
+        for columns, indices in [ ( js, i_js ), ( nojs, i_nojs ) ]:
+            for name in timing_columns:
+                medians = np.median(columns[name][indices], axis=1)
+                out_columns.append(list(map(str, medians.tolist())))
+
+        profiling.count(rows=len(urls))
+
+    with profiling.stage("write"), open(results_file_path, "w") as out_file:
+        out_file.write(",".join(results_header) + "\n")
+        out_file.writelines([ ",".join(row) + "\n" for row in zip(*out_columns) ])
+        profiling.count(rows=len(urls), files=1)
+
+    return unmatched
+
+def add_arguments(parser):
+    parser.add_argument("outputdir")
+    parser.add_argument("--incremental", action="store_true", help="update the results straight from the main table")
+    parser.add_argument("--blacklist", metavar="path", help="skip rows of blacklisted URLs (with --incremental)")
+
+def run(args, session):
+    bm_file_path, _, _, _ = get_output_paths(args.outputdir)
+    results_file_path = append_to_filename(bm_file_path, "_results")
+
+    if args.incremental:
+        summarize_incremental(bm_file_path, results_file_path, None if args.blacklist is None else Blacklist(args.blacklist))
+        return
+
+    try:
+        unmatched = summarize(bm_file_path, results_file_path, session.load_columns)
+    except IOError as e:
+        print("File IO error: {}".format(e))
+        return
+
+    for url, timestamp, js_enabled in unmatched:
+        print("Unmatched row for {} (JS {}, timestamp {})".format(url, "enabled" if js_enabled else "disabled", timestamp))
+
+if __name__ == "__main__":
+    from cli import run_script
+    run_script("summarize")
@@ -2,48 +2,56 @@
 Removes URLs from a file using a blacklist as an additional
 command line parameter.
 """
-from util import get_paths, parse_csv_line, append_to_filename
-from util import benchmark_columns as columns
-
-import os, sys, shutil
-
-if len(sys.argv) < 3:
-    print("usage: {} outputdir blacklist".format(sys.argv[0]))
-    exit()
-
-bm_file_path, _, _, _ = get_paths()
-bm_trunc_file_path = append_to_filename(bm_file_path, "_trunc")
-bl_file_path = sys.argv[2]
-
-# Read all URLs from the blacklist file into list.
-blacklisted_urls = []
-
-with open(bl_file_path, "r") as f:
-    for line in f:
-        line = line.strip()
-
-        # Ignore empty lines and comments.
-        if line.startswith("#") or len(line) == 0:
-            continue
-        
-        blacklisted_urls.append(line)
-
-with open(bm_file_path, "r") as in_file:
-    # Copy CSV header.
-    out_file = open(bm_trunc_file_path, "w")
-    out_file.write(next(in_file))
-
-    # Write rows line by line except for the ones that
-    # belong to a blacklisted URL.
-    for line in in_file:
-        if parse_csv_line(line)[columns["url"]] in blacklisted_urls:
-            continue
-        
-        out_file.write(line)
-
-    out_file.close()
-
-# Copy original file.
-shutil.copyfile(bm_file_path, append_to_filename(bm_file_path, "_orig"))
-# Overwrite original benchmark file.
-shutil.move(bm_trunc_file_path, bm_file_path)
\ No newline at end of file
+from util import get_output_paths, read_benchmark, append_to_filename, Blacklist
+
+import os
+import profiling
+
+def truncate(bm_file_path, bl_file_path):
+    """
+    Removes the rows of blacklisted URLs from the main table. The
+    original table is kept with _orig appended to its name. Returns
+    the amount of removed rows.
+    """
+    bm_trunc_file_path = append_to_filename(bm_file_path, "_trunc")
+
+    blacklist = Blacklist(bl_file_path)
+    removed_rows = 0
+
+    with profiling.stage("truncate"), open(bm_file_path, "r") as in_file:
+        with open(bm_trunc_file_path, "w") as out_file:
+            # Copy CSV header.
+            out_file.write(next(in_file))
+            in_file.seek(0)
+
+            # Write rows line by line except for the ones that
+            # belong to a blacklisted URL.
+            for row in read_benchmark(in_file):
+                profiling.count(rows=1)
+
+                if row.url in blacklist:
+                    removed_rows += 1
+                    continue
+
+                out_file.write(row.line)
+
+        profiling.count(files=1, bytes=os.path.getsize(bm_file_path))
+
+    # Keep the original file and put the truncated one in its place.
+    # Renaming doesn't copy anything, so both files are only written once.
+    os.replace(bm_file_path, append_to_filename(bm_file_path, "_orig"))
+    os.replace(bm_trunc_file_path, bm_file_path)
+
+    return removed_rows
+
+def add_arguments(parser):
+    parser.add_argument("outputdir")
+    parser.add_argument("blacklist")
+
+def run(args, session):
+    bm_file_path, _, _, _ = get_output_paths(args.outputdir)
+    print("Removed {} rows".format(truncate(bm_file_path, args.blacklist)))
+
+if __name__ == "__main__":
+    from cli import run_script
+    run_script("trunc")
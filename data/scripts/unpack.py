@@ -0,0 +1,61 @@
+"""
+Restores the files in the subdirectories of the output directory
+from the packs written by pack.py. Files that already exist are
+left alone. Pass --remove to delete the packs afterwards.
+"""
+from util import get_output_paths, get_pack_paths, ArtifactStore
+
+import os
+
+def unpack(base_dir_path, remove=False):
+    """
+    Restores the files of the subdirectories of an output directory
+    that are missing from their packs. With remove set, the packs are
+    deleted afterwards.
+    """
+    _, metrics_dir_path, noscript_dir_path, screenshots_dir_path = get_output_paths(base_dir_path)
+
+    for dir_path, ext in [
+        ( metrics_dir_path, ".json" ),
+        ( noscript_dir_path, ".html" ),
+        ( screenshots_dir_path, ".png" )
+    ]:
+        pack_path, index_path = get_pack_paths(dir_path)
+
+        if not os.path.exists(index_path):
+            print("{}: no pack found".format(dir_path))
+            continue
+
+        store = ArtifactStore(dir_path, ext)
+        os.makedirs(dir_path, exist_ok=True)
+
+        unpacked = 0
+
+        for name in store.index:
+            file_path = store.get_path(name)
+
+            if os.path.exists(file_path):
+                continue
+
+            with open(file_path, "wb") as f:
+                f.write(store.read(name))
+
+            unpacked += 1
+
+        store.close()
+        print("{}: unpacked {} files".format(dir_path, unpacked))
+
+        if remove:
+            os.remove(pack_path)
+            os.remove(index_path)
+
+def add_arguments(parser):
+    parser.add_argument("outputdir")
+    parser.add_argument("--remove", action="store_true", help="delete the packs afterwards")
+
+def run(args, session):
+    unpack(args.outputdir, args.remove)
+
+if __name__ == "__main__":
+    from cli import run_script
+    run_script("unpack")
@@ -1,9 +1,19 @@
 """
 Collection of utilities.
 """
+from urllib.parse import urlparse
+from collections import namedtuple, deque
+from fnmatch import translate
+import heapq
+import csv
+import json
+import mmap
 import os
+import re
 import sys
 
+import profiling
+
 results_columns = {
     "url":                      0,
     "noscript":                 1,
@@ -25,32 +35,606 @@ benchmark_columns = {
     "dataFileName": 5
 }
 
-def try_remove(lst, item):
+# Header of the file with the summarized results.
+results_header = [ "url", "noscript", "scripts" ]
+
+# Append headers for the median values.
+for x in [ "js", "no_js" ]:
+    results_header.append("median_load_" + x)
+    results_header.append("median_domload_" + x)
+    results_header.append("median_idle_" + x)
+
+# Functions whose calls are counted with --profile, see profiling.py.
+profiled_functions = [ "median", "parse_benchmark_line", "normalize_url" ]
+
+def median(lst):
     """
-    Tries to remove the specified item from a list and 
-    silently fails if the item doesn't exist.
+    Computes the median value in a list of 
+    numeric values.
     """
-    try:
-        lst.remove(item)
-    except Exception:
-        pass
+    lst = sorted(lst)
+    l = len(lst)
+
+    if l % 2 == 0:
+        return (lst[l // 2 - 1] + lst[l // 2]) / 2
+    else:
+        return lst[l // 2]
+
+def summarize_rows(js_row, nojs_row):
+    """
+    Merges the rows of a page with JS enabled and disabled into
+    a row of the results file.
+    """
+    return [
+        # col 1: url
+        js_row.url,
+        # col 2: noscript exists?
+        js_row.noscript or nojs_row.noscript,
+        # col 3: script exists?
+        (js_row.script_count > 0) or (nojs_row.script_count > 0),
+        # col 4: median load (js on)
+        median(js_row.load),
+        # col 5: median domload (js on)
+        median(js_row.domload),
+        # col 6: median idle (js on)
+        median(js_row.idle),
+        # col 7: median load (js off)
+        median(nojs_row.load),
+        # col 8: median domload (js off)
+        median(nojs_row.domload),
+        # col 9: median idle (js off)
+        median(nojs_row.idle)
+    ]
+
+# Counters computed by stats.py.
+stats_counters = [ "count", "noscript", "noscript_without_scripts", "scripts", "scripts_without_noscript" ]
+
+def update_stats(stats, noscript, scripts, sign=1):
+    """
+    Adds a website with the given noscript and scripts flags to the
+    counters of stats.py, or removes it again if sign is -1.
+    """
+    stats["count"] += sign
+    stats["noscript"] += sign * noscript
+    stats["noscript_without_scripts"] += sign * (noscript and not scripts)
+    stats["scripts"] += sign * scripts
+    stats["scripts_without_noscript"] += sign * (scripts and not noscript)
+
+def report_unmatched(url, timestamp, js_enabled):
+    """
+    Default handler for rows that couldn't be paired.
+    """
+    print("Unmatched row for {} (JS {}, timestamp {})".format(url, "enabled" if js_enabled else "disabled", timestamp))
+
+def pair_rows(rows, window=1000, on_unmatched=report_unmatched, leftovers=None):
+    """
+    Pairs rows with JS enabled and disabled by their URL. Expects
+    (url, timestamp, js_enabled, item) tuples in the order they were
+    written and yields (js item, no JS item) tuples. If a URL was
+    benchmarked more than once, rows are paired with the counterpart
+    closest in time. Rows that didn't find a counterpart within the
+    given amount of following rows are handed to on_unmatched, so
+    only a window of rows is kept in memory. If a leftovers list is
+    given, the rows that are still unpaired in the end are appended
+    to it instead, so they can be paired in a later run.
+    """
+    # Unpaired rows by (url, js_enabled) and the order they came in.
+    pending = {}
+    order = deque()
+
+    def evict(key, position):
+        entries = pending.get(key, [])
+
+        for i, entry in enumerate(entries):
+            if entry[0] == position:
+                del entries[i]
+
+                if len(entries) == 0:
+                    del pending[key]
+                
+                return entry
+        
+        # Already paired.
+        return None
+
+    for position, (url, timestamp, js_enabled, item) in enumerate(rows):
+        # Give up on rows that are too far behind.
+        while len(order) > 0 and order[0][0] <= position - window:
+            old_position, key = order.popleft()
+            entry = evict(key, old_position)
+
+            if entry is not None and on_unmatched is not None:
+                on_unmatched(key[0], entry[1], key[1])
+
+        others = pending.get(( url, not js_enabled ))
+
+        if others is None:
+            pending.setdefault(( url, js_enabled ), []).append(( position, timestamp, item ))
+            order.append(( position, ( url, js_enabled ) ))
+            continue
+        
+        # Pair with the row closest in time.
+        other = min(others, key=lambda x: abs(x[1] - timestamp))
+        evict(( url, not js_enabled ), other[0])
+
+        if js_enabled:
+            yield item, other[2]
+        else:
+            yield other[2], item
+    
+    # Everything that is left didn't find a counterpart (yet).
+    for old_position, key in order:
+        entry = evict(key, old_position)
+
+        if entry is None:
+            continue
+        
+        if leftovers is not None:
+            leftovers.append(( key[0], entry[1], key[1], entry[2] ))
+        elif on_unmatched is not None:
+            on_unmatched(key[0], entry[1], key[1])
+
+def chunked(iterable, chunk_size):
+    """
+    Splits an iterable into lists with at most the given amount of
+    items without reading all of it first.
+    """
+    chunk = []
+
+    for x in iterable:
+        chunk.append(x)
+
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    
+    if len(chunk) > 0:
+        yield chunk
+
+def iter_columns(columns, names, chunk_size=65536):
+    """
+    Iterates over the rows of the given columns as tuples, converting
+    the values to Python objects one chunk at a time.
+    """
+    rows = len(columns[names[0]])
+
+    for i in range(0, rows, chunk_size):
+        yield from zip(*[ columns[name][i:i + chunk_size].tolist() for name in names ])
+
+def format_url(url):
+    """
+    Quotes a URL for the results file if it contains a comma.
+    """
+    if "," in url:
+        return "\"{}\"".format(url)
+    
+    return url
+
+def format_results_row(row):
+    """
+    Formats a row of the results file as a line.
+    """
+    return ",".join([ format_url(row[0]) ] + [ str(x) for x in row[1:] ]) + "\n"
+
+def find_orphans(dir_path, ext, data_file_names):
+    """
+    Scans a subdirectory of the output directory once and returns
+    a list of (path, size) tuples for every file in it that isn't
+    named after one of the data file names in the given set with
+    the given extension.
+    """
+    orphans = []
+
+    with os.scandir(dir_path) as it:
+        for entry in it:
+            name, entry_ext = os.path.splitext(entry.name)
+
+            if entry_ext == ext and name in data_file_names:
+                continue
+            
+            orphans.append(( entry.path, entry.stat().st_size ))
+    
+    return orphans
+
+def remove_files(paths, batch_size=1000):
+    """
+    Removes the files at the given paths and yields the amount of
+    removed files after every batch of up to batch_size files. Files
+    are grouped by their directory and removed relative to a handle
+    of it, so the path of the directory is only looked up once.
+    Files that are already gone (e.g. removed by another run) are
+    skipped and not counted.
+    """
+    names = {}
+
+    for path in paths:
+        dir_path, name = os.path.split(path)
+        names.setdefault(dir_path, []).append(name)
+
+    for dir_path, dir_names in names.items():
+        dir_fd = None
+
+        # Not every platform can remove files relative to a directory.
+        if os.unlink in os.supports_dir_fd:
+            try:
+                dir_fd = os.open(dir_path or ".", os.O_RDONLY | os.O_DIRECTORY)
+            except FileNotFoundError:
+                continue
+
+        try:
+            for i in range(0, len(dir_names), batch_size):
+                removed = 0
+
+                for name in dir_names[i:i + batch_size]:
+                    try:
+                        if dir_fd is None:
+                            os.remove(os.path.join(dir_path, name))
+                        else:
+                            os.unlink(name, dir_fd=dir_fd)
+
+                        removed += 1
+                    except FileNotFoundError:
+                        pass
+
+                yield removed
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
+
+def get_pack_paths(dir_path):
+    """
+    Returns the paths to the data file and the index of the pack
+    that belongs to a subdirectory of the output directory, e.g.
+    noscript.pack and noscript.idx for the noscript directory.
+    """
+    base_path = os.path.normpath(dir_path)
+    return base_path + ".pack", base_path + ".idx"
+
+def read_pack_index(index_path):
+    """
+    Reads the index of a pack into a dictionary that maps data file
+    names to (offset, length) tuples. Every line of the index holds
+    the name, offset and length of a file separated by spaces. If a
+    name shows up more than once, the last entry wins.
+    """
+    index = {}
+
+    with open(index_path, "r") as f:
+        for line in f:
+            name, offset, length = line.rsplit(" ", 2)
+            index[name] = ( int(offset), int(length) )
+    
+    return index
+
+class ArtifactStore:
+
+    def __init__(self, dir_path, ext):
+        """
+        Gives access to the files with the given extension that belong
+        to a subdirectory of the output directory, by their data file
+        name. Files are read from the pack of the directory if there
+        is one (see pack.py) and from the directory itself otherwise,
+        so files that were added after packing are found as well.
+        """
+        self.dir_path = dir_path
+        self.ext = ext
+        self.index = {}
+        self.data = None
+
+        pack_path, index_path = get_pack_paths(dir_path)
+
+        if os.path.exists(index_path):
+            self.index = read_pack_index(index_path)
+
+            # mmap refuses to map empty files.
+            if os.path.getsize(pack_path) > 0:
+                with open(pack_path, "rb") as f:
+                    self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    def get_path(self, name):
+        """
+        Returns the path of a file in the directory.
+        """
+        return os.path.join(self.dir_path, name + self.ext)
+
+    def names(self):
+        """
+        Yields the names of all files in the store.
+        """
+        yield from self.index
+
+        if not os.path.isdir(self.dir_path):
+            return
+
+        with os.scandir(self.dir_path) as it:
+            for entry in it:
+                name, ext = os.path.splitext(entry.name)
+
+                if ext == self.ext and name not in self.index:
+                    yield name
+    
+    def __contains__(self, name):
+        return name in self.index or os.path.exists(self.get_path(name))
+
+    def read(self, name):
+        """
+        Returns the contents of a file as bytes.
+        """
+        if name in self.index:
+            offset, length = self.index[name]
+
+            if length == 0:
+                return b""
+
+            return self.data[offset:offset + length]
+        
+        with open(self.get_path(name), "rb") as f:
+            return f.read()
+    
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+
+def normalize_host(host):
+    """
+    Lowercases a hostname and removes the trailing dot of fully
+    qualified names.
+    """
+    return host.lower().rstrip(".")
+
+def normalize_url(url):
+    """
+    Returns a URL with a lowercase scheme and host, without the
+    default port and with a trailing slash if the path is empty.
+    """
+    parsed = urlparse(url)
+    host = normalize_host(parsed.hostname or "")
+
+    # Keep non-default ports.
+    if parsed.port is not None and (parsed.scheme, parsed.port) not in [ ("http", 80), ("https", 443) ]:
+        host += ":{}".format(parsed.port)
+    
+    return parsed._replace(scheme=parsed.scheme.lower(), netloc=host, path=parsed.path or "/").geturl()
+
+class Blacklist:
+
+    def __init__(self, file_path):
+        """
+        Reads a blacklist file. Every line that is neither empty
+        nor a comment is one of the following:
+
+        * a full URL (https://example.com/) that has to match exactly
+        * a hostname (example.com) that matches every URL on that host
+        * a pattern with * wildcards (*.example.com or https://*.example.com/*)
+          that is checked against the hostname if it doesn't have a scheme
+          or against the full URL otherwise
+        """
+        self.urls = set()
+        self.hosts = set()
+        host_patterns = []
+        url_patterns = []
+
+        with open(file_path, "r") as f:
+            for line in f:
+                line = line.strip()
+
+                # Ignore empty lines and comments.
+                if line.startswith("#") or len(line) == 0:
+                    continue
+                
+                if "*" in line:
+                    if "://" in line:
+                        url_patterns.append(translate(line))
+                    else:
+                        host_patterns.append(translate(normalize_host(line)))
+                elif "://" in line:
+                    self.urls.add(line)
+                    self.urls.add(normalize_url(line))
+                else:
+                    self.hosts.add(normalize_host(line))
+        
+        # Compile all patterns into one expression each.
+        self.host_pattern = re.compile("|".join(host_patterns)) if len(host_patterns) > 0 else None
+        self.url_pattern = re.compile("|".join(url_patterns)) if len(url_patterns) > 0 else None
+    
+    def __contains__(self, url):
+        """
+        True if the given URL is blacklisted, False otherwise.
+        """
+        if url in self.urls:
+            return True
+        
+        normalized_url = normalize_url(url)
+
+        if normalized_url in self.urls:
+            return True
+        
+        host = normalize_host(urlparse(normalized_url).hostname or "")
+
+        if host in self.hosts:
+            return True
+        
+        if self.host_pattern is not None and self.host_pattern.match(host):
+            return True
+        
+        if self.url_pattern is not None and self.url_pattern.match(normalized_url):
+            return True
+        
+        return False
+
+def get_args():
+    """
+    Returns the command line arguments that aren't options,
+    i.e. everything that doesn't start with two dashes.
+    """
+    return [ x for x in sys.argv if not x.startswith("--") ]
+
+def get_option(name, default=None):
+    """
+    Returns the value of a command line option passed as --name=value,
+    True if it was passed as --name without a value or the default
+    value if it wasn't passed at all.
+    """
+    prefix = "--" + name
+
+    for x in sys.argv[1:]:
+        if x == prefix:
+            return True
+        
+        if x.startswith(prefix + "="):
+            return x[len(prefix) + 1:]
+    
+    return default
+
+class UsageError(Exception):
+    """
+    Raised when a script is called with missing or invalid arguments.
+    The message is meant to be shown to the user as it is.
+    """
+    pass
 
 def get_paths():
     """
     Gets the output path from the command line and formats
     the paths to the respective subdirectories.
     """
-    if len(sys.argv) < 2:
-        print("usage: {} outputdir [args...]".format(sys.argv[0]))
-        exit()
+    args = get_args()
+
+    if len(args) < 2:
+        raise UsageError("usage: {} outputdir [args...]".format(sys.argv[0]))
     
-    base_dir_path = sys.argv[1]
+    return get_output_paths(args[1])
 
+def get_output_paths(base_dir_path):
+    """
+    Formats the paths to the main table and the subdirectories
+    of an output directory.
+    """
     return (os.path.join(base_dir_path, "benchmark.csv"), 
         os.path.join(base_dir_path, "metrics"), 
         os.path.join(base_dir_path, "noscript"), 
         os.path.join(base_dir_path, "screenshots"))
 
+def get_shards(path):
+    """
+    Returns the list of output directories that make up a dataset.
+    The path is either a single output directory or a manifest, a
+    text file that lists one output directory per line (relative to
+    the manifest). Lines starting with # are ignored.
+    """
+    if os.path.isdir(path):
+        return [ path ]
+    
+    shards = []
+    base_dir_path = os.path.dirname(path)
+
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+
+            if len(line) == 0 or line.startswith("#"):
+                continue
+            
+            shards.append(os.path.join(base_dir_path, line))
+    
+    return shards
+
+def get_dataset():
+    """
+    Gets the dataset from the command line, see open_dataset.
+    """
+    args = get_args()
+
+    if len(args) < 2:
+        raise UsageError("usage: {} <outputdir|manifest> [args...]".format(sys.argv[0]))
+    
+    return open_dataset(args[1])
+
+def open_dataset(path):
+    """
+    Returns the path to base the names of output files on and the
+    list of output directories of a dataset, see get_shards. Files
+    of a single output directory are named after its main table,
+    files of a manifest after the manifest, e.g. crawl_results.csv
+    for crawl.txt.
+    """
+    if os.path.isdir(path):
+        return os.path.join(path, "benchmark.csv"), [ path ]
+    
+    if not os.path.isfile(path):
+        raise UsageError("No such output directory or manifest: {}".format(path))
+    
+    return os.path.splitext(path)[0] + ".csv", get_shards(path)
+
+# Ways to deal with URLs that were benchmarked in more than one shard.
+duplicate_policies = [ "all", "first", "latest", "error" ]
+
+def get_url_owners(shards, policy):
+    """
+    Finds the shard that keeps the rows of every URL that shows up in
+    more than one shard: the one that benchmarked it first or last,
+    depending on the policy. Raises a ValueError for the "error" policy.
+    Returns the dictionary of owners by URL.
+    """
+    # Shard and timestamp of the first and last row of every URL.
+    first = {}
+    last = {}
+    duplicates = set()
+
+    for i, shard in enumerate(shards):
+        columns = load_columns(get_output_paths(shard)[0])
+
+        for url, timestamp in iter_columns(columns, [ "url", "timestamp" ]):
+            if url not in first:
+                first[url] = ( timestamp, i )
+                last[url] = ( timestamp, i )
+                continue
+            
+            if first[url][1] != i:
+                duplicates.add(url)
+
+            first[url] = min(first[url], ( timestamp, i ))
+            last[url] = max(last[url], ( timestamp, i ))
+
+    if policy == "error" and len(duplicates) > 0:
+        raise ValueError("{} URLs are in more than one shard, e.g. {}".format(len(duplicates), sorted(duplicates)[0]))
+
+    owners = first if policy == "first" else last
+    return { url: owners[url][1] for url in duplicates }
+
+def read_shards(shards, duplicates="all"):
+    """
+    Reads the main tables of several output directories as one and
+    yields (shard index, BenchmarkRow) tuples ordered by timestamp.
+    Rows of URLs that were benchmarked in more than one shard are
+    handled according to the given policy, see duplicate_policies.
+    """
+    if duplicates not in duplicate_policies:
+        raise ValueError("Duplicate policy must be one of: {}".format(", ".join(duplicate_policies)))
+
+    owners = {}
+
+    if duplicates != "all" and len(shards) > 1:
+        owners = get_url_owners(shards, duplicates)
+
+    files = [ open(get_output_paths(x)[0], "r") for x in shards ]
+
+    try:
+        def tag_rows(i, f):
+            for row in read_benchmark(f):
+                yield i, row
+
+        # Every main table is written in the order of time already.
+        rows = heapq.merge(*[ tag_rows(i, f) for i, f in enumerate(files) ], key=lambda x: x[1].timestamp)
+
+        for i, row in rows:
+            if owners.get(row.url, i) == i:
+                yield i, row
+    finally:
+        for f in files:
+            f.close()
+
 def as_bool(x):
     """
     Returns True if the given string in lowercase equals "true",
@@ -66,18 +650,391 @@ def append_to_filename(path, suffix):
     name, ext = os.path.splitext(path)
     return name + suffix + ext
 
-def parse_csv_line(line):
+# Columns with the samples of every load state, e.g. load1 to load5.
+timing_columns = [ "load", "domload", "idle" ]
+
+# Typed row of the main table. The timing fields hold lists with
+# one float per iteration and line holds the unparsed line.
+BenchmarkRow = namedtuple("BenchmarkRow", [
+    "url", "timestamp", "js_enabled", "script_count", "noscript", "data_file_name",
+    "load", "domload", "idle", "line"
+])
+
+# Typed row of the results file.
+ResultsRow = namedtuple("ResultsRow", list(results_columns))
+
+def get_timing_indices(header):
+    """
+    Returns a list with the column indices of every iteration
+    for each of the timing columns in the given header.
+    """
+    indices = []
+
+    for name in timing_columns:
+        # Columns are numbered from 1 to the amount of iterations.
+        numbered = [ (int(x[len(name):]), i) for i, x in enumerate(header)
+            if x.startswith(name) and x[len(name):].isdigit() ]
+        indices.append([ i for _, i in sorted(numbered) ])
+    
+    return indices
+
+def as_index(indices):
+    """
+    Turns a list of column indices into a slice if they are
+    consecutive, so the values can be cut out in one go.
+    """
+    if len(indices) > 0 and indices == list(range(indices[0], indices[-1] + 1)):
+        return slice(indices[0], indices[-1] + 1)
+    
+    return indices
+
+def take(values, index):
+    """
+    Returns the values at a slice or list of indices.
+    """
+    if isinstance(index, slice):
+        return values[index]
+    
+    return [ values[i] for i in index ]
+
+# Numbers in the main table are parsed as floats, the integer
+# columns are converted back afterwards.
+parse_values = json.JSONDecoder(parse_int=float).decode
+
+def parse_benchmark_line(line):
+    """
+    Parses a line of the main table into a list of values.
+    writeCSVRow in index.js quotes strings and writes numbers and
+    booleans as they are, which is exactly what a JSON array looks
+    like without the brackets. If that fails because the file was
+    written by something else, the line is parsed as regular CSV.
+    """
+    try:
+        return parse_values("[" + line + "]")
+    except ValueError:
+        values = next(csv.reader([ line ]))
+
+        for i, x in enumerate(values):
+            if x.lower() in [ "true", "false" ]:
+                values[i] = as_bool(x)
+            else:
+                try:
+                    values[i] = float(x)
+                except ValueError:
+                    pass
+        
+        return values
+
+def read_benchmark(f):
+    """
+    Reads the main table (or one of the split tables) from an open
+    file and yields a BenchmarkRow for every row. Strings are quoted
+    the same way as by writeCSVRow in index.js, so URLs may contain
+    commas. The timing columns are taken from the header, so any
+    amount of iterations works.
+    """
+    return parse_benchmark_rows(next(f), f)
+
+def parse_benchmark_rows(header, lines):
+    """
+    Parses lines of the main table with the given header line
+    and yields a BenchmarkRow for every line.
+    """
+    header = next(csv.reader([ header ]))
+    col = { x: i for i, x in enumerate(header) }
+
+    i_url = col["url"]
+    i_timestamp = col["timestamp"]
+    i_js_enabled = col["jsEnabled"]
+    i_script_count = col["scriptCount"]
+    i_noscript = col["noscript"]
+    i_data_file_name = col["dataFileName"]
+    i_load, i_domload, i_idle = [ as_index(x) for x in get_timing_indices(header) ]
+
+    for line in lines:
+        values = parse_benchmark_line(line)
+
+        yield BenchmarkRow(
+            values[i_url],
+            int(values[i_timestamp]),
+            values[i_js_enabled],
+            int(values[i_script_count]),
+            values[i_noscript],
+            values[i_data_file_name],
+            take(values, i_load),
+            take(values, i_domload),
+            take(values, i_idle),
+            line
+        )
+
+def read_results(f):
+    """
+    Reads the results file from an open file and yields a
+    ResultsRow for every row.
+    """
+    reader = csv.reader(f)
+
+    # Skip CSV header.
+    next(reader)
+
+    for values in reader:
+        yield ResultsRow(values[0], as_bool(values[1]), as_bool(values[2]), *[ float(x) for x in values[3:] ])
+
+# Type of the rows that each reader yields.
+row_types = {
+    read_benchmark: BenchmarkRow,
+    read_results: ResultsRow
+}
+
+# Types of the fields of every reader's rows, which can't be taken
+# from the values if a table has no rows. The timing samples (None)
+# turn into (rows x iterations) arrays of floats.
+row_dtypes = {
+    read_benchmark: {
+        "url": str, "timestamp": int, "js_enabled": bool, "script_count": int, "noscript": bool, "data_file_name": str,
+        "load": None, "domload": None, "idle": None
+    },
+    read_results: dict([ ( "url", str ), ( "noscript", bool ), ( "scripts", bool ) ] + [ ( x, float ) for x in list(results_columns)[3:] ])
+}
+
+def get_state_path(csv_path):
+    """
+    Returns the path to the file holding the state of incremental
+    runs for a CSV file, e.g. benchmark_results_state.json for
+    benchmark_results.csv.
+    """
+    return os.path.splitext(csv_path)[0] + "_state.json"
+
+def load_state(state_path):
+    """
+    Loads the state of an incremental run or returns None if
+    there is none yet.
+    """
+    if not os.path.exists(state_path):
+        return None
+    
+    with open(state_path, "r") as f:
+        return json.load(f)
+
+def save_state(state_path, state):
+    """
+    Saves the state of an incremental run. The file is replaced in
+    one go, so an interrupted run never leaves a broken state behind.
+    """
+    with open(state_path + ".tmp", "w") as f:
+        json.dump(state, f)
+    
+    os.replace(state_path + ".tmp", state_path)
+
+# Amount of bytes before the watermark that are kept to check that
+# the file wasn't rewritten since the last run.
+watermark_guard = 64
+
+def open_appended(csv_path, watermark):
+    """
+    Opens a CSV file that is appended to and returns its header, True
+    if reading restarts from the first row, a generator that yields
+    every line after the given watermark and the watermark itself. The
+    watermark is a dict with the byte offset up to which the file has
+    been read and is updated in place while reading. Pass None to read
+    the whole file and get a new watermark. If the
+    file was rewritten since the watermark was taken (e.g. by trunc.py),
+    reading starts over from the first row. A last line that isn't
+    terminated yet is left for the next run.
+    """
+    f = open(csv_path, "rb")
+    header = f.readline()
+    restarted = True
+
+    if watermark is not None and watermark.get("header") == header.decode():
+        offset = watermark["offset"]
+        guard_start = max(offset - watermark_guard, 0)
+
+        f.seek(guard_start)
+
+        if f.read(offset - guard_start).decode("latin-1") == watermark["guard"]:
+            restarted = False
+    
+    if restarted:
+        watermark = {} if watermark is None else watermark
+        watermark.clear()
+        watermark["header"] = header.decode()
+        watermark["offset"] = len(header)
+        watermark["rows"] = 0
+
+    def lines():
+        with f:
+            f.seek(watermark["offset"])
+
+            for line in f:
+                # Still being written.
+                if not line.endswith(b"\n"):
+                    break
+                
+                watermark["offset"] += len(line)
+                watermark["rows"] += 1
+
+                yield line.decode()
+            
+            guard_start = max(watermark["offset"] - watermark_guard, 0)
+            f.seek(guard_start)
+            watermark["guard"] = f.read(watermark["offset"] - guard_start).decode("latin-1")
+    
+    return header.decode(), restarted, lines(), watermark
+
+def get_cache_path(csv_path):
+    """
+    Returns the path to the directory holding the columnar cache
+    of a CSV file, e.g. benchmark_cache for benchmark.csv.
+    """
+    return os.path.splitext(csv_path)[0] + "_cache"
+
+def build_columns(csv_path, reader):
+    """
+    Reads a CSV file with the given reader and returns a dict that
+    maps every field of the rows to a NumPy array. Fields that hold
+    lists (the timing samples) turn into (rows x iterations) arrays.
+    """
+    import numpy as np
+
+    with open(csv_path, "r") as f:
+        rows = list(reader(f))
+    
+    if len(rows) == 0:
+        return build_empty_columns(csv_path, reader)
+
+    columns = {}
+
+    for i, name in enumerate(row_types[reader]._fields):
+        # Raw lines aren't worth keeping around.
+        if name == "line":
+            continue
+        
+        values = [ row[i] for row in rows ]
+
+        if isinstance(values[0], str):
+            # Fixed width strings so the array can be memory-mapped.
+            columns[name] = np.array(values, dtype=str)
+        elif isinstance(values[0], list):
+            columns[name] = np.array(values, dtype=np.float64).reshape(len(values), -1)
+        else:
+            columns[name] = np.array(values)
+    
+    return columns
+
+def build_empty_columns(csv_path, reader):
     """
-    Splits a line of comma seperated values into a list of
-    values. Removes leading and trailing quotes if there are
-    any.
+    Returns the columns of a CSV file without rows (e.g. a main table
+    that only has its header because every URL failed) with the same
+    types as build_columns. The amount of iterations of the timing
+    samples is taken from the header.
     """
-    parsed_line = []
+    import numpy as np
+
+    with open(csv_path, "r") as f:
+        header = next(csv.reader([ f.readline() ]))
+
+    iterations = len(get_timing_indices(header)[0])
+    columns = {}
+
+    for name, dtype in row_dtypes[reader].items():
+        if dtype is None:
+            columns[name] = np.empty(( 0, iterations ))
+        else:
+            columns[name] = np.array([], dtype=dtype)
+
+    return columns
+
+def load_columns(csv_path, reader=read_benchmark):
+    """
+    Returns the columns of a CSV file as a dict of memory-mapped
+    NumPy arrays. The arrays are cached as .npy files next to the
+    CSV file and are rebuilt once the size or modification time
+    of the CSV file changes, so only the first load has to parse it.
+    """
+    import numpy as np
+
+    cache_path = get_cache_path(csv_path)
+    meta_path = os.path.join(cache_path, "meta.json")
+
+    csv_stat = os.stat(csv_path)
+    source = { "size": csv_stat.st_size, "mtime_ns": csv_stat.st_mtime_ns }
+
+    meta = None
 
-    for x in line.split(","):
-        if x[0] == "\"" and x[-1] == "\"":
-            x = x[1:-1]
+    if os.path.exists(meta_path):
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+    
+    if meta is None or meta["source"] != source:
+        with profiling.stage("build_columns"):
+            columns = build_columns(csv_path, reader)
+            profiling.count(rows=len(next(iter(columns.values()), [])), bytes=source["size"])
+
+        os.makedirs(cache_path, exist_ok=True)
+
+        # The meta file is written last, so a cache that was only
+        # partially written is never used.
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+        for name, values in columns.items():
+            np.save(os.path.join(cache_path, name + ".npy"), values)
+        
+        meta = { "source": source, "rows": len(next(iter(columns.values()), [])), "columns": list(columns) }
+
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+    
+    with profiling.stage("load_columns"):
+        profiling.count(rows=meta["rows"], files=len(meta["columns"]))
+        return { name: np.load(os.path.join(cache_path, name + ".npy"), mmap_mode="r") for name in meta["columns"] }
+
+class Session:
+
+    def __init__(self):
+        """
+        Holds data that several commands running in the same process
+        can share, so it's only loaded once, see cli.py. Everything is
+        loaded again once the files it came from change.
+        """
+        self.columns = {}
+        self.stores = {}
+    
+    def load_columns(self, csv_path, reader=read_benchmark):
+        """
+        Same as load_columns, but keeps the columns around.
+        """
+        csv_stat = os.stat(csv_path)
+        source = ( csv_stat.st_size, csv_stat.st_mtime_ns )
+        key = ( os.path.abspath(csv_path), reader )
+
+        if key not in self.columns or self.columns[key][0] != source:
+            self.columns[key] = ( source, load_columns(csv_path, reader) )
+        
+        return self.columns[key][1]
+    
+    def open_store(self, dir_path, ext):
+        """
+        Returns an artifact store of a directory that stays open. It is
+        opened again if the pack index changed since.
+        """
+        _, index_path = get_pack_paths(dir_path)
+        index_stat = os.stat(index_path) if os.path.exists(index_path) else None
+        source = None if index_stat is None else ( index_stat.st_size, index_stat.st_mtime_ns )
+        key = ( os.path.abspath(dir_path), ext )
+
+        if key in self.stores and self.stores[key][0] != source:
+            self.stores.pop(key)[1].close()
+
+        if key not in self.stores:
+            self.stores[key] = ( source, ArtifactStore(dir_path, ext) )
         
-        parsed_line.append(x.strip())
+        return self.stores[key][1]
     
-    return parsed_line
\ No newline at end of file
+    def close(self):
+        for _, store in self.stores.values():
+            store.close()
+        
+        self.columns = {}
+        self.stores = {}